@@ -0,0 +1,258 @@
+# Find known ads inside episodes and emit the remove segments of concat.remove_ads.
+#
+# remove_ads needs markInMillis/duration pairs written by hand (see remove.json). For back catalog cleanup
+# the detector finds them: every ad of the library and the track are decoded to 8 kHz mono and turned into
+# a spectral fingerprint, the frame to frame change of the log energy of FINGERPRINT_BANDS bands (a gain
+# change of the whole file cancels out). An ad is located where the normalized cross-correlation of its
+# fingerprint with the one of the track peaks above the threshold.
+#
+# All of it is batched NumPy: the spectrogram is computed FFT_BLOCK_FRAMES frames per rfft call, and the
+# cross-correlation of every band of every ad with the track is one multiplication in the frequency
+# domain (the track is transformed once for the whole library), summed over the bands before a single
+# inverse FFT per ad. A one hour episode is scanned in a few seconds, most of it spent decoding.
+#
+# Fingerprints of the ads are kept in a DiskLRU keyed by the content of the ad file.
+#
+# usage: python addetect.py ivm_episode1.mp3 Geico.mp3 Coke.mp3 kfc.mp3 > remove.json
+#        python concat.py remove.json
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import uuid
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+# Third Party Imports
+import numpy as np
+
+# Imports from this repository
+import pcmengine
+from diskcache import CACHE_ROOT
+from diskcache import DiskLRU
+from diskcache import content_key
+from probecache import estimate_duration
+
+SAMPLE_RATE = 8000
+FFT_SIZE = 512
+HOP = 256  # 32 ms per fingerprint frame
+FINGERPRINT_BANDS = 32
+MIN_FREQ = 300
+MAX_FREQ = 3400
+FFT_BLOCK_FRAMES = 16384
+# ads correlated with the track per batch, bounds the frequency domain arrays held at once
+AD_BATCH = 8
+# normalized correlation a match must reach, unrelated audio stays near 0
+DEFAULT_THRESHOLD = 0.4
+FINGERPRINT_MAX_BYTES = 256 * 1024 * 1024
+FINGERPRINT_SUFFIX = ".fp.npy"
+
+
+class Detection(NamedTuple):
+    ad_id: int  # position of the ad in its AdLibrary, or its id in a FingerprintIndex
+    name: str  # path of the ad, unique per ad
+    start_frame: int
+    frames: int
+    score: float
+
+    def to_remove_segment(self, ad_duration_millis: int) -> Dict:
+        return {
+            "markInMillis": int(round(self.start_frame * HOP * 1000 / SAMPLE_RATE)),
+            "duration": ad_duration_millis,
+            "ad": self.name,
+            "score": round(self.score, 3),
+        }
+
+
+def _band_matrix() -> np.ndarray:
+    """(FFT bins, bands) matrix summing the power of each band."""
+    freqs = np.fft.rfftfreq(FFT_SIZE, 1.0 / SAMPLE_RATE)
+    edges = np.geomspace(MIN_FREQ, MAX_FREQ, FINGERPRINT_BANDS + 1)
+    band = np.searchsorted(edges, freqs, side="right") - 1
+    matrix = np.zeros((len(freqs), FINGERPRINT_BANDS), dtype=np.float32)
+    inside = (band >= 0) & (band < FINGERPRINT_BANDS)
+    matrix[np.nonzero(inside)[0], band[inside]] = 1.0
+    return matrix
+
+
+def frame_view(pcm: np.ndarray) -> np.ndarray:
+    """(frames, FFT_SIZE) view of the overlapping analysis frames of mono ``pcm``, HOP apart."""
+    pcm = np.asarray(pcm, dtype=np.float32).reshape(-1)
+    if len(pcm) < FFT_SIZE:
+        return np.zeros((0, FFT_SIZE), dtype=np.float32)
+    return np.lib.stride_tricks.sliding_window_view(pcm, FFT_SIZE)[::HOP]
+
+
+def power_spectrum(frames: np.ndarray) -> np.ndarray:
+    """(frames, FFT_SIZE // 2 + 1) power spectrum of analysis frames, Hann windowed."""
+    spectrum = np.fft.rfft(frames * np.hanning(FFT_SIZE).astype(np.float32), axis=1)
+    return (spectrum.real ** 2 + spectrum.imag ** 2).astype(np.float32)
+
+
+def band_energies(pcm: np.ndarray) -> np.ndarray:
+    """(frames, FINGERPRINT_BANDS) log band energies of mono ``pcm``."""
+    frames = frame_view(pcm)
+    bands = _band_matrix()
+    energies = np.empty((len(frames), FINGERPRINT_BANDS), dtype=np.float32)
+    for start in range(0, len(frames), FFT_BLOCK_FRAMES):
+        power = power_spectrum(frames[start:start + FFT_BLOCK_FRAMES])
+        energies[start:start + FFT_BLOCK_FRAMES] = np.log(power @ bands + 1e-3)
+    return energies
+
+
+def fingerprint(pcm: np.ndarray) -> np.ndarray:
+    """(frames, FINGERPRINT_BANDS) frame to frame change of the log band energies."""
+    return np.diff(band_energies(pcm), axis=0)
+
+
+def _decode_mono(source: str) -> np.ndarray:
+    pcm_file = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}-detect{pcmengine.SUFFIX}")
+    try:
+        pcmengine.decode(source, pcm_file, SAMPLE_RATE, 1)
+        # the map is copied, the fingerprint of a one hour track needs the samples only once anyway
+        return np.array(pcmengine.open_pcm(pcm_file, 1)[:, 0])
+    finally:
+        os.remove(pcm_file)
+
+
+def _params_digest() -> str:
+    params = [SAMPLE_RATE, FFT_SIZE, HOP, FINGERPRINT_BANDS, MIN_FREQ, MAX_FREQ]
+    return hashlib.md5(json.dumps(params).encode()).hexdigest()[:8]
+
+
+class AdLibrary:
+    """Fingerprints of the ads to look for."""
+
+    def __init__(self, filenames: List[str], store: Optional[DiskLRU] = None):
+        self.filenames = list(filenames)
+        self.store = store
+        self.fingerprints = [self._fingerprint(filename) for filename in self.filenames]
+
+    def _fingerprint(self, filename: str) -> np.ndarray:
+        if self.store is None:
+            return fingerprint(_decode_mono(filename))
+        key = f"{content_key(filename)}-{_params_digest()}"
+        path = self.store.get(key, FINGERPRINT_SUFFIX)
+        if path is None:
+            fp = fingerprint(_decode_mono(filename))
+
+            def write(tmp_path):
+                with open(tmp_path, "wb") as f:
+                    np.save(f, fp)
+
+            self.store.put(key, FINGERPRINT_SUFFIX, write)
+            return fp
+        return np.load(path)
+
+    def duration_millis(self, i: int) -> int:
+        # the fingerprint stops up to a window before the end of the ad, the headers know the exact length
+        return int(round(estimate_duration(self.filenames[i]) * 1000))
+
+
+def _windowed_norms(track: np.ndarray, frames: int) -> np.ndarray:
+    """Norm of every ``frames`` long window of ``track`` with the mean of each band removed."""
+    zero = np.zeros((1, track.shape[1]), dtype=np.float64)
+    s1 = np.concatenate([zero, np.cumsum(track, axis=0, dtype=np.float64)])
+    s2 = np.concatenate([zero, np.cumsum(track.astype(np.float64) ** 2, axis=0)])
+    window_s1 = s1[frames:] - s1[:-frames]
+    window_s2 = s2[frames:] - s2[:-frames]
+    return np.sqrt(np.maximum((window_s2 - window_s1 ** 2 / frames).sum(axis=1), 0))
+
+
+def correlate(track: np.ndarray, ads: List[np.ndarray]) -> List[np.ndarray]:
+    """
+    Normalized cross-correlation (Pearson, over all bands) of each ad fingerprint with every position of
+    the track fingerprint. Element ``k`` compares the ad with the track frames ``k:k + len(ad)``.
+    """
+    # an ad longer than the track can not be in it
+    scores = [np.zeros(0, dtype=np.float32) for _ in ads]
+    usable = [i for i, ad in enumerate(ads) if 1 < len(ad) <= len(track)]
+    if not usable:
+        return scores
+
+    size = len(track) + max(len(ads[i]) for i in usable) - 1
+    size = 1 << (size - 1).bit_length()
+    track_spectrum = np.fft.rfft(track, size, axis=0)
+    for batch_start in range(0, len(usable), AD_BATCH):
+        batch = usable[batch_start:batch_start + AD_BATCH]
+        centered = [ads[i] - ads[i].mean(axis=0) for i in batch]
+        # correlation is convolution with the reversed ad
+        ad_spectra = np.stack([np.fft.rfft(ad[::-1], size, axis=0) for ad in centered])
+        products = np.einsum("fb,afb->af", track_spectrum, ad_spectra)
+        correlations = np.fft.irfft(products, size, axis=1)
+        for i, ad, correlation in zip(batch, centered, correlations):
+            frames = len(ad)
+            numerator = correlation[frames - 1:len(track)]
+            denominator = _windowed_norms(track, frames) * np.sqrt((ad.astype(np.float64) ** 2).sum())
+            scores[i] = np.where(denominator > 0, numerator / np.maximum(denominator, 1e-12), 0).astype(np.float32)
+    return scores
+
+
+def _peaks(score: np.ndarray, threshold: float, spacing: int) -> List[int]:
+    """Positions of the peaks of ``score`` above ``threshold``, at least ``spacing`` apart."""
+    candidates = np.nonzero(score >= threshold)[0]
+    candidates = candidates[np.argsort(score[candidates])[::-1]]
+    taken = np.zeros(len(score), dtype=bool)
+    peaks = []
+    for position in candidates:
+        if not taken[position]:
+            peaks.append(int(position))
+            taken[max(position - spacing + 1, 0):position + spacing] = True
+    return peaks
+
+
+def resolve_overlaps(detections: List[Detection]) -> List[Detection]:
+    """Two ads can not play at the same time, keep the better match of overlapping detections."""
+    kept: List[Detection] = []
+    for detection in sorted(detections, key=lambda d: d.score, reverse=True):
+        end = detection.start_frame + detection.frames
+        if all(end <= k.start_frame or k.start_frame + k.frames <= detection.start_frame for k in kept):
+            kept.append(detection)
+    return sorted(kept, key=lambda d: d.start_frame)
+
+
+def detect(track_fingerprint: np.ndarray, library: AdLibrary, threshold: float = DEFAULT_THRESHOLD) -> List[Detection]:
+    """Occurrences of the ads of ``library`` in the track, in track order, overlaps resolved by score."""
+    detections = []
+    for i, score in enumerate(correlate(track_fingerprint, library.fingerprints)):
+        frames = len(library.fingerprints[i])
+        for position in _peaks(score, threshold, frames):
+            detections.append(Detection(i, library.filenames[i], position, frames, float(score[position])))
+
+    return resolve_overlaps(detections)
+
+
+def find_remove_segments(
+    track_file: str, library: AdLibrary, threshold: float = DEFAULT_THRESHOLD
+) -> List[Dict]:
+    """Remove segments (markInMillis, duration) of the ads of ``library`` found in ``track_file``."""
+    track_fingerprint = fingerprint(_decode_mono(track_file))
+    return [
+        detection.to_remove_segment(library.duration_millis(detection.ad_id))
+        for detection in detect(track_fingerprint, library, threshold)
+    ]
+
+
+def get_fingerprint_store() -> DiskLRU:
+    return DiskLRU(os.path.join(CACHE_ROOT, "fingerprints"), FINGERPRINT_MAX_BYTES)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Find known ads in a track and print a remove job")
+    parser.add_argument("track_file")
+    parser.add_argument("ads", nargs="+", help="ad files to look for")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    library = AdLibrary(args.ads, get_fingerprint_store())
+    ad_segments = find_remove_segments(args.track_file, library, args.threshold)
+    json.dump({"track_file": args.track_file, "cmd": "remove", "ad_segments": ad_segments}, sys.stdout, indent=1)
+    print()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
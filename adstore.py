@@ -0,0 +1,149 @@
+# Persistent store of normalized ads.
+#
+# The ad inventory is a few hundred files reused by millions of stitches. Instead of probing, copying or
+# re-encoding every ad into path_tmp for every job (do_transcode, main), each ad is normalized once to the
+# adori audio standard and kept here, keyed by the content of the source and the normalization
+# parameters. Stitch jobs read the stored file directly. Concurrent requests for the same ad, from threads
+# or from other worker processes, wait on a file lock and reuse the result of the first one.
+#
+# adori audio std
+#   stereo
+#   44100 Hz
+#   128kbps CBR
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import uuid
+from typing import Dict
+from typing import Optional
+
+# Imports from this repository
+from diskcache import CACHE_ROOT
+from diskcache import DiskLRU
+from diskcache import content_key
+from diskcache import file_lock
+from diskcache import link_or_copy
+from probecache import ProbeError
+from probecache import probe
+
+DEFAULT_MAX_BYTES = int(os.getenv("AD_STITCH_AD_STORE_BYTES", 4 * 1024 * 1024 * 1024))
+SUFFIX = ".mp3"
+# get_normalized_link gives up after the entry was evicted this many times between lookup and link
+LINK_ATTEMPTS = 3
+
+# ffmpeg output options of the adori audio standard
+NORMALIZATION = {"ar": 44100, "ac": 2, "b:a": "128k"}
+
+
+def _params_digest(params: Dict) -> str:
+    encoded = json.dumps(params, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.md5(encoded).hexdigest()[:8]
+
+
+def _is_normalized(source: str, params: Dict) -> bool:
+    if params != NORMALIZATION:
+        return False
+    try:
+        info = probe(source)
+    except ProbeError:
+        return False
+    return info.codec_name == "mp3" and info.channels == 2 and info.sample_rate == 44100 and info.bit_rate == 128000
+
+
+def transcode_args(
+    input_filename: str,
+    output_filename: str,
+    remove_meta: bool = False,
+    params: Dict = NORMALIZATION,
+    output_format: Optional[str] = None,
+):
+    """ffmpeg arguments of a single decode+encode pass of ``input_filename`` to ``params``, no intermediate wav."""
+    args = ["ffmpeg", "-y", "-hide_banner", "-nostats", "-loglevel", "panic", "-i", input_filename]
+    for option, value in params.items():
+        args += [f"-{option}", str(value)]
+    if remove_meta:
+        args += ["-map_metadata", "-1"]
+    if output_format:
+        args += ["-f", output_format]
+    return args + [output_filename]
+
+
+def normalize(source: str, output_filename: str, params: Dict = NORMALIZATION, remove_meta: bool = True):
+    """
+    Write the normalized version of ``source`` to ``output_filename``.
+
+    A source that already matches the standard is copied (metadata included, as do_transcode does),
+    otherwise it is decoded and re-encoded by a single ffmpeg run.
+    """
+    if _is_normalized(source, params):
+        shutil.copyfile(source, output_filename)
+        return
+    subprocess.check_call(args=transcode_args(source, output_filename, remove_meta, params, "mp3"))
+
+
+class AdStore:
+    def __init__(self, directory: str, max_bytes: int, params: Dict = NORMALIZATION):
+        self.store = DiskLRU(directory, max_bytes)
+        self.params = params
+        self._params_digest = _params_digest(params)
+        self._lock_dir = os.path.join(directory, "locks")
+
+    def key(self, source: str) -> str:
+        return f"{content_key(source)}-{self._params_digest}"
+
+    def get_normalized(self, source: str) -> str:
+        """
+        Path of the normalized version of ``source``, normalizing it on the first request.
+
+        The returned file belongs to the store, callers must not modify or delete it.
+        """
+        if os.path.dirname(os.path.realpath(source)) == os.path.realpath(self.store.directory):
+            return source
+        key = self.key(source)
+        path = self.store.get(key, SUFFIX)
+        if path is not None:
+            return path
+        with file_lock(os.path.join(self._lock_dir, f"{key}.lock")):
+            # another thread or process may have built it while we waited for the lock
+            path = self.store.get(key, SUFFIX)
+            if path is None:
+                path = self.store.put(key, SUFFIX, lambda tmp_path: normalize(source, tmp_path, self.params))
+        return path
+
+    def get_normalized_link(self, source: str, directory: str) -> str:
+        """
+        Hard link (or copy) in ``directory`` of the normalized version of ``source``.
+
+        Any process's put may evict the entry returned by get_normalized before a job opens it, the link
+        keeps the file for as long as the job needs it. The caller owns the link and removes it.
+        """
+        for _ in range(LINK_ATTEMPTS):
+            link_filename = os.path.join(directory, f"{uuid.uuid4()}{SUFFIX}")
+            try:
+                link_or_copy(self.get_normalized(source), link_filename)
+                return link_filename
+            except FileNotFoundError:  # evicted in between, normalized again by the next get_normalized
+                continue
+        raise FileNotFoundError(f"Normalized version of {source} was evicted {LINK_ATTEMPTS} times")
+
+
+_default_store: Optional[AdStore] = None
+
+
+def get_store() -> AdStore:
+    global _default_store
+    if _default_store is None:
+        _default_store = AdStore(os.path.join(CACHE_ROOT, "ads"), DEFAULT_MAX_BYTES)
+    return _default_store
+
+
+def get_normalized(source: str) -> str:
+    """get_normalized of the default store."""
+    return get_store().get_normalized(source)
+
+
+def get_normalized_link(source: str, directory: str) -> str:
+    """get_normalized_link of the default store."""
+    return get_store().get_normalized_link(source, directory)
@@ -0,0 +1,156 @@
+# Batch stitching of a JSONL job file.
+#
+# Every line of the job file is one stitch.json/remove.json style job:
+# {"id": "ep1-setA", "track_file": "ivm_episode1.mp3", "cmd": "stitch", "ad_segments": [...]}
+# Jobs are streamed to a bounded process pool and one result line per job is appended to the results file:
+# {"id": "ep1-setA", "status": "ok", "output": "...", "estimatedDuration": 152.4, "duration": 152.4,
+#  "drift": 0.0, "seconds": 0.21}
+# {"id": "ep1-setB", "status": "error", "error": "...", "seconds": 0.01}
+# The results file is the checkpoint: on restart, jobs whose id already has a result line are skipped,
+# so a crashed overnight run resumes where it stopped. Jobs without an "id" are identified by their line
+# number in the job file.
+#
+# usage: python batch.py jobs.jsonl results.jsonl [--workers 8] [--tmp ./tmp/] [--retry-errors]
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from typing import Dict
+from typing import Iterator
+from typing import Set
+from typing import Tuple
+
+# Imports from this repository
+import concat
+import probecache
+
+
+def _init_worker(path_tmp: str):
+    # concat keeps its tmp directory in a module global, set it once per worker process
+    concat.path_tmp = path_tmp
+
+
+def run_job(job_id: str, job: Dict) -> Dict:
+    start_time = time.monotonic()
+    result = {"id": job_id, "cmd": job.get("cmd")}
+    try:
+        cmd = job["cmd"]
+        if cmd == "stitch":
+            # stitch_ads checks the duration against the ads it inserted, the check is not run again here
+            output, durations = concat.stitch_ads_checked(job_id, job)
+        elif cmd == "remove":
+            output = concat.remove_ads(job_id, job)
+        else:
+            raise ValueError(f"Unknown cmd {cmd}")
+        if not output:
+            raise RuntimeError("No output file produced")
+        result.update(status="ok", output=output)
+        if cmd == "stitch":
+            estimated, duration, drift = durations
+            result.update(estimatedDuration=estimated, duration=duration, drift=drift)
+        else:
+            result.update(duration=probecache.estimate_duration(output))
+    except Exception as e:
+        result.update(status="error", error=f"{type(e).__name__}: {e}")
+    result["seconds"] = time.monotonic() - start_time
+    return result
+
+
+def read_jobs(jobs_filename: str) -> Iterator[Tuple[str, Dict]]:
+    """Yield (job id, job) for every non empty line of the job file."""
+    with open(jobs_filename) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            job = json.loads(line)
+            yield str(job.get("id", line_number)), job
+
+
+def read_done(results_filename: str, retry_errors: bool = False) -> Set[str]:
+    """
+    Ids with a result line, a torn last line from a crash is ignored (its job is run again).
+    With ``retry_errors`` only successful jobs count as done.
+    """
+    done = set()
+    if not os.path.exists(results_filename):
+        return done
+    with open(results_filename) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+                if not retry_errors or result["status"] == "ok":
+                    done.add(str(result["id"]))
+            except (ValueError, KeyError):
+                continue
+    return done
+
+
+def run_batch(
+    jobs_filename: str, results_filename: str, workers: int = None, path_tmp: str = None, retry_errors: bool = False
+) -> Dict:
+    """
+    Run every job of ``jobs_filename`` not yet present in ``results_filename``.
+
+    At most ``2 * workers`` jobs are in flight, so job files of any size are streamed rather than
+    loaded at once.
+
+    :return: counts of ok/error/skipped jobs
+    """
+    workers = workers or os.cpu_count() or 1
+    # concat builds its file names as f"{path_tmp}{basename}...", the directory needs its trailing separator
+    path_tmp = os.path.join(path_tmp or concat.path_tmp, "")
+    os.makedirs(path_tmp, exist_ok=True)
+    done = read_done(results_filename, retry_errors)
+    counts = {"ok": 0, "error": 0, "skipped": 0}
+
+    with open(results_filename, "a") as results, ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(path_tmp,)
+    ) as executor:
+
+        def drain(pending, return_when):
+            finished, pending = wait(pending, return_when=return_when)
+            for future in finished:
+                result = future.result()
+                counts[result["status"]] += 1
+                results.write(json.dumps(result) + "\n")
+                results.flush()
+                os.fsync(results.fileno())
+            return pending
+
+        pending = set()
+        for job_id, job in read_jobs(jobs_filename):
+            if job_id in done:
+                counts["skipped"] += 1
+                continue
+            done.add(job_id)
+            pending.add(executor.submit(run_job, job_id, job))
+            if len(pending) >= 2 * workers:
+                pending = drain(pending, FIRST_COMPLETED)
+        while pending:
+            pending = drain(pending, FIRST_COMPLETED)
+
+    return counts
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Run stitch/remove jobs from a JSONL file")
+    parser.add_argument("jobs", help="JSONL job file")
+    parser.add_argument("results", help="JSONL results file, also used as the resume checkpoint")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: cpu count)")
+    parser.add_argument("--tmp", default=os.path.join(os.getcwd(), "tmp", ""), help="directory for outputs")
+    parser.add_argument("--retry-errors", action="store_true", help="run jobs that failed in a previous run again")
+    args = parser.parse_args(argv)
+
+    start_time = time.monotonic()
+    counts = run_batch(args.jobs, args.results, args.workers, args.tmp, args.retry_errors)
+    print(f"{counts} in {time.monotonic() - start_time} Secs")
+    return 0 if counts["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,71 @@
+# Benchmark of the transcode pipelines on the sample MP3s of this repository.
+#
+#   two-pass     input -> temp.wav -> output.mp3 (the old transcode.do_transcode / concat.do_transcode path)
+#   single-pass  input -> output.mp3 in one ffmpeg run (adstore.transcode_args)
+#
+# Reports the median wall time of each pipeline and the bytes it wrote to disk (intermediate + output).
+# usage: python bench_transcode.py [repeat] [files...] > bench_output.txt
+import glob
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+FFMPEG = ["ffmpeg", "-y", "-hide_banner", "-nostats", "-loglevel", "panic"]
+ENCODE = ["-ar", "44100", "-ac", "2", "-b:a", "128k"]  # adstore.NORMALIZATION
+
+
+def _two_pass(input_filename: str, work_dir: str):
+    wav = os.path.join(work_dir, f"{uuid.uuid4()}.wav")
+    output = os.path.join(work_dir, f"{uuid.uuid4()}.mp3")
+    subprocess.check_call(FFMPEG + ["-i", input_filename, wav])
+    subprocess.check_call(FFMPEG + ["-i", wav] + ENCODE + [output])
+    written = os.path.getsize(wav) + os.path.getsize(output)
+    os.remove(wav)
+    os.remove(output)
+    return written
+
+
+def _single_pass(input_filename: str, work_dir: str):
+    output = os.path.join(work_dir, f"{uuid.uuid4()}.mp3")
+    subprocess.check_call(FFMPEG + ["-i", input_filename] + ENCODE + [output])
+    written = os.path.getsize(output)
+    os.remove(output)
+    return written
+
+
+def bench(input_filename: str, work_dir: str, repeat: int):
+    results = {}
+    for name, pipeline in (("two-pass", _two_pass), ("single-pass", _single_pass)):
+        times = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            written = pipeline(input_filename, work_dir)
+            times.append(time.perf_counter() - start_time)
+        results[name] = (statistics.median(times), written)
+    return results
+
+
+def main(argv):
+    repeat = int(argv[0]) if argv else 3
+    files = argv[1:] or sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.mp3")))
+    with tempfile.TemporaryDirectory() as work_dir:
+        total = {"two-pass": [0.0, 0], "single-pass": [0.0, 0]}
+        print(f"{'file':<20}{'pipeline':<14}{'wall s':>10}{'disk bytes':>14}")
+        for input_filename in files:
+            for name, (seconds, written) in bench(input_filename, work_dir, repeat).items():
+                total[name][0] += seconds
+                total[name][1] += written
+                print(f"{os.path.basename(input_filename):<20}{name:<14}{seconds:>10.3f}{written:>14}")
+        print(f"{'total':<20}{'two-pass':<14}{total['two-pass'][0]:>10.3f}{total['two-pass'][1]:>14}")
+        print(f"{'total':<20}{'single-pass':<14}{total['single-pass'][0]:>10.3f}{total['single-pass'][1]:>14}")
+        if total["single-pass"][0]:
+            print(f"single-pass / two-pass: wall time {total['single-pass'][0] / total['two-pass'][0]:.1%}, "
+                  f"disk bytes {total['single-pass'][1] / total['two-pass'][1]:.1%}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
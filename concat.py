@@ -6,7 +6,16 @@ import subprocess
 import uuid
 import logging
 import shutil
+import adstore
+import diskcache
+import envelope
+import indexcache
 import logger
+import mp3frames
+import probecache
+import rangecopy
+import slicecache
+import smartrender
 from datetime import datetime
 from datetime import timedelta
 from typing import Dict
@@ -44,33 +53,11 @@ def GetAudioLength(inputFile: str = None):
     if not os.path.exists(inputFile): 
         print(f"Audio file {inputFile} does not exist")
         return 0
-    result = subprocess.run(
-        args=[
-            "ffprobe",
-            "-hide_banner",
-            "-v",
-            "quiet",
-            "-i",
-            inputFile,
-            "-print_format",
-            "json",
-            "-show_format",
-            "-show_streams",
-        ],
-        stdout=subprocess.PIPE,
-    )
+    # probecache runs ffprobe at most once per file version
     try:
-        audio_length = 0
-        if result.returncode == 0:
-            obj = json.loads(result.stdout)
-            if isinstance(obj, dict):
-                if "streams" in obj:
-                    stream = obj["streams"][0]
-                    audio_length = float(stream["duration"])
-        else:
-            logging.error("FFProbe : Non-zero return code {}")
-    except json.JSONDecodeError:
-        logging.error(json.JSONDecodeError)
+        audio_length = probecache.probe(inputFile).duration
+    except probecache.ProbeError as e:
+        logging.error(str(e))
         audio_length = 0
 
     if audio_length == 0:
@@ -80,7 +67,10 @@ def GetAudioLength(inputFile: str = None):
     return audio_length
 
 #.global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
+# Track slices are looked up in the slicecache (keyed by track content, start and end) before they are cut,
+# so stitching the same episode with another ad set reuses the slices of the previous stitch.
 def _get_concat_files(basename: str, orig_file: str, insert_segments: List[Dict]):
+    slice_cache = slicecache.get_cache()
     concat_files = []
     prev_input_slice_end = 0
     outro = False
@@ -95,12 +85,14 @@ def _get_concat_files(basename: str, orig_file: str, insert_segments: List[Dict]
         elif prev_input_slice_end < mark_in_sec:
             output_file = f"{path_tmp}{basename}-{prev_input_slice_end}-{mark_in_sec}.mp3"
             try:
-                cmd = (
-                    ffmpeg.input(orig_file, ss=prev_input_slice_end, to=mark_in_sec)
-                    .output(output_file, c="copy", avoid_negative_ts=1)
-                    .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
-                )
-                cmd.run(capture_stdout=True, capture_stderr=True)
+                if not slice_cache.fetch(orig_file, prev_input_slice_end, mark_in_sec, output_file):
+                    cmd = (
+                        ffmpeg.input(orig_file, ss=prev_input_slice_end, to=mark_in_sec)
+                        .output(output_file, c="copy", avoid_negative_ts=1)
+                        .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
+                    )
+                    cmd.run(capture_stdout=True, capture_stderr=True)
+                    slice_cache.store_slice(orig_file, prev_input_slice_end, mark_in_sec, output_file)
                 prev_input_slice_end = mark_in_sec
                 concat_files.append(output_file)
                 concat_files.append(ad["filepath"])
@@ -112,12 +104,14 @@ def _get_concat_files(basename: str, orig_file: str, insert_segments: List[Dict]
                 raise e
         
     output_file = f"{path_tmp}{basename}-{prev_input_slice_end}-end.mp3"
-    cmd = (
-        ffmpeg.input(orig_file, ss=prev_input_slice_end)
-        .output(output_file, c="copy", avoid_negative_ts=1)
-        .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
-    )
-    cmd.run()
+    if not slice_cache.fetch(orig_file, prev_input_slice_end, None, output_file):
+        cmd = (
+            ffmpeg.input(orig_file, ss=prev_input_slice_end)
+            .output(output_file, c="copy", avoid_negative_ts=1)
+            .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
+        )
+        cmd.run()
+        slice_cache.store_slice(orig_file, prev_input_slice_end, None, output_file)
     concat_files.append(output_file)
 
     if outro == True:
@@ -162,17 +156,143 @@ def do_concat_files(uid: str, orig_file: str, insert_segments: List[Dict]):
         # remove temp files created within this method
         os.remove(concat_filename)
         #print (f"removing {concat_filename}")
-        # for seg in insert_segments:
-        #     concat_file_list.remove(seg["filepath"])
+        # ad files are not ours to delete (they may live in the adstore), only the slices are removed
+        ad_files = {seg["filepath"] for seg in insert_segments}
         for f in concat_file_list: 
-            os.remove(f)
+            if f not in ad_files:
+                os.remove(f)
             #print (f"removing {f}")
 
     return output_filename
 
 
+# Stitch modes
+#   slice   - legacy path: every track slice is cut to path_tmp by its own ffmpeg process and the
+#             slices are then joined by a second concat run (N+2 process spawns)
+#   inpoint - one concat list that references the original track_file with inpoint/outpoint
+#             directives, stitched by a single ffmpeg run with no intermediate slices
+#   splice  - no ffmpeg at all, the same concat entries are mapped to MP3 frame boundaries by
+#             mp3frames (frame indexes are kept in the indexcache sidecar cache) and the output is assembled from byte ranges of the sources by rangecopy
+#             (copy_file_range/sendfile), no slice is written to path_tmp
+#   smart   - splice, except for a few frames around every join that are decoded and re-encoded by
+#             smartrender, so cuts are sample exact and the encoder delay/padding of the ads is removed
+STITCH_MODE_SLICE = "slice"
+STITCH_MODE_INPOINT = "inpoint"
+STITCH_MODE_SPLICE = "splice"
+STITCH_MODE_SMART = "smart"
+DEFAULT_STITCH_MODE = STITCH_MODE_INPOINT
+
+
+# The concat demuxer reads paths between single quotes, a quote in the path has to be written as '\''
+def _escape_concat_path(filename: str):
+    return filename.replace("'", "'\\''")
+
+
+# Writes a concat demuxer list. Each entry is (filename, inpoint, outpoint), inpoint/outpoint may be None
+# to play the file from its start or until its end. Paths are written absolute since the demuxer
+# resolves relative paths against the directory of the list file (path_tmp).
+# file '/workspaces/Adorify/pyadorifier/ad_stitching/ivm_episode1.mp3'
+# outpoint 5.0
+# file '/workspaces/Adorify/pyadorifier/ad_stitching/tmp/kfc.mp3'
+# file '/workspaces/Adorify/pyadorifier/ad_stitching/ivm_episode1.mp3'
+# inpoint 5.0
+def _write_concat_list(concat_filename: str, entries: List[Tuple]):
+    with open(concat_filename, "w") as f:
+        for filename, inpoint, outpoint in entries:
+            f.write(f"file '{_escape_concat_path(os.path.abspath(filename))}'\n")
+            if inpoint:
+                f.write(f"inpoint {inpoint}\n")
+            if outpoint is not None:
+                f.write(f"outpoint {outpoint}\n")
+
+
+# Same segment layout as _get_concat_files, but the track slices are returned as
+# (orig_file, start, end) entries instead of being cut into separate files.
+def _get_concat_entries(orig_file: str, insert_segments: List[Dict]):
+    entries = []
+    prev_input_slice_end = 0
+    outro = False
+    for ad in insert_segments:
+        mark_in_sec = ad["markInMillis"] / 1000.0
+        if mark_in_sec == 0:
+            prev_input_slice_end = mark_in_sec
+            entries.append((ad["filepath"], None, None))
+        elif mark_in_sec < 0:
+            outro = True
+            outrofile = ad["filepath"]
+        elif prev_input_slice_end < mark_in_sec:
+            entries.append((orig_file, prev_input_slice_end, mark_in_sec))
+            entries.append((ad["filepath"], None, None))
+            prev_input_slice_end = mark_in_sec
+
+    entries.append((orig_file, prev_input_slice_end, None))
+    if outro == True:
+        entries.append((outrofile, None, None))
+
+    return entries
+
+
+# Runs a single ffmpeg concat over a list written by _write_concat_list and removes the list afterwards.
+def _run_concat_list(basename: str, entries: List[Tuple]):
+    concat_filename = f"{path_tmp}{basename}-concat-list.txt"
+    _write_concat_list(concat_filename, entries)
+
+    output_filename = f"{path_tmp}{basename}.mp3"
+    try:
+        cmd = (
+            ffmpeg.input(concat_filename, f="concat", safe=0)
+            .output(output_filename, c="copy")
+            .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
+        )
+        cmd.run(capture_stdout=True, capture_stderr=True)
+    except ffmpeg.Error as e:
+        print("Unable to stitch files"+ str(e))
+        print('stderr:', e.stderr.decode('utf8'))
+        raise e
+    finally:
+        os.remove(concat_filename)
+
+    return output_filename
+
+
+# Single invocation version of do_concat_files. The track_file is never sliced to path_tmp, the concat
+# list points at it directly with inpoint/outpoint directives:
+# file '/workspaces/Adorify/pyadorifier/ad_stitching/ivm_episode1.mp3'
+# outpoint 12.0
+# file '/workspaces/Adorify/pyadorifier/ad_stitching/tmp/Coke_tc_pb.mp3'
+# file '/workspaces/Adorify/pyadorifier/ad_stitching/ivm_episode1.mp3'
+# inpoint 12.0
+# outpoint 22.0
+# file '/workspaces/Adorify/pyadorifier/ad_stitching/tmp/kfc128_tc_pb.mp3'
+# file '/workspaces/Adorify/pyadorifier/ad_stitching/ivm_episode1.mp3'
+# inpoint 22.0
+#  ffmpeg -f concat -safe 0 -i list.txt -c copy out.mp3
+def do_concat_files_single_pass(uid: str, orig_file: str, insert_segments: List[Dict]):
+    basename = f"{uid}-{uuid.uuid4()}"
+    entries = _get_concat_entries(orig_file, insert_segments)
+    return _run_concat_list(basename, entries)
+
+
+# Compressed domain version of do_concat_files_single_pass. Cut points are rounded to the nearest MP3
+# frame (26 ms at 44100 Hz), the track and ads must share sample rate and channels (see do_transcode).
+def do_concat_files_splice(uid: str, orig_file: str, insert_segments: List[Dict]):
+    basename = f"{uid}-{uuid.uuid4()}"
+    entries = _get_concat_entries(orig_file, insert_segments)
+    ranges = mp3frames.entries_to_ranges(entries, mp3frames.get_index_cached({}, indexcache.get_index))
+    output_filename = f"{path_tmp}{basename}.mp3"
+    return rangecopy.write_ranges(output_filename, ranges)
+
+
+# Sample exact version of do_concat_files_splice, only the frames around the joins are re-encoded.
+def do_concat_files_smart(uid: str, orig_file: str, insert_segments: List[Dict]):
+    basename = f"{uid}-{uuid.uuid4()}"
+    entries = _get_concat_entries(orig_file, insert_segments)
+    output_filename = f"{path_tmp}{basename}.mp3"
+    return smartrender.render(entries, output_filename, mp3frames.get_index_cached({}, indexcache.get_index))
+
 
 def _get_file_segments(basename: str, orig_file: str, remove_segments: List[Dict]):
+    slice_cache = slicecache.get_cache()
     concat_files = []
     prev_input_slice_end = 0
     for ad in remove_segments:
@@ -184,12 +304,14 @@ def _get_file_segments(basename: str, orig_file: str, remove_segments: List[Dict
         elif prev_input_slice_end < mark_in_sec:
             output_file = f"{path_tmp}{basename}-{prev_input_slice_end}-{mark_in_sec}.mp3"
             try:
-                cmd = (
-                    ffmpeg.input(orig_file, ss=prev_input_slice_end, to=mark_in_sec)
-                    .output(output_file, c="copy", avoid_negative_ts=1)
-                    .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
-                )
-                cmd.run(capture_stdout=True, capture_stderr=True)
+                if not slice_cache.fetch(orig_file, prev_input_slice_end, mark_in_sec, output_file):
+                    cmd = (
+                        ffmpeg.input(orig_file, ss=prev_input_slice_end, to=mark_in_sec)
+                        .output(output_file, c="copy", avoid_negative_ts=1)
+                        .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
+                    )
+                    cmd.run(capture_stdout=True, capture_stderr=True)
+                    slice_cache.store_slice(orig_file, prev_input_slice_end, mark_in_sec, output_file)
                 prev_input_slice_end = mark_in_sec + duration
                 concat_files.append(output_file)
                 #concat_files.append(ad["filepath"])
@@ -201,12 +323,14 @@ def _get_file_segments(basename: str, orig_file: str, remove_segments: List[Dict
                 raise e
         
     output_file = f"{path_tmp}{basename}-{prev_input_slice_end}-end.mp3"
-    cmd = (
-        ffmpeg.input(orig_file, ss=prev_input_slice_end)
-        .output(output_file, c="copy", avoid_negative_ts=1)
-        .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
-    )
-    cmd.run()
+    if not slice_cache.fetch(orig_file, prev_input_slice_end, None, output_file):
+        cmd = (
+            ffmpeg.input(orig_file, ss=prev_input_slice_end)
+            .output(output_file, c="copy", avoid_negative_ts=1)
+            .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
+        )
+        cmd.run()
+        slice_cache.store_slice(orig_file, prev_input_slice_end, None, output_file)
     concat_files.append(output_file)
 
     return concat_files
@@ -255,6 +379,46 @@ def do_remove_ads(uid: str, orig_file: str, remove_segments: List[Dict]):
 
     return output_filename
 
+
+# Same segment layout as _get_file_segments, returned as (orig_file, start, end) entries.
+def _get_file_segment_entries(orig_file: str, remove_segments: List[Dict]):
+    entries = []
+    prev_input_slice_end = 0
+    for ad in remove_segments:
+        mark_in_sec = ad["markInMillis"] / 1000.0
+        duration = ad["duration"] / 1000.0
+        if mark_in_sec == 0:
+            prev_input_slice_end = mark_in_sec + duration
+        elif prev_input_slice_end < mark_in_sec:
+            entries.append((orig_file, prev_input_slice_end, mark_in_sec))
+            prev_input_slice_end = mark_in_sec + duration
+
+    entries.append((orig_file, prev_input_slice_end, None))
+    return entries
+
+
+# Single invocation version of do_remove_ads, the kept parts of the track are referenced with
+# inpoint/outpoint directives instead of being sliced to path_tmp first.
+def do_remove_ads_single_pass(uid: str, orig_file: str, remove_segments: List[Dict]):
+    basename = f"{uid}-{uuid.uuid4()}"
+    entries = _get_file_segment_entries(orig_file, remove_segments)
+    return _run_concat_list(basename, entries)
+
+# Compressed domain version of do_remove_ads_single_pass, see do_concat_files_splice.
+def do_remove_ads_splice(uid: str, orig_file: str, remove_segments: List[Dict]):
+    basename = f"{uid}-{uuid.uuid4()}"
+    entries = _get_file_segment_entries(orig_file, remove_segments)
+    ranges = mp3frames.entries_to_ranges(entries, mp3frames.get_index_cached({}, indexcache.get_index))
+    output_filename = f"{path_tmp}{basename}.mp3"
+    return rangecopy.write_ranges(output_filename, ranges)
+
+# Smart render version of do_remove_ads_splice, see do_concat_files_smart.
+def do_remove_ads_smart(uid: str, orig_file: str, remove_segments: List[Dict]):
+    basename = f"{uid}-{uuid.uuid4()}"
+    entries = _get_file_segment_entries(orig_file, remove_segments)
+    output_filename = f"{path_tmp}{basename}.mp3"
+    return smartrender.render(entries, output_filename, mp3frames.get_index_cached({}, indexcache.get_index))
+
 # def remove_metadata(input_filename: str, output_filename: str):
 # #ffmpeg -i in.mp3 -codec:a copy -map_metadata -1 out.mp3
 #     subprocess.check_call(
@@ -304,74 +468,22 @@ def do_transcode(input_filename: str, remove_meta: bool = False):
     if os.path.exists(input_filename):
         output_filename = append_txtToFilename(input_filename, "_tc")
         try:
-            probe = ffmpeg.probe(input_filename)
-            for stream in probe['streams']:
-                if stream['codec_type'] == 'audio':
-                    if stream['channels'] == 2 and stream['bit_rate'] == '128000' and stream['sample_rate'] == '44100' : #transcode not needed
-                        # if(remove_meta):
-                        #     output_filename = remove_metadata(input_filename,output_filename)
-                        # else:
-                        shutil.copy(input_filename,output_filename) # for future, changing copy to move can save time, but you will loose the original file
-                    else: # transcode needed
-                        if(remove_meta):
-                            print(f"tanscoding & REMOVING META {input_filename}")
-                            subprocess.check_call(
-                                args=[
-                                    "ffmpeg",
-                                    "-y",
-                                    "-hide_banner",
-                                    "-nostats",
-                                    "-loglevel",
-                                    "panic",
-                                    "-i",
-                                    input_filename,
-                                    "temp.wav",
-                                ]
-                            )
-                            subprocess.check_call(
-                                args=[
-                                    "ffmpeg",
-                                    "-y",
-                                    "-hide_banner",
-                                    "-nostats",
-                                    "-loglevel",
-                                    "panic",
-                                    "-i",
-                                    "temp.wav",
-                                    "-ar",
-                                    "44100",
-                                    "-ac",
-                                    "2",
-                                    "-b:a", 
-                                    "128k",
-                                    output_filename,
-                                ]
-                            )
-                            os.remove("temp.wav")
-                        else:
-                            print(f"tanscoding only {input_filename}")
-                            subprocess.check_call(
-                                args=[
-                                    "ffmpeg",
-                                    "-y",
-                                    "-hide_banner",
-                                    "-nostats",
-                                    "-loglevel",
-                                    "panic",
-                                    "-i",
-                                    input_filename,
-                                    "-ar",
-                                    "44100",
-                                    "-ac",
-                                    "2",
-                                    "-b:a", 
-                                    "128k",
-                                    output_filename,
-                                ]
-                            )
-                return output_filename 
-        except ffmpeg.Error as e:
-            logger.error("ffmpeg.probe do_transcode : {}".format(e.stderr))   
+            probe = probecache.probe(input_filename)
+            if probe.channels == 2 and probe.bit_rate == 128000 and probe.sample_rate == 44100 : #transcode not needed
+                # if(remove_meta):
+                #     output_filename = remove_metadata(input_filename,output_filename)
+                # else:
+                shutil.copy(input_filename,output_filename) # for future, changing copy to move can save time, but you will loose the original file
+            else: # transcode needed
+                if(remove_meta):
+                    print(f"tanscoding & REMOVING META {input_filename}")
+                else:
+                    print(f"tanscoding only {input_filename}")
+                # single pass, -map_metadata -1 drops the tags the old temp.wav round trip used to lose
+                subprocess.check_call(args=adstore.transcode_args(input_filename, output_filename, remove_meta))
+            return output_filename 
+        except probecache.ProbeError as e:
+            logging.error("probe do_transcode : {}".format(e))
     else:
         logger.error("File Does not exist : {}".format(input_filename))
 
@@ -381,37 +493,130 @@ def get_StitchedDuration(objectDictionary: dict):
     if not os.path.exists(track_file): 
         print(f"Track segment {track_file} does not exist")
         return 0
-    total_duration = GetAudioLength(track_file)
-    print(f"Duration of {track_file} = {total_duration} Secs")
     ad_segments = objectDictionary['ad_segments']
     for ad in ad_segments:
         if not os.path.exists(ad["filepath"]): 
             print(f"Ad segment {ad['filepath']} does not exist")
             return 0
-        duration = GetAudioLength(ad["filepath"])
+    # durations come from the mp3 headers, ffprobe only runs for files without usable headers
+    durations = probecache.estimate_durations([track_file] + [ad["filepath"] for ad in ad_segments])
+    total_duration = durations[0]
+    print(f"Duration of {track_file} = {total_duration} Secs")
+    for ad, duration in zip(ad_segments, durations[1:]):
         total_duration += duration
         print(f"Duration of {ad['filepath']} = {duration} Secs")
     return total_duration
 
 
-def stitch_ads(_uid: str, objectDictionary:  dict):
+# Stitched output that is shorter/longer than track + ads by more than this is logged (the "missing one
+# second" seen after stitching, see tmp1_withnotes.json)
+DRIFT_TOLERANCE_SEC = 0.5
+
+
+# Compares the duration of the stitched file with the sum of its inputs. Both sides are computed from
+# the mp3 headers, which is cheap enough to run after every stitch.
+# Returns (estimated duration, stitched duration, drift) in seconds.
+def check_stitched_duration(objectDictionary: dict, concatenated_file: str):
+    estimated_duration = get_StitchedDuration(objectDictionary)
+    stitched_duration = probecache.estimate_duration(concatenated_file)
+    drift = stitched_duration - estimated_duration
+    if abs(drift) > DRIFT_TOLERANCE_SEC:
+        logging.warning(
+            f"Stitched duration drift of {drift:.3f} Secs for {concatenated_file}: "
+            f"estimated {estimated_duration:.3f} Secs, stitched {stitched_duration:.3f} Secs"
+        )
+    return estimated_duration, stitched_duration, drift
+
+
+# Returns a copy of the ad segments pointing at the normalized (stereo/44.1k/128k CBR) version of every
+# ad in the adstore. Each ad is transcoded once per content, later jobs only link the stored file into
+# path_tmp, so another process evicting it from the adstore does not pull it from under the job.
+# The caller removes the links.
+def get_normalized_segments(ad_segments: List[Dict]):
+    normalized = []
+    try:
+        for ad in ad_segments:
+            normalized.append(dict(ad, filepath=adstore.get_normalized_link(ad["filepath"], path_tmp)))
+    except Exception:
+        remove_files([ad["filepath"] for ad in normalized])
+        raise
+    return normalized
+
+
+def remove_files(filenames: List[str]):
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+# The ad segments a stitch job actually inserts, shared by stitch_ads and stream_ads so a job cuts at the
+# same points however it is run. With "snapToleranceMillis": 500 every markInMillis moves to the quietest
+# point of the track within 500 ms, so the cut does not land in the middle of a word (see envelope.py).
+# Ads are taken from the adstore unless the job sets "normalizeAds": false.
+# Returns (ad segments, files of the job the caller removes once the stitch is done).
+def prepare_ad_segments(objectDictionary: dict):
+    ad_segments = objectDictionary['ad_segments']
+    snap_tolerance_millis = objectDictionary.get('snapToleranceMillis', 0)
+    if snap_tolerance_millis:
+        ad_segments = envelope.snap_segments(objectDictionary['track_file'], ad_segments, snap_tolerance_millis)
+    if objectDictionary.get('normalizeAds', True):
+        ad_segments = get_normalized_segments(ad_segments)
+        return ad_segments, [ad["filepath"] for ad in ad_segments]
+    return ad_segments, []
+
+
+# The stitch mode is taken from the optional "mode" key of the job, e.g. "mode": "slice"
+# falls back to the legacy slice-then-concat path so both can be compared on the same input.
+# The ads are prepared by prepare_ad_segments.
+# Returns (stitched file, (estimated duration, stitched duration, drift)), the durations being the
+# check_stitched_duration of the ads actually inserted, or (None, None) when ffmpeg failed.
+def stitch_ads_checked(_uid: str, objectDictionary:  dict):
     #objectDictionary = json.loads(inputJson)
     track_file = objectDictionary['track_file']
     #Step 2 Concatenate all files
-    ad_segments = objectDictionary['ad_segments']
+    ad_segments, job_files = prepare_ad_segments(objectDictionary)
+    mode = objectDictionary.get('mode', DEFAULT_STITCH_MODE)
     try:
-        concatenated_file = do_concat_files(_uid, track_file, ad_segments)
-        return concatenated_file
+        if mode == STITCH_MODE_SLICE:
+            concatenated_file = do_concat_files(_uid, track_file, ad_segments)
+        elif mode == STITCH_MODE_INPOINT:
+            concatenated_file = do_concat_files_single_pass(_uid, track_file, ad_segments)
+        elif mode == STITCH_MODE_SPLICE:
+            concatenated_file = do_concat_files_splice(_uid, track_file, ad_segments)
+        elif mode == STITCH_MODE_SMART:
+            concatenated_file = do_concat_files_smart(_uid, track_file, ad_segments)
+        else:
+            raise ValueError(f"Unknown stitch mode {mode}")
+        durations = check_stitched_duration(dict(objectDictionary, ad_segments=ad_segments), concatenated_file)
+        return concatenated_file, durations
     except subprocess.CalledProcessError as e:
         print("Unable to stitch files"+ str(e))
+        return None, None
+    finally:
+        remove_files(job_files)
+
+
+def stitch_ads(_uid: str, objectDictionary:  dict):
+    concatenated_file, _ = stitch_ads_checked(_uid, objectDictionary)
+    return concatenated_file
 
 def remove_ads(_uid: str, objectDictionary:  dict):
     #objectDictionary = json.loads(inputJson)
     track_file = objectDictionary['track_file']
     #Step 2 Concatenate all files
     ad_segments = objectDictionary['ad_segments']
+    mode = objectDictionary.get('mode', DEFAULT_STITCH_MODE)
     try:
-        concatenated_file = do_remove_ads(_uid, track_file, ad_segments)
+        if mode == STITCH_MODE_SLICE:
+            concatenated_file = do_remove_ads(_uid, track_file, ad_segments)
+        elif mode == STITCH_MODE_INPOINT:
+            concatenated_file = do_remove_ads_single_pass(_uid, track_file, ad_segments)
+        elif mode == STITCH_MODE_SPLICE:
+            concatenated_file = do_remove_ads_splice(_uid, track_file, ad_segments)
+        elif mode == STITCH_MODE_SMART:
+            concatenated_file = do_remove_ads_smart(_uid, track_file, ad_segments)
+        else:
+            raise ValueError(f"Unknown stitch mode {mode}")
         return concatenated_file
     except subprocess.CalledProcessError as e:
         print("Unable to stitch files"+ str(e))
@@ -419,11 +624,70 @@ def remove_ads(_uid: str, objectDictionary:  dict):
 
 
 
+# Streaming versions of stitch_ads/remove_ads (splice mode). The stitched mp3 is yielded as chunks read
+# straight from the track and ad files, nothing but links of the normalized ads is written to path_tmp
+# (removed when the generator ends or is closed) and memory use is bounded by chunk_size. A source is only indexed when the stream reaches it, so the time to the first byte depends
+# on the first segment, not on the whole episode. The generator can be returned as a WSGI body as is:
+#   def app(environ, start_response):
+#       start_response("200 OK", [("Content-Type", "audio/mpeg")])
+#       return stream_ads(job)
+# or handed to an ASGI StreamingResponse.
+def stream_ads(objectDictionary: dict, chunk_size: int = rangecopy.DEFAULT_CHUNK_SIZE):
+    ad_segments, job_files = prepare_ad_segments(objectDictionary)
+    try:
+        entries = _get_concat_entries(objectDictionary['track_file'], ad_segments)
+        ranges = mp3frames.iter_entry_ranges(entries, mp3frames.get_index_cached({}, indexcache.get_index))
+        yield from rangecopy.iter_ranges(ranges, chunk_size)
+    finally:
+        remove_files(job_files)
+
+
+def stream_remove_ads(objectDictionary: dict, chunk_size: int = rangecopy.DEFAULT_CHUNK_SIZE):
+    entries = _get_file_segment_entries(objectDictionary['track_file'], objectDictionary['ad_segments'])
+    ranges = mp3frames.iter_entry_ranges(entries, mp3frames.get_index_cached({}, indexcache.get_index))
+    return rangecopy.iter_ranges(ranges, chunk_size)
+
+
+# Writes the stitched output of a stitch.json/remove.json to stdout, nothing else is printed.
+# usage: python concat.py stitch.json --stdout > out.mp3
+def stream_to_stdout(argv):
+    with open(argv[0]) as json_data:
+        objectDictionary = json.load(json_data)
+    if objectDictionary['cmd'] == "stitch":
+        chunks = stream_ads(objectDictionary)
+    else:
+        chunks = stream_remove_ads(objectDictionary)
+    out = sys.stdout.buffer
+    for chunk in chunks:
+        out.write(chunk)
+    out.flush()
+
+
 # need to build Binaries and add to the PATH   
 # goto adorify folder and make all
 # then add the build folder path to the environment 
 # export PATH="/workspaces/Adorify/adorify/build/:$PATH"
+# Prebuilds the frame index sidecars of every mp3 below a directory, so the first stitch of an episode
+# does not pay for parsing it.
+# usage: python concat.py --build-index ./episodes [max_cache_megabytes]
+def build_indexes(argv):
+    directory = argv[1]
+    cache = indexcache.get_cache()
+    if len(argv) > 2:
+        cache = diskcache.DiskLRU(cache.directory, int(argv[2]) * 1024 * 1024)
+    start_time = datetime.utcnow().timestamp()
+    results = indexcache.build_directory(directory, cache)
+    for filename, status in results:
+        print(f"{filename}: {status}")
+    print(f"Indexed {len(results)} files in {datetime.utcnow().timestamp() - start_time} Secs, "
+          f"cache {cache.directory} holds {cache.total_bytes()} bytes")
+
+
 def main(argv):
+    if argv and argv[0] == "--build-index":
+        return build_indexes(argv)
+    if "--stdout" in argv:
+        return stream_to_stdout([arg for arg in argv if arg != "--stdout"])
     if len(argv) > 1:
         with open(sys.argv[1]) as json_data:
             objectJson = json.load(json_data)
@@ -462,8 +726,6 @@ def main(argv):
   
     cmd = objectDictionary['cmd']
     if cmd=="stitch":
-        stitched_duration = get_StitchedDuration(objectDictionary)
-        stitched_duration = 10
         track_file = objectDictionary['track_file']
         print(f"track_file =  {track_file}")
         ad_segments = objectDictionary['ad_segments']
@@ -472,22 +734,22 @@ def main(argv):
                 print(f"Ad segment {ad['filepath']} does not exist")
                 return 0
             print(f"ad_file[{i}] =  {ad['filepath']}") 
-            #copy file to temp folder and update the object
-            copied_file = shutil.copy(ad['filepath'], path_tmp)
-            ad["filepath"] = copied_file
-            print(f"ad_file[{i}] new =  {ad['filepath']}") 
+            # no copy to the temp folder, stitch_ads reads the normalized ad from the adstore
 
         print(f"ad_segments[0] filepath=  {objectDictionary['ad_segments'][0]['filepath']}")
         start_time = datetime.utcnow().timestamp()
 
-        concatenated_file = stitch_ads(_uid, objectDictionary)
+        concatenated_file, durations = stitch_ads_checked(_uid, objectDictionary)
         
         print(f"Code Execution Time {datetime.utcnow().timestamp() - start_time} Secs")
+        print(f"Slice cache {slicecache.get_cache().stats()}")
+        if concatenated_file is None:
+            return 0
 
-        #Sanity check
+        #Sanity check, stitch_ads_checked compared the output with the ads it inserted
+        stitched_duration, duration, drift = durations
         print(f"Estimated stitched duration is {stitched_duration} Secs")
-        duration = GetAudioLength(concatenated_file)
-        print(f"duration of {concatenated_file} is {duration} Secs")
+        print(f"duration of {concatenated_file} is {duration} Secs, drift {drift} Secs")
     elif cmd=="remove":
         start_time = datetime.utcnow().timestamp()
         concatenated_file = remove_ads(_uid, objectDictionary)
@@ -527,6 +789,9 @@ def main1(argv):
 
 # usage: python concat.py .\remove.json
 # usage: python concat.py .\stitch.json
+# usage: python concat.py --build-index .\episodes
+# usage: python concat.py .\stitch.json --stdout > out.mp3
+# batch runs of JSONL job files: see batch.py
 # mp4 to mp3 conversion ffmpeg -i video.mp4 -vn -sn -c:a mp3 -ab 192k audio.mp3
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,274 @@
+# Local dynamic ad insertion server.
+#
+# GET /episode/{track}?ads=Coke.mp3@5000,Geico.mp3@40000
+# serves the track with the ads inserted at the given markInMillis as a *virtual* file. The layout is a
+# manifest of (source, byte range) pieces computed with the splice-mode logic of concat.py (frame indexes
+# come from the indexcache), and every request, including Range requests, reads only the source ranges it
+# maps to. Nothing is stitched to disk, so one manifest serves any number of listeners and seeks.
+#
+# Tracks and ads are resolved inside --root, the server runs offline against local files for load tests.
+# usage: python dai_server.py --root ./episodes --port 8080
+import argparse
+import asyncio
+import hashlib
+import os
+import stat
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+
+# Imports from this repository
+import concat
+import indexcache
+import mp3frames
+from logger import get_logger
+from rangecopy import DEFAULT_CHUNK_SIZE
+from rangecopy import VirtualFile
+
+logger = get_logger(__name__)
+
+MANIFEST_CACHE_ENTRIES = 1024
+MAX_HEADER_BYTES = 16 * 1024
+READ_TIMEOUT_SEC = 30
+
+_REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+    422: "Unprocessable Entity",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str = ""):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_ads(value: str) -> List[Dict]:
+    """``Coke.mp3@5000,Geico.mp3@40000`` -> ad segments sorted by markInMillis."""
+    ad_segments = []
+    for item in filter(None, value.split(",")):
+        filepath, sep, mark = item.rpartition("@")
+        if not sep or not filepath:
+            raise HttpError(400, f"Invalid ad {item}, expected name@markInMillis")
+        try:
+            ad_segments.append({"markInMillis": int(mark), "filepath": filepath})
+        except ValueError:
+            raise HttpError(400, f"Invalid markInMillis in {item}")
+    return sorted(ad_segments, key=lambda ad: ad["markInMillis"])
+
+
+def parse_range(value: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    (start, end exclusive) of a single ``bytes=`` range, None when the header is absent or not a single
+    byte range (the full file is served then, as RFC 7233 allows).
+    """
+    if not value or not value.startswith("bytes=") or "," in value:
+        return None
+    first, sep, last = value[6:].strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":  # suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise HttpError(416)
+            return max(size - length, 0), size
+        start = int(first)
+        end = int(last) + 1 if last else size
+    except ValueError:
+        return None
+    if start >= size or end <= start:
+        raise HttpError(416)
+    return start, min(end, size)
+
+
+class ManifestCache:
+    """LRU of VirtualFile manifests keyed by (track, ads)."""
+
+    def __init__(self, root: str, entries: int = MANIFEST_CACHE_ENTRIES):
+        self.root = os.path.realpath(root)
+        self.entries = entries
+        self._manifests: "OrderedDict[tuple, Tuple[VirtualFile, str]]" = OrderedDict()
+        # get runs on the executor threads of the event loop
+        self._lock = threading.Lock()
+
+    def resolve(self, name: str) -> Tuple[str, int, int]:
+        """(path, size, mtime_ns) of the file ``name`` inside the root."""
+        path = os.path.realpath(os.path.join(self.root, name))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise HttpError(404, f"{name} not found")
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            raise HttpError(404, f"{name} not found")
+        return path, st.st_size, st.st_mtime_ns
+
+    def _build(
+        self, track_version: Tuple[str, int, int], ad_segments: List[Dict], ad_versions: List[Tuple[str, int, int]]
+    ) -> Tuple[VirtualFile, str]:
+        ad_segments = [dict(ad, filepath=version[0]) for ad, version in zip(ad_segments, ad_versions)]
+        entries = concat._get_concat_entries(track_version[0], ad_segments)
+        try:
+            ranges = mp3frames.entries_to_ranges(entries, mp3frames.get_index_cached({}, indexcache.get_index))
+        except ValueError as e:
+            raise HttpError(422, str(e))
+        manifest = VirtualFile(ranges)
+        # the versions of the sources are part of the etag, a replaced file invalidates cached ranges
+        etag = hashlib.md5(repr((track_version, ad_versions, ranges)).encode()).hexdigest()
+        return manifest, f'"{etag}"'
+
+    def get(self, track: str, ad_segments: List[Dict]) -> Tuple[VirtualFile, str]:
+        # every request stats its sources, a track or ad replaced under the same name gets a new manifest
+        track_version = self.resolve(track)
+        ad_versions = [self.resolve(ad["filepath"]) for ad in ad_segments]
+        key = (track_version, tuple(zip(ad_versions, (ad["markInMillis"] for ad in ad_segments))))
+        with self._lock:
+            manifest = self._manifests.get(key)
+            if manifest is not None:
+                self._manifests.move_to_end(key)
+                return manifest
+        # built outside the lock, frame indexing must not block the lookups of other episodes
+        manifest = self._build(track_version, ad_segments, ad_versions)
+        with self._lock:
+            self._manifests[key] = manifest
+            while len(self._manifests) > self.entries:
+                self._manifests.popitem(last=False)
+        return manifest
+
+
+class DaiServer:
+    def __init__(self, root: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.manifests = ManifestCache(root)
+        self.chunk_size = chunk_size
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), READ_TIMEOUT_SEC)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpError(400, "Request header too large")
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            raise HttpError(400, "Invalid request line")
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        return method, target, version, headers
+
+    async def _send(self, writer: asyncio.StreamWriter, status: int, headers: Dict, body: bytes = b""):
+        lines = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def _send_error(self, writer: asyncio.StreamWriter, error: HttpError, keep_alive: bool):
+        body = str(error).encode()
+        headers = {"Content-Type": "text/plain", "Content-Length": len(body)}
+        if error.status == 416:
+            headers["Content-Range"] = "bytes */*"
+        if not keep_alive:
+            headers["Connection"] = "close"
+        await self._send(writer, error.status, headers, body)
+
+    async def _serve_episode(self, writer, method: str, target: str, headers: Dict, keep_alive: bool):
+        url = urlsplit(target)
+        if not url.path.startswith("/episode/"):
+            raise HttpError(404, "Unknown path")
+        track = unquote(url.path[len("/episode/"):])
+        query = parse_qs(url.query)
+        ad_segments = parse_ads(",".join(query.get("ads", [])))
+
+        loop = asyncio.get_running_loop()
+        # building a manifest may parse frame indexes, keep it off the event loop
+        manifest, etag = await loop.run_in_executor(None, self.manifests.get, track, ad_segments)
+
+        byte_range = None
+        if headers.get("if-range") in (None, etag):
+            byte_range = parse_range(headers.get("range"), manifest.size)
+        status = 200 if byte_range is None else 206
+        start, end = byte_range or (0, manifest.size)
+        response_headers = {
+            "Content-Type": "audio/mpeg",
+            "Accept-Ranges": "bytes",
+            "ETag": etag,
+            "Content-Length": end - start,
+        }
+        if status == 206:
+            response_headers["Content-Range"] = f"bytes {start}-{end - 1}/{manifest.size}"
+        if not keep_alive:
+            response_headers["Connection"] = "close"
+        await self._send(writer, status, response_headers)
+        if method == "HEAD":
+            return
+
+        chunks = manifest.iter_range(start, end, self.chunk_size)
+        while True:
+            # file reads run in the default executor so a slow disk does not stall other listeners
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            writer.write(chunk)
+            await writer.drain()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+                    method, target, version, headers = request
+                    connection = headers.get("connection", "").lower()
+                    keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+                    if method not in ("GET", "HEAD"):
+                        raise HttpError(405, f"{method} not allowed")
+                    await self._serve_episode(writer, method, target, headers, keep_alive)
+                except HttpError as e:
+                    await self._send_error(writer, e, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        except Exception:
+            logger.error("Unhandled error serving request", exc_info=True)
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_HEADER_BYTES)
+        logger.info("Serving dynamic ad insertion", root=self.manifests.root, host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Serve stitched episodes as virtual files")
+    parser.add_argument("--root", default=".", help="directory holding the tracks and ads")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args(argv)
+    asyncio.run(DaiServer(args.root).serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,244 @@
+# Small helpers shared by the on-disk caches of this repository (frame indexes, probes, slices, ...).
+#
+# content_key identifies a file by what is in it rather than by its path: stitched tracks and ads are
+# downloaded to a new uuid named file for every job, so a path or mtime based key would never hit.
+# Hashing a whole track on every job would cost as much as the work the caches save, so the downloader
+# keeps the key of each download with its cache entry and hands it over with set_content_key for every
+# uuid link it makes, content_key then answers without reading the file.
+# DiskLRU is a directory of cache entries trimmed to a byte budget, least recently used first. It keeps a
+# running total of the bytes it wrote and only lists the directory when that total crosses the budget (or
+# RESCAN_INTERVAL_SEC passed, the other processes sharing the directory write to it too), a put into a
+# directory of 100k entries must not stat all of them.
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows, only the in-process lock of file_lock applies
+    fcntl = None
+
+CACHE_ROOT = os.getenv("AD_STITCH_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ad_stitching"))
+
+# content_key reads the file in blocks of _READ_SIZE
+_READ_SIZE = 1024 * 1024
+
+# eviction trims a directory to this fraction of its budget, so the puts that follow do not each rescan it
+LOW_WATER_MARK = 0.9
+RESCAN_INTERVAL_SEC = 60
+
+# (realpath, size, mtime_ns) -> content key, so an unchanged file is hashed once per process
+_key_memo: Dict[Tuple[str, int, int], str] = {}
+_key_memo_lock = threading.Lock()
+# realpath -> (st_dev, st_ino, size, content key) of files whose key is known without hashing them, the
+# inode check makes sure the path still names the file the key was given for
+_KNOWN_KEY_ENTRIES = 65536
+_known_keys: "OrderedDict[str, Tuple[int, int, int, str]]" = OrderedDict()
+
+
+def set_content_key(filename: str, key: str):
+    """Record ``key`` as the content key of ``filename``, which must not be modified afterwards."""
+    st = os.stat(filename)
+    realpath = os.path.realpath(filename)
+    with _key_memo_lock:
+        _known_keys[realpath] = (st.st_dev, st.st_ino, st.st_size, key)
+        _known_keys.move_to_end(realpath)
+        while len(_known_keys) > _KNOWN_KEY_ENTRIES:
+            _known_keys.popitem(last=False)
+
+
+def content_key(filename: str) -> str:
+    """
+    Cache key of a file's content.
+
+    The key is a blake2b digest of the size and the whole content of the file, two files that differ
+    anywhere get different keys. Identical files map to the same key wherever they live. The digest is
+    memoized per (path, size, mtime) so repeated lookups of an unchanged file do not read it again, and
+    files registered with set_content_key are not read at all.
+    """
+    st = os.stat(filename)
+    realpath = os.path.realpath(filename)
+    memo_key = (realpath, st.st_size, st.st_mtime_ns)
+    with _key_memo_lock:
+        known = _known_keys.get(realpath)
+        if known is not None and known[:3] == (st.st_dev, st.st_ino, st.st_size):
+            return known[3]
+        key = _key_memo.get(memo_key)
+    if key is not None:
+        return key
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(st.st_size.to_bytes(8, "little"))
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(_READ_SIZE), b""):
+            digest.update(block)
+    key = digest.hexdigest()
+
+    with _key_memo_lock:
+        _key_memo[memo_key] = key
+    return key
+
+
+def link_or_copy(src: str, dst: str):
+    """Hard-link ``src`` to ``dst``, copying it when a link is not possible."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        # different filesystem, or links not supported
+        shutil.copyfile(src, dst)
+
+
+def disk_usage(st: os.stat_result) -> int:
+    """Bytes a file takes on disk, a 100 byte file still takes a whole filesystem block."""
+    blocks = getattr(st, "st_blocks", None)
+    if blocks is None:  # Windows
+        return st.st_size
+    return blocks * 512
+
+
+class DiskLRU:
+    """
+    Directory of cache files kept under ``max_bytes`` of disk usage.
+
+    Recency is tracked with the file mtime, which ``get`` refreshes, so it survives restarts and is
+    shared by every process using the same directory. Entries are written to a temporary name and
+    renamed into place, readers never see a partial file.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # disk usage of the directory as of the last scan plus what put added since, None before the first scan
+        self._total: Optional[int] = None
+        self._scanned_at = 0.0
+        self._total_lock = threading.Lock()
+
+    def path_for(self, key: str, suffix: str = "") -> str:
+        return os.path.join(self.directory, f"{key}{suffix}")
+
+    def get(self, key: str, suffix: str = "") -> Optional[str]:
+        """Path of the entry, or None on a miss. A hit marks the entry as recently used."""
+        path = self.path_for(key, suffix)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key: str, suffix: str, write: Callable[[str], None]) -> str:
+        """
+        Create an entry by calling ``write(tmp_path)`` and renaming the result into place.
+
+        :return: path of the entry
+        """
+        path = self.path_for(key, suffix)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            write(tmp_path)
+            added = disk_usage(os.stat(tmp_path))
+            try:
+                added -= disk_usage(os.stat(path))
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._total_lock:
+            if self._total is not None:
+                self._total += added
+            if (
+                self._total is None
+                or self._total > self.max_bytes
+                or time.monotonic() - self._scanned_at > RESCAN_INTERVAL_SEC
+            ):
+                self._evict()
+        return path
+
+    def remove(self, key: str, suffix: str = ""):
+        path = self.path_for(key, suffix)
+        try:
+            removed = disk_usage(os.stat(path))
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._total_lock:
+            if self._total is not None:
+                self._total -= removed
+
+    def total_bytes(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".tmp") or not entry.is_file():
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.path, disk_usage(st), st.st_mtime_ns))
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used entries until the directory fits in ``max_bytes``, down to
+        LOW_WATER_MARK of it when it did not.
+        """
+        with self._total_lock:
+            self._evict()
+
+    def _evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            target = self.max_bytes * LOW_WATER_MARK
+            for path, size, _ in sorted(entries, key=lambda e: e[2]):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= target:
+                    break
+        self._total = total
+        self._scanned_at = time.monotonic()
+
+
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_lock = threading.Lock()
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Exclusive lock shared by the threads of this process and, through flock on ``path``, by every
+    process using the same file. Used to make sure a cache entry is built once when many jobs ask
+    for it at the same time.
+    """
+    with _thread_locks_lock:
+        thread_lock = _thread_locks.setdefault(path, threading.Lock())
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,613 @@
+# Downloads of the track and ad files of stitch jobs.
+#
+# Every source of a job is fetched concurrently on one long lived pool whose threads keep a keep-alive
+# session per host. Finished downloads are kept in a local cache keyed by the URL without its query string
+# (signed URLs change on every request, the object does not): an entry is served as is until the expiry
+# given by the server's cache headers, then revalidated with If-None-Match so an unchanged file costs a 304.
+# Callers get their own hard link of the cached file and keep deleting it when they are done.
+#
+# Files larger than RANGE_PART_SIZE are fetched as parallel Range requests written with pwrite into a
+# preallocated file. A part that fails resumes from its last written byte, and servers without range
+# support fall back to a single stream.
+#
+# DownloadProgress tells readers how much of a file in flight is readable, so a consumer can work on the
+# start of a track (see stitcher._concat_files_pipelined) while the rest is still downloading.
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from datetime import datetime
+from datetime import timedelta
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+from urllib.parse import urlsplit
+
+# Third Party Imports
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+# Imports from this repository
+from diskcache import CACHE_ROOT
+from diskcache import DiskLRU
+from diskcache import content_key
+from diskcache import file_lock
+from diskcache import link_or_copy
+from diskcache import set_content_key
+from utils.http import file_ext_from_content_type_header
+from utils.http import get_etag_from_header
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_WORKERS = 8
+TIMEOUT = 10
+DEFAULT_CACHE_MAX_BYTES = int(os.getenv("AD_STITCH_DOWNLOAD_CACHE_BYTES", 8 * 1024 * 1024 * 1024))
+META_SUFFIX = ".json"
+
+# large files are split into parts of this size, fetched over up to RANGE_WORKERS connections
+RANGE_PART_SIZE = 16 * 1024 * 1024
+RANGE_WORKERS = 8
+RANGE_RETRIES = 3
+
+SOURCE_NETWORK = "network"
+SOURCE_CACHE = "cache"
+SOURCE_REVALIDATED = "revalidated"
+
+# Downloads run on one long lived pool, so its threads and their keep-alive sessions survive across jobs
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="download")
+# parts run on their own pool, a download waiting for its parts must not hold a slot they need
+_range_executor = ThreadPoolExecutor(max_workers=RANGE_WORKERS, thread_name_prefix="download-range")
+_local = threading.local()
+
+
+class DownloadStats(NamedTuple):
+    url: str
+    bytes: int
+    seconds: float
+    source: str = SOURCE_NETWORK
+
+    @property
+    def mbps(self) -> float:
+        return self.bytes * 8 / 1e6 / self.seconds if self.seconds else 0.0
+
+
+def get_session(url: str) -> requests.Session:
+    """
+    Keep-alive session for the host of ``url``.
+
+    Sessions are per thread (requests.Session is not thread safe) and per host, so every worker thread
+    reuses one pooled connection per storage host instead of opening a new one for each file.
+    """
+    sessions = getattr(_local, "sessions", None)
+    if sessions is None:
+        sessions = _local.sessions = {}
+    host = urlsplit(url).netloc
+    session = sessions.get(host)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        sessions[host] = session
+    return session
+
+
+class DownloadCancelled(Exception):
+    """The reader of a download no longer needs it, see DownloadProgress.cancel."""
+
+
+class DownloadProgress:
+    """
+    Readable part of a file that is being downloaded.
+
+    Parts of the file are written sequentially from their start offset, the readable part is the contiguous
+    prefix they form. Readers block in ``wait`` until the bytes they need arrived, the download fails or
+    completes. ``cancel`` stops the writers at their next chunk.
+    """
+
+    def __init__(self):
+        self.filename: Optional[str] = None
+        self._parts: Dict[int, int] = {}
+        self._readable = 0
+        self._complete = False
+        self._cancelled = False
+        self._error: Optional[BaseException] = None
+        self._cond = threading.Condition()
+
+    def cancel(self):
+        """Abort the download unless it is complete, the writers raise DownloadCancelled."""
+        with self._cond:
+            self._cancelled = True
+
+    def start(self, filename: str):
+        with self._cond:
+            self.filename = filename
+            self._cond.notify_all()
+
+    def advance(self, part_start: int, offset: int):
+        """The part starting at ``part_start`` is written up to ``offset``."""
+        with self._cond:
+            if self._cancelled:
+                raise DownloadCancelled(f"Download of {self.filename} cancelled")
+            self._parts[part_start] = offset
+            readable = 0
+            while self._parts.get(readable, readable) > readable:
+                readable = self._parts[readable]
+            if readable > self._readable:
+                self._readable = readable
+                self._cond.notify_all()
+
+    def finish(self, size: int):
+        with self._cond:
+            self._readable = size
+            self._complete = True
+            self._cond.notify_all()
+
+    def fail(self, error: BaseException):
+        with self._cond:
+            self._error = error
+            self._cond.notify_all()
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError(f"Download of {self.filename} failed") from self._error
+
+    def wait_started(self) -> str:
+        """Local filename of the download, once it is known."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.filename is not None or self._error is not None)
+            self._check()
+            return self.filename
+
+    def wait(self, offset: int) -> Tuple[int, bool]:
+        """
+        Block until the first ``offset`` bytes are readable or the download is complete.
+
+        :return: (readable bytes, download complete)
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._readable >= offset or self._complete or self._error is not None)
+            self._check()
+            return self._readable, self._complete
+
+
+class RangeError(requests.exceptions.RequestException):
+    """The server answered a part request with something else than the requested range."""
+
+
+def _readinto(resp: requests.Response, view: memoryview) -> int:
+    try:
+        return resp.raw.readinto(view)
+    except urllib3.exceptions.HTTPError as e:
+        # raw reads raise the urllib3 errors that iter_content would have wrapped
+        raise requests.exceptions.ChunkedEncodingError(e)
+
+
+def _write_body(resp: requests.Response, fd, progress: DownloadProgress) -> int:
+    written = 0
+    if resp.headers.get("Content-Encoding", "identity") == "identity":
+        # read straight into one preallocated buffer, no per chunk bytes objects
+        buffer = bytearray(DOWNLOAD_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            n = _readinto(resp, view)
+            if not n:
+                break
+            fd.write(view[:n])
+            written += n
+            # readers of the progress read the file, not this buffer
+            fd.flush()
+            progress.advance(0, written)
+    else:
+        for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+            fd.write(chunk)
+            written += len(chunk)
+            fd.flush()
+            progress.advance(0, written)
+    return written
+
+
+def _ext_from_headers(headers) -> str:
+    # 'audio/mpeg' will be identified as mp2. Correct it to mp3
+    ext = file_ext_from_content_type_header(headers.get("Content-Type", None))
+    if not ext or ext == ".mp2":
+        ext = ".mp3"
+    return ext
+
+
+def _new_local_filename(ext: str) -> str:
+    return f"/tmp/{str(uuid.uuid4())}{ext}"
+
+
+def _write_file(resp: requests.Response, filename: str, progress: DownloadProgress) -> int:
+    try:
+        with open(filename, "wb") as fd:
+            progress.start(filename)
+            return _write_body(resp, fd, progress)
+    except Exception:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+
+
+def _content_range(headers) -> Optional[Tuple[int, int, int]]:
+    """(first, last, total) of a ``Content-Range: bytes first-last/total`` header."""
+    match = re.match(r"bytes (\d+)-(\d+)/(\d+)", headers.get("Content-Range", ""))
+    if match is None:
+        return None
+    first, last, total = (int(value) for value in match.groups())
+    return first, last, total
+
+
+def _pwrite_chunks(resp: requests.Response, fd: int, offset: int, end: int) -> Iterator[int]:
+    """Write the body of ``resp`` at ``offset`` of ``fd``, up to ``end``, yielding the offset reached."""
+    buffer = bytearray(DOWNLOAD_CHUNK_SIZE)
+    view = memoryview(buffer)
+    while offset < end:
+        n = _readinto(resp, view[:min(len(view), end - offset)])
+        if not n:
+            break
+        written = 0
+        while written < n:
+            written += os.pwrite(fd, view[written:n], offset + written)
+        offset += n
+        yield offset
+
+
+def _fetch_range(
+    url: str,
+    fd: int,
+    start: int,
+    end: int,
+    validator: str,
+    progress: DownloadProgress,
+    resp: requests.Response = None,
+):
+    """
+    Write bytes ``start:end`` of ``url`` at the same offsets of ``fd``.
+
+    A broken connection is resumed from the last written byte, up to RANGE_RETRIES times. ``If-Range``
+    makes the server send the whole file instead of a part when it changed since the first request,
+    which fails the download instead of mixing two versions.
+
+    :param resp: response already streaming ``start:end``, requested when None
+    """
+    part_start = start
+    attempt = 0
+    while True:
+        try:
+            if resp is None:
+                headers = {"Range": f"bytes={start}-{end - 1}"}
+                if validator:
+                    headers["If-Range"] = validator
+                resp = get_session(url).get(url, stream=True, timeout=TIMEOUT, headers=headers)
+            with resp:
+                resp.raise_for_status()
+                content_range = _content_range(resp.headers)
+                if resp.status_code != 206 or content_range is None or content_range[0] != start:
+                    raise RangeError(f"Range {start}-{end - 1} of {url} not served, the file may have changed")
+                # progress is kept per chunk so a broken connection resumes where it stopped
+                for start in _pwrite_chunks(resp, fd, start, end):
+                    progress.advance(part_start, start)
+            if start >= end:
+                return
+            raise requests.exceptions.ChunkedEncodingError(f"Connection closed at {start} of range end {end}")
+        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+            attempt += 1
+            if attempt > RANGE_RETRIES:
+                raise
+            logger.warning("Resuming range", url=urlsplit(url).path, offset=start, end=end, attempt=attempt)
+        finally:
+            resp = None
+
+
+def _preallocate(fd: int, size: int):
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):  # not available, or not supported by the filesystem
+        os.ftruncate(fd, size)
+
+
+def _download_ranged(url: str, resp: requests.Response, filename: str, progress: DownloadProgress) -> int:
+    """
+    Write the file answered by ``resp`` to ``filename``.
+
+    ``resp`` answers a request for the first RANGE_PART_SIZE bytes. When the server honoured it and the
+    file is larger, the remaining parts are requested in parallel while this thread writes the first one.
+    A server without range support answers 200 with the whole file, which is written as a single stream.
+
+    :return: size of the file
+    """
+    content_range = _content_range(resp.headers)
+    if resp.status_code != 206 or content_range is None:
+        return _write_file(resp, filename, progress)
+
+    first_end, total = content_range[1] + 1, content_range[2]
+    etag = resp.headers.get("ETag", "")
+    validator = etag if etag and not etag.startswith("W/") else resp.headers.get("Last-Modified", "")
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    progress.start(filename)
+    try:
+        _preallocate(fd, total)
+        futures = [
+            _range_executor.submit(
+                _fetch_range, url, fd, start, min(start + RANGE_PART_SIZE, total), validator, progress
+            )
+            for start in range(first_end, total, RANGE_PART_SIZE)
+        ]
+        try:
+            _fetch_range(url, fd, 0, first_end, validator, progress, resp)
+        finally:
+            # the parts write to fd, it stays open until all of them are done
+            wait(futures)
+        for future in futures:
+            future.result()
+    except Exception:
+        os.close(fd)
+        fd = None
+        os.remove(filename)
+        raise
+    finally:
+        if fd is not None:
+            os.close(fd)
+    return total
+
+
+class DownloadCache:
+    """
+    Local copies of downloaded files, keyed by URL without the query string.
+
+    Each entry is the file plus a ``.json`` sidecar holding its etag, expiry, extension and content key.
+    Both live in a DiskLRU, so the cache is shared by every worker process and trimmed to ``max_bytes``.
+    The content key is computed once per download and registered for every link handed out (see
+    diskcache.set_content_key), so the caches keyed by content do not hash the file again for every job.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.store = DiskLRU(directory, max_bytes)
+        self._lock_dir = os.path.join(directory, "locks")
+        self.counts = {SOURCE_NETWORK: 0, SOURCE_CACHE: 0, SOURCE_REVALIDATED: 0}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url: str) -> str:
+        parts = urlsplit(url)
+        return hashlib.blake2b(f"{parts.netloc}{parts.path}".encode(), digest_size=16).hexdigest()
+
+    def _read_meta(self, key: str) -> Optional[Dict]:
+        path = self.store.get(key, META_SUFFIX)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, key: str, etag: str, expiry: datetime, ext: str, file_key: str):
+        meta = {"etag": etag, "expiry": expiry.isoformat(), "ext": ext, "contentKey": file_key}
+
+        def write(tmp_path):
+            with open(tmp_path, "w") as f:
+                json.dump(meta, f)
+
+        self.store.put(key, META_SUFFIX, write)
+
+    def _link_cached(self, key: str, meta: Optional[Dict]) -> Optional[str]:
+        """Hard link of the cached file in /tmp, None when it is not cached."""
+        if meta is None:
+            return None
+        path = self.store.get(key, meta["ext"])
+        if path is None:
+            return None
+        local_filename = _new_local_filename(meta["ext"])
+        try:
+            link_or_copy(path, local_filename)
+        except FileNotFoundError:  # evicted in between
+            return None
+        if not meta.get("contentKey"):  # entry cached before the key was recorded
+            meta["contentKey"] = content_key(local_filename)
+            self._write_meta(
+                key, meta["etag"], datetime.fromisoformat(meta["expiry"]), meta["ext"], meta["contentKey"]
+            )
+        set_content_key(local_filename, meta["contentKey"])
+        return local_filename
+
+    def _count(self, source: str):
+        with self._lock:
+            self.counts[source] += 1
+
+    def fetch(self, url: str, progress: DownloadProgress = None) -> Tuple[str, str, datetime, int, str]:
+        """
+        Local copy of ``url``, from the cache when it is fresh or still valid.
+
+        Requests for the same URL, from threads or other processes, are serialized on a file lock so a
+        file that is not cached yet is downloaded once.
+
+        :param progress: reports the local file and its readable bytes while the download runs
+        :return: (local filename, etag, expiry, bytes downloaded, source)
+        """
+        progress = progress or DownloadProgress()
+        try:
+            local_filename, etag, expiry, size, source = self._fetch(url, progress)
+        except BaseException as e:
+            progress.fail(e)
+            raise
+        if progress.filename is None:
+            progress.start(local_filename)
+        progress.finish(os.path.getsize(local_filename))
+        return local_filename, etag, expiry, size, source
+
+    def _fetch(self, url: str, progress: DownloadProgress) -> Tuple[str, str, datetime, int, str]:
+        key = self.key(url)
+        meta = self._read_meta(key)
+        if meta is not None and datetime.utcnow() < datetime.fromisoformat(meta["expiry"]):
+            local_filename = self._link_cached(key, meta)
+            if local_filename is not None:
+                self._count(SOURCE_CACHE)
+                return local_filename, meta["etag"], datetime.fromisoformat(meta["expiry"]), 0, SOURCE_CACHE
+
+        with file_lock(os.path.join(self._lock_dir, f"{key}.lock")):
+            # another thread or process may have refreshed it while we waited for the lock
+            meta = self._read_meta(key)
+            local_filename = self._link_cached(key, meta)
+            if local_filename is not None and datetime.utcnow() < datetime.fromisoformat(meta["expiry"]):
+                self._count(SOURCE_CACHE)
+                return local_filename, meta["etag"], datetime.fromisoformat(meta["expiry"]), 0, SOURCE_CACHE
+
+            headers = {"Range": f"bytes=0-{RANGE_PART_SIZE - 1}"}
+            if local_filename is not None and meta["etag"]:
+                headers["If-None-Match"] = meta["etag"]
+            try:
+                resp = get_session(url).get(url, stream=True, timeout=TIMEOUT, headers=headers)
+                if resp.status_code == 416:
+                    # an empty file has no range to serve
+                    resp.close()
+                    del headers["Range"]
+                    resp = get_session(url).get(url, stream=True, timeout=TIMEOUT, headers=headers)
+                with resp:
+                    if resp.status_code == 304 and "If-None-Match" in headers:
+                        etag, expiry = get_etag_from_header(resp.headers)
+                        etag = etag or meta["etag"]
+                        self._write_meta(key, etag, expiry, meta["ext"], meta["contentKey"])
+                        self._count(SOURCE_REVALIDATED)
+                        return local_filename, etag, expiry, 0, SOURCE_REVALIDATED
+
+                    resp.raise_for_status()
+                    etag, expiry = get_etag_from_header(resp.headers)
+                    ext = _ext_from_headers(resp.headers)
+                    if local_filename is not None:
+                        os.remove(local_filename)
+                    local_filename = _new_local_filename(ext)
+                    size = _download_ranged(url, resp, local_filename, progress)
+            except Exception:
+                if local_filename is not None and os.path.exists(local_filename):
+                    os.remove(local_filename)
+                raise
+
+            if meta is not None and meta["ext"] != ext:
+                self.store.remove(key, meta["ext"])
+            # the caller's file goes into the cache as a link, a file larger than the budget is evicted
+            # right away without affecting the caller
+            self.store.put(key, ext, lambda tmp_path: link_or_copy(local_filename, tmp_path))
+            # the one read of the whole file, every later link of the entry reuses the key
+            file_key = content_key(local_filename)
+            set_content_key(local_filename, file_key)
+            self._write_meta(key, etag or "", expiry, ext, file_key)
+        self._count(SOURCE_NETWORK)
+        return local_filename, etag, expiry, size, SOURCE_NETWORK
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counts = dict(self.counts)
+        requests_count = sum(counts.values())
+        return {
+            **counts,
+            "hitRate": (counts[SOURCE_CACHE] + counts[SOURCE_REVALIDATED]) / requests_count if requests_count else 0.0,
+            "bytes": self.store.total_bytes(),
+            "maxBytes": self.store.max_bytes,
+        }
+
+
+_default_cache: Optional[DownloadCache] = None
+
+
+def get_cache() -> DownloadCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DownloadCache(os.path.join(CACHE_ROOT, "downloads"), DEFAULT_CACHE_MAX_BYTES)
+    return _default_cache
+
+
+def download_audio(
+    url: str, progress: DownloadProgress = None
+) -> Tuple[Optional[str], str, datetime, Optional[DownloadStats]]:
+    """
+    Local copy of ``url`` in a uuid named file in /tmp, which the caller owns and removes.
+
+    :param progress: see DownloadCache.fetch
+
+    :return: (local filename or None on error, etag, expiry, throughput stats)
+    """
+    etag = ""
+    expiry = datetime.utcnow() + timedelta(hours=6)
+
+    start_time = time.monotonic()
+    try:
+        local_filename, etag, expiry, size, source = get_cache().fetch(url, progress)
+        stats = DownloadStats(
+            url=urlsplit(url).path, bytes=size, seconds=time.monotonic() - start_time, source=source
+        )
+        logger.info(
+            "Downloaded",
+            url=stats.url,
+            source=stats.source,
+            bytes=stats.bytes,
+            seconds=stats.seconds,
+            mbps=stats.mbps,
+        )
+        return local_filename, etag, expiry, stats
+    except requests.exceptions.HTTPError:
+        logger.error("Http Error", url=url, exc_info=True)
+    except requests.exceptions.ConnectionError:
+        logger.error("Connection Error", url=url, exc_info=True)
+    except requests.exceptions.Timeout:
+        logger.error("Timeout Error", url=url, exc_info=True)
+    except requests.exceptions.RequestException:
+        logger.error("Unknown Error", url=url, exc_info=True)
+
+    return None, etag, expiry, None
+
+
+def download_all(urls: List[str]) -> List[str]:
+    """
+    Download all ``urls`` concurrently on the shared pool.
+
+    The latency of a job is the slowest download instead of the sum of all of them. If any download
+    fails, the files that did arrive are removed and RuntimeError is raised.
+
+    :return: local filenames, in the order of ``urls``
+    """
+    start_time = time.monotonic()
+    results = list(_executor.map(download_audio, urls))
+    local_filenames = [local_filename for local_filename, _, _, _ in results]
+    if None in local_filenames:
+        for local_filename in local_filenames:
+            if local_filename:
+                os.remove(local_filename)
+        failed = [url for url, local_filename in zip(urls, local_filenames) if local_filename is None]
+        raise RuntimeError(f"Unable to download {len(failed)} of {len(urls)} files: {failed}")
+
+    total_bytes = sum(stats.bytes for _, _, _, stats in results)
+    seconds = time.monotonic() - start_time
+    logger.info(
+        "Downloaded job sources",
+        files=len(urls),
+        bytes=total_bytes,
+        seconds=seconds,
+        mbps=total_bytes * 8 / 1e6 / seconds if seconds else 0.0,
+        cached=sum(stats.source != SOURCE_NETWORK for _, _, _, stats in results),
+    )
+    return local_filenames
+
+
+def download_in_background(url: str) -> Tuple[Future, DownloadProgress]:
+    """
+    Start downloading ``url`` on the shared pool.
+
+    :return: (future of the download_audio result, progress of the download)
+    """
+    progress = DownloadProgress()
+    return _executor.submit(download_audio, url, progress), progress
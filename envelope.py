@@ -0,0 +1,127 @@
+# RMS energy envelope of tracks, and snapping of ad marks to the quietest point near them.
+#
+# markInMillis is set by hand on a millisecond grid, so the cut often lands in the middle of a word. With
+# "snapToleranceMillis" in a stitch job every mark moves to the quietest point within the tolerance. The
+# envelope is the RMS of WINDOW_MILLIS windows of the track decoded to 8 kHz mono (a one hour track is
+# 360000 floats, 1.4 MB), computed with one reshape and kept in a DiskLRU keyed by the content of the
+# track, so later stitches of the episode snap their marks without decoding it again.
+import os
+import tempfile
+import uuid
+from typing import Dict
+from typing import List
+from typing import Optional
+
+# Third Party Imports
+import numpy as np
+
+# Imports from this repository
+import pcmengine
+from diskcache import CACHE_ROOT
+from diskcache import DiskLRU
+from diskcache import content_key
+
+SAMPLE_RATE = 8000
+WINDOW_MILLIS = 10
+# the envelope is averaged over this span before looking for the minimum, a pause between words is
+# preferred to a single quiet window inside one
+SMOOTH_MILLIS = 50
+# weight of the distance to the requested mark, between two equally quiet points the nearer one wins
+DISTANCE_PENALTY = 0.1
+DEFAULT_MAX_BYTES = int(os.getenv("AD_STITCH_ENVELOPE_CACHE_BYTES", 256 * 1024 * 1024))
+SUFFIX = f"-{SAMPLE_RATE}-{WINDOW_MILLIS}.env.npy"
+
+
+def compute_envelope(pcm: np.ndarray) -> np.ndarray:
+    """RMS of every WINDOW_MILLIS window of mono ``pcm``, a partial last window is dropped."""
+    window = SAMPLE_RATE * WINDOW_MILLIS // 1000
+    pcm = np.asarray(pcm).reshape(-1)
+    windows = pcm[:len(pcm) // window * window].astype(np.float32).reshape(-1, window)
+    return np.sqrt(np.mean(windows * windows, axis=1))
+
+
+def _decode_envelope(filename: str) -> np.ndarray:
+    pcm_file = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}-envelope{pcmengine.SUFFIX}")
+    try:
+        pcmengine.decode(filename, pcm_file, SAMPLE_RATE, 1)
+        return compute_envelope(pcmengine.open_pcm(pcm_file, 1))
+    finally:
+        os.remove(pcm_file)
+
+
+class EnvelopeCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.store = DiskLRU(directory, max_bytes)
+
+    def get(self, filename: str) -> np.ndarray:
+        """Envelope of ``filename``, computed on the first request for its content."""
+        key = content_key(filename)
+        path = self.store.get(key, SUFFIX)
+        if path is not None:
+            return np.load(path)
+        envelope = _decode_envelope(filename)
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                np.save(f, envelope)
+
+        self.store.put(key, SUFFIX, write)
+        return envelope
+
+
+_default_cache: Optional[EnvelopeCache] = None
+
+
+def get_cache() -> EnvelopeCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = EnvelopeCache(os.path.join(CACHE_ROOT, "envelopes"), DEFAULT_MAX_BYTES)
+    return _default_cache
+
+
+def snap_mark(envelope: np.ndarray, mark_millis: int, tolerance_millis: int) -> int:
+    """The quietest point of ``envelope`` within ``tolerance_millis`` of ``mark_millis``, in millis."""
+    if mark_millis <= 0 or tolerance_millis <= 0 or not len(envelope):
+        return mark_millis
+    center = mark_millis // WINDOW_MILLIS
+    radius = tolerance_millis // WINDOW_MILLIS
+    if radius == 0:  # the tolerance does not reach another window
+        return mark_millis
+    smooth = max(SMOOTH_MILLIS // WINDOW_MILLIS, 1)
+    lo = max(center - radius, 0)
+    hi = min(center + radius + 1, len(envelope))
+    if lo >= hi:  # the mark is past the end of the track
+        return mark_millis
+    # moving average of ``smooth`` windows centered on each candidate
+    pad = smooth // 2
+    padded = envelope[max(lo - pad, 0):min(hi + pad, len(envelope))].astype(np.float64)
+    sums = np.concatenate([[0.0], np.cumsum(padded)])
+    first = lo - max(lo - pad, 0)
+    starts = np.clip(np.arange(hi - lo) + first - pad, 0, len(padded))
+    ends = np.clip(np.arange(hi - lo) + first + pad + 1, 0, len(padded))
+    smoothed = (sums[ends] - sums[starts]) / (ends - starts)
+    distance = np.abs(np.arange(lo, hi) - center) / max(radius, 1)
+    best = lo + int(np.argmin(smoothed * (1 + DISTANCE_PENALTY * distance)))
+    if best == center:  # nothing nearby is quieter than the window of the mark
+        return mark_millis
+    # the middle of the quietest window
+    return best * WINDOW_MILLIS + WINDOW_MILLIS // 2
+
+
+def snap_segments(
+    track_file: str, ad_segments: List[Dict], tolerance_millis: int, cache: Optional[EnvelopeCache] = None
+) -> List[Dict]:
+    """
+    Copies of ``ad_segments`` with every markInMillis snapped to the quietest point of ``track_file`` within
+    ``tolerance_millis``. Marks stay in the order of the job, a mark at 0 (pre-roll) is not moved.
+    """
+    if tolerance_millis <= 0:
+        return ad_segments
+    envelope = (cache or get_cache()).get(track_file)
+    snapped = []
+    previous = 0
+    for ad in ad_segments:
+        mark = max(snap_mark(envelope, ad["markInMillis"], tolerance_millis), previous)
+        snapped.append(dict(ad, markInMillis=mark))
+        previous = mark
+    return snapped
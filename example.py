@@ -1,6 +1,5 @@
 #https://github.com/Adori/Backend/blob/master/src/services/transcoding/__init__.py
 # Standard Library Imports
-import json
 import os
 import subprocess
 import uuid
@@ -9,6 +8,8 @@ import uuid
 from pydantic import ValidationError
 
 # Imports from this repository
+from probecache import ProbeError
+from probecache import probe
 from utils.logger import get_logger
 
 # Imports from this module
@@ -43,36 +44,9 @@ def _get_transcoded_file(input_audio_file):
 
 
 def _get_sample_rate(input_filename):
-    _dir = "/tmp/adori/keyword-spotter/"
-    os.makedirs(_dir, exist_ok=True)
-    result = subprocess.run(
-        args=[
-            "ffprobe",
-            "-hide_banner",
-            "-v",
-            "quiet",
-            "-i",
-            input_filename,
-            "-print_format",
-            "json",
-            "-show_format",
-            "-show_streams",
-        ],
-        stdout=subprocess.PIPE,
-    )
     try:
-        sample_rate = 0
-        if result.returncode == 0:
-            obj = json.loads(result.stdout)
-            if isinstance(obj, dict):
-                if "streams" in obj:
-                    stream = obj["streams"][0]
-                    sample_rate = int(stream["sample_rate"])
-        else:
-            logger.error(
-                "FFProbe : Non-zero return code {}".format(result.returncode), return_code=result.returncode,
-            )
-    except json.JSONDecodeError:
+        sample_rate = probe(input_filename).sample_rate
+    except ProbeError:
         logger.error("Exception in Extracting Sample Rate", filname=input_filename, exc_info=True)
         sample_rate = 0
 
@@ -106,35 +80,11 @@ def get_sample_rate(input_filename: str = None):
 
 
 def _get_format_info(input_filename) -> ProbeData:
-    _dir = "/tmp/adori/keyword-spotter/"
-    os.makedirs(_dir, exist_ok=True)
-    result = subprocess.run(
-        args=[
-            "ffprobe",
-            "-hide_banner",
-            "-v",
-            "quiet",
-            "-i",
-            input_filename,
-            "-print_format",
-            "json",
-            "-show_format",
-            "-show_streams",
-        ],
-        stdout=subprocess.PIPE,
-    )
-
     try:
-        if result.returncode == 0:
-            obj = json.loads(result.stdout)
-            probe_data: ProbeData = ProbeData(**obj)
-            return probe_data
-        else:
-            logger.error("FFProbe : Non-zero return code {} ".format(result.returncode))
-    except json.JSONDecodeError:
-        logger.error(
-            "Exception in json decoding ffmpeg info", filename=input_filename, exc_info=True,
-        )
+        probe_data: ProbeData = ProbeData(**probe(input_filename).data)
+        return probe_data
+    except ProbeError:
+        logger.error("FFProbe : Unable to probe {} ".format(input_filename), exc_info=True)
     except ValidationError:
         logger.error(
             "Exception in de-serializing json into media format", filename=input_filename, exc_info=True,
@@ -0,0 +1,292 @@
+# Persistent landmark hash index of the whole ad library.
+#
+# addetect correlates the track with every ad, so scanning a catalog costs episodes x ads correlations. The
+# index turns it into one pass of lookups per episode: the spectrogram peaks of every ad are paired into
+# landmarks (f1, f2, dt), each hashed to 24 bits and stored with the ad id and the frame of its anchor. An
+# episode is hashed the same way, every hash is looked up, and each match votes for (ad, episode frame -
+# ad frame). An ad that plays in the episode collects many votes on one offset, chance matches scatter.
+#
+# On disk the index is a directory of segments, each three .npy arrays (hashes sorted, ad ids, offsets)
+# loaded with mmap_mode="r" and searched with np.searchsorted, plus manifest.json naming the ads and the
+# segments. Adding ads writes a new segment and replaces the manifest atomically, readers keep their maps
+# of the old segments. compact() merges the segments into one.
+#
+# usage: python fpindex.py add ./ad-index Geico.mp3 Coke.mp3 kfc.mp3
+#        python fpindex.py scan ./ad-index ivm_episode1.mp3 > remove.json
+#        python fpindex.py compact ./ad-index
+import argparse
+import json
+import os
+import sys
+import uuid
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+# Third Party Imports
+import numpy as np
+
+# Imports from this repository
+import addetect
+from addetect import Detection
+from diskcache import CACHE_ROOT
+from diskcache import content_key
+from diskcache import file_lock
+from probecache import estimate_duration
+
+DEFAULT_INDEX_DIR = os.getenv("AD_STITCH_FP_INDEX_DIR", os.path.join(CACHE_ROOT, "fpindex"))
+MANIFEST = "manifest.json"
+RELOAD_ATTEMPTS = 3
+
+# spectrogram peaks: local maxima within +-PEAK_TIME_RADIUS frames and +-PEAK_FREQ_RADIUS bins that stand
+# PEAK_MIN_LOG above the mean log power of their frame
+PEAK_TIME_RADIUS = 3
+PEAK_FREQ_RADIUS = 4
+PEAK_MIN_LOG = 2.0
+# each anchor peak is paired with the next FAN_OUT peaks that are 1..MAX_DT frames later and at most
+# MAX_DF bins apart
+FAN_OUT = 5
+MAX_DT = 63
+MAX_DF = 96
+# hashes matching more than this many entries (silence, hum) say nothing about which ad plays
+MAX_BUCKET = 1000
+# an ad is reported when MIN_VOTES of its landmarks, and MIN_SCORE of all of them, agree on one offset
+MIN_VOTES = 12
+MIN_SCORE = 0.02
+
+
+def spectrogram_peaks(pcm: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(frames, bins) of the spectrogram peaks of mono 8 kHz ``pcm``, ordered by frame then bin."""
+    frames = addetect.frame_view(pcm)
+    peak_frames, peak_bins = [], []
+    r = PEAK_TIME_RADIUS
+    for start in range(0, len(frames), addetect.FFT_BLOCK_FRAMES):
+        end = min(start + addetect.FFT_BLOCK_FRAMES, len(frames))
+        # a block is read with the frames around it, a peak at its edge compares with both sides
+        lo, hi = max(start - r, 0), min(end + r, len(frames))
+        log_power = np.log(addetect.power_spectrum(frames[lo:hi]) + 1e-3)
+        local_max = log_power.copy()
+        for axis, radius in ((0, PEAK_TIME_RADIUS), (1, PEAK_FREQ_RADIUS)):
+            spread = local_max.copy()
+            for shift in range(1, radius + 1):
+                a = [slice(None)] * 2
+                b = [slice(None)] * 2
+                a[axis], b[axis] = slice(shift, None), slice(None, -shift)
+                np.maximum(spread[tuple(a)], local_max[tuple(b)], out=spread[tuple(a)])
+                np.maximum(spread[tuple(b)], local_max[tuple(a)], out=spread[tuple(b)])
+            local_max = spread
+        loud = log_power > log_power.mean(axis=1, keepdims=True) + PEAK_MIN_LOG
+        t, f = np.nonzero((log_power == local_max) & loud)
+        t += lo
+        inside = (t >= start) & (t < end)
+        peak_frames.append(t[inside])
+        peak_bins.append(f[inside])
+    if not peak_frames:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(peak_frames), np.concatenate(peak_bins)
+
+
+def landmarks(pcm: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(hashes uint32, anchor frames uint32) of the landmarks of mono 8 kHz ``pcm``."""
+    t, f = spectrogram_peaks(pcm)
+    hashes, anchors = [], []
+    for j in range(1, FAN_OUT + 1):
+        t1, f1, t2, f2 = t[:-j], f[:-j], t[j:], f[j:]
+        dt = t2 - t1
+        valid = (dt >= 1) & (dt <= MAX_DT) & (np.abs(f2 - f1) <= MAX_DF)
+        hashes.append((f1[valid] << 15) | (f2[valid] << 6) | dt[valid])
+        anchors.append(t1[valid])
+    return np.concatenate(hashes).astype(np.uint32), np.concatenate(anchors).astype(np.uint32)
+
+
+class FingerprintIndex:
+    """Landmark hash index stored in ``directory``."""
+
+    def __init__(self, directory: str = DEFAULT_INDEX_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock_path = os.path.join(directory, "index.lock")
+        self.reload()
+
+    def reload(self):
+        for attempt in range(RELOAD_ATTEMPTS):
+            manifest = self._read_manifest()
+            try:
+                segments = [self._open_segment(name) for name in manifest["segments"]]
+                break
+            except FileNotFoundError:
+                # a compact replaced the manifest and removed its segments after it was read, the manifest
+                # on disk now names the merged segment
+                if attempt == RELOAD_ATTEMPTS - 1:
+                    raise
+        self.ads: List[Dict] = manifest["ads"]
+        self.segments = segments
+
+    def _read_manifest(self) -> Dict:
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"ads": [], "segments": []}
+
+    def _write_manifest(self, manifest: Dict):
+        path = os.path.join(self.directory, MANIFEST)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+
+    def _segment_path(self, name: str, array: str) -> str:
+        return os.path.join(self.directory, f"{name}.{array}.npy")
+
+    def _open_segment(self, name: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return tuple(np.load(self._segment_path(name, array), mmap_mode="r") for array in ("hashes", "ads", "offsets"))
+
+    def _write_segment(self, hashes: np.ndarray, ad_ids: np.ndarray, offsets: np.ndarray) -> str:
+        name = f"segment-{uuid.uuid4().hex}"
+        order = np.argsort(hashes, kind="stable")
+        for array, values in (("hashes", hashes), ("ads", ad_ids), ("offsets", offsets)):
+            np.save(self._segment_path(name, array), values[order])
+        return name
+
+    def _remove_segment(self, name: str):
+        for array in ("hashes", "ads", "offsets"):
+            os.remove(self._segment_path(name, array))
+
+    def add(self, filenames: List[str]) -> int:
+        """Index the ads of ``filenames`` that are not in the index yet, returns how many were added."""
+        with file_lock(self._lock_path):
+            manifest = self._read_manifest()
+            known = {ad["key"] for ad in manifest["ads"]}
+            hashes, ad_ids, offsets = [], [], []
+            for filename in filenames:
+                key = content_key(filename)
+                if key in known:
+                    continue
+                known.add(key)
+                pcm = addetect._decode_mono(filename)
+                ad_hashes, ad_offsets = landmarks(pcm)
+                ad_id = len(manifest["ads"])
+                manifest["ads"].append(
+                    {
+                        "id": ad_id,
+                        "name": os.path.basename(filename),
+                        "path": os.path.abspath(filename),
+                        "key": key,
+                        "durationMillis": int(round(estimate_duration(filename) * 1000)),
+                        "frames": len(addetect.frame_view(pcm)),
+                        "hashes": len(ad_hashes),
+                    }
+                )
+                hashes.append(ad_hashes)
+                ad_ids.append(np.full(len(ad_hashes), ad_id, dtype=np.uint32))
+                offsets.append(ad_offsets)
+            if not hashes:
+                return 0
+            manifest["segments"].append(
+                self._write_segment(np.concatenate(hashes), np.concatenate(ad_ids), np.concatenate(offsets))
+            )
+            self._write_manifest(manifest)
+        self.reload()
+        return len(hashes)
+
+    def compact(self):
+        """Merge all segments into one, lookups then take one search per hash."""
+        with file_lock(self._lock_path):
+            manifest = self._read_manifest()
+            if len(manifest["segments"]) < 2:
+                return
+            old = manifest["segments"]
+            arrays = [self._open_segment(name) for name in old]
+            manifest["segments"] = [self._write_segment(*(np.concatenate(a) for a in zip(*arrays)))]
+            self._write_manifest(manifest)
+            del arrays
+            for name in old:
+                self._remove_segment(name)
+        self.reload()
+
+    def votes(self, hashes: np.ndarray, frames: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(ad ids, offsets, votes) of every (ad, episode frame - ad frame) pair the landmarks match."""
+        all_ads, all_deltas = [], []
+        for index_hashes, index_ads, index_offsets in self.segments:
+            left = np.searchsorted(index_hashes, hashes, side="left")
+            right = np.searchsorted(index_hashes, hashes, side="right")
+            counts = right - left
+            counts[counts > MAX_BUCKET] = 0
+            total = int(counts.sum())
+            if not total:
+                continue
+            # positions of all matches: left of each hash plus 0..count-1
+            starts = np.repeat(left - (np.cumsum(counts) - counts), counts)
+            matches = starts + np.arange(total)
+            all_ads.append(np.asarray(index_ads[matches], dtype=np.int64))
+            all_deltas.append(np.repeat(frames.astype(np.int64), counts) - index_offsets[matches])
+        if not all_ads:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        ads, deltas = np.concatenate(all_ads), np.concatenate(all_deltas)
+        keys, counts = np.unique((ads << 32) + (deltas + (1 << 31)), return_counts=True)
+        # the frame grids of the ad and the episode rarely line up, count the neighbouring offsets too
+        votes = counts.copy()
+        for neighbour in (keys - 1, keys + 1):
+            position = np.clip(np.searchsorted(keys, neighbour), 0, len(keys) - 1)
+            votes += np.where(keys[position] == neighbour, counts[position], 0)
+        return keys >> 32, (keys & 0xFFFFFFFF) - (1 << 31), votes
+
+    def detect(self, pcm: np.ndarray) -> List[Detection]:
+        """Ads of the index found in mono 8 kHz ``pcm``."""
+        hashes, frames = landmarks(pcm)
+        ad_ids, deltas, votes = self.votes(hashes, frames)
+        ad_hashes = np.array([ad["hashes"] for ad in self.ads], dtype=np.int64)
+        enough = (votes >= MIN_VOTES) & (votes >= MIN_SCORE * ad_hashes[ad_ids])
+        ad_ids, deltas, votes = ad_ids[enough], deltas[enough], votes[enough]
+        # grouped by ad, most votes first within each ad
+        order = np.lexsort((-votes, ad_ids))
+        ad_ids, deltas, votes = ad_ids[order], deltas[order], votes[order]
+        bounds = np.flatnonzero(np.diff(ad_ids)) + 1
+        detections = []
+        for start, end in zip(np.concatenate(([0], bounds)), np.concatenate((bounds, [len(ad_ids)]))):
+            if start == end:
+                continue
+            ad_id = int(ad_ids[start])
+            ad = self.ads[ad_id]
+            taken: List[int] = []
+            for delta, ad_votes in zip(deltas[start:end].tolist(), votes[start:end].tolist()):
+                # one occurrence per ad length, the neighbouring offsets of a match voted for it too
+                if all(abs(delta - t) >= max(ad["frames"], 1) for t in taken):
+                    taken.append(delta)
+                    score = float(ad_votes) / max(ad["hashes"], 1)
+                    # ads added before paths were recorded are named by their content key
+                    name = ad.get("path", ad["key"])
+                    detections.append(Detection(ad_id, name, max(delta, 0), ad["frames"], score))
+        return addetect.resolve_overlaps(detections)
+
+    def find_remove_segments(self, track_file: str) -> List[Dict]:
+        """Remove segments (markInMillis, duration) of the indexed ads found in ``track_file``."""
+        return [
+            detection.to_remove_segment(self.ads[detection.ad_id]["durationMillis"])
+            for detection in self.detect(addetect._decode_mono(track_file))
+        ]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Landmark hash index of the ad library")
+    parser.add_argument("command", choices=["add", "scan", "compact"])
+    parser.add_argument("index_dir")
+    parser.add_argument("files", nargs="*", help="ads to add, or the track to scan")
+    args = parser.parse_args(argv)
+
+    index = FingerprintIndex(args.index_dir)
+    if args.command == "add":
+        print(f"Added {index.add(args.files)} ads, {len(index.ads)} indexed")
+    elif args.command == "compact":
+        index.compact()
+    else:
+        for track_file in args.files:
+            ad_segments = index.find_remove_segments(track_file)
+            json.dump({"track_file": track_file, "cmd": "remove", "ad_segments": ad_segments}, sys.stdout, indent=1)
+            print()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
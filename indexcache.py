@@ -0,0 +1,135 @@
+# Persistent cache of MP3 frame indexes (see mp3frames).
+#
+# The same episode is stitched hundreds of times with different ad sets. Its frame index is written once
+# to a compact sidecar file keyed by the file content and loaded on later jobs with a single read, so
+# cut points map to byte offsets without parsing or demuxing the track again.
+#
+# Sidecar layout (little endian):
+#   header  magic "MP3X", format version, offset item size (4 or 8), channels, sample rate,
+#           samples per frame, number of offsets, duration in seconds
+#   body    the offsets array (frame starts + end of the last frame)
+import os
+import struct
+import sys
+from array import array
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+# Imports from this repository
+from diskcache import CACHE_ROOT
+from diskcache import DiskLRU
+from diskcache import content_key
+from mp3frames import Mp3FrameIndex
+from mp3frames import build_index
+
+MAGIC = b"MP3X"
+FORMAT_VERSION = 1
+SUFFIX = ".mp3x"
+_HEADER = struct.Struct("<4sBBBxIIQd")
+
+DEFAULT_MAX_BYTES = int(os.getenv("AD_STITCH_INDEX_CACHE_BYTES", 256 * 1024 * 1024))
+
+_default_cache: Optional[DiskLRU] = None
+
+
+def get_cache() -> DiskLRU:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DiskLRU(os.path.join(CACHE_ROOT, "index"), DEFAULT_MAX_BYTES)
+    return _default_cache
+
+
+def save_index(index: Mp3FrameIndex, path: str):
+    offsets = index.offsets
+    if offsets[-1] < 1 << 32 and offsets.itemsize != 4:
+        offsets = array("I", offsets)
+    elif offsets[-1] >= 1 << 32 and offsets.itemsize != 8:
+        offsets = array("Q", offsets)
+    if sys.byteorder != "little":
+        offsets = array(offsets.typecode, offsets)
+        offsets.byteswap()
+    with open(path, "wb") as f:
+        f.write(
+            _HEADER.pack(
+                MAGIC,
+                FORMAT_VERSION,
+                offsets.itemsize,
+                index.channels,
+                index.sample_rate,
+                index.samples_per_frame,
+                len(offsets),
+                index.duration,
+            )
+        )
+        offsets.tofile(f)
+
+
+def _read_header(f) -> Tuple:
+    header = f.read(_HEADER.size)
+    if len(header) != _HEADER.size:
+        raise ValueError("Truncated index file")
+    magic, version, itemsize, channels, sample_rate, samples_per_frame, count, duration = _HEADER.unpack(header)
+    if magic != MAGIC or version != FORMAT_VERSION or itemsize not in (4, 8):
+        raise ValueError("Not a frame index file")
+    return itemsize, channels, sample_rate, samples_per_frame, count, duration
+
+
+def load_index(path: str, filename: str) -> Mp3FrameIndex:
+    with open(path, "rb") as f:
+        itemsize, channels, sample_rate, samples_per_frame, count, _ = _read_header(f)
+        offsets = array("I" if itemsize == 4 else "Q")
+        offsets.fromfile(f, count)
+    if sys.byteorder != "little":
+        offsets.byteswap()
+    return Mp3FrameIndex(filename, sample_rate, samples_per_frame, channels, offsets)
+
+
+def read_duration(path: str) -> float:
+    """Duration summary of an index file, without loading the offsets."""
+    with open(path, "rb") as f:
+        return _read_header(f)[5]
+
+
+def get_index(filename: str, cache: Optional[DiskLRU] = None) -> Mp3FrameIndex:
+    """
+    Frame index of ``filename``, loaded from the cache or built and stored on a miss.
+
+    A corrupt or truncated sidecar is treated as a miss and rebuilt.
+    """
+    cache = cache or get_cache()
+    key = content_key(filename)
+    path = cache.get(key, SUFFIX)
+    if path is not None:
+        try:
+            return load_index(path, filename)
+        except (ValueError, EOFError, OSError):
+            cache.remove(key, SUFFIX)
+
+    index = build_index(filename)
+    cache.put(key, SUFFIX, lambda tmp_path: save_index(index, tmp_path))
+    return index
+
+
+def build_directory(directory: str, cache: Optional[DiskLRU] = None, ext: str = ".mp3") -> List[Tuple[str, str]]:
+    """
+    Prebuild the index of every ``ext`` file below ``directory``.
+
+    :return: list of (filename, "cached" | "built" | error message)
+    """
+    cache = cache or get_cache()
+    results = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if not name.lower().endswith(ext):
+                continue
+            filename = os.path.join(root, name)
+            try:
+                if cache.get(content_key(filename), SUFFIX) is not None:
+                    results.append((filename, "cached"))
+                else:
+                    get_index(filename, cache)
+                    results.append((filename, "built"))
+            except (ValueError, OSError) as e:
+                results.append((filename, str(e)))
+    return results
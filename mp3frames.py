@@ -0,0 +1,539 @@
+# MPEG-1/2/2.5 Layer III frame indexer and compressed-domain splicer.
+#
+# Inputs are normalized to 44100 Hz / 128k CBR by concat.do_transcode, so cutting them at frame
+# boundaries is a byte-offset problem: parse the frame headers once, keep the frame start offsets in an
+# array and answer "which byte is at t seconds" with a multiplication. Stitching then becomes copying
+# byte ranges of the track and ad files into the output, no ffmpeg process is needed.
+import mmap
+import os
+from array import array
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+# Imports from this repository
+from rangecopy import ByteRange
+
+# kbps, indexed by the 4 bit bitrate field. 0 is "free format" and 15 is invalid, both are not supported
+_BITRATES_V1_L3 = (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0)
+_BITRATES_V2_L3 = (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0)
+
+# indexed by the 2 bit version field: 0 = MPEG 2.5, 1 = reserved, 2 = MPEG 2, 3 = MPEG 1
+_SAMPLE_RATES = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+
+ID3V1_SIZE = 128
+# samples of delay added by the synthesis filterbank of every Layer III decoder
+DECODER_DELAY = 529
+
+
+class FrameHeader(NamedTuple):
+    version: int  # 3 = MPEG 1, 2 = MPEG 2, 0 = MPEG 2.5
+    bitrate: int  # bits per second
+    sample_rate: int
+    channels: int
+    protected: bool
+    frame_length: int  # bytes, including the 4 byte header
+    samples_per_frame: int
+
+    @property
+    def side_info_size(self):
+        if self.version == 3:
+            return 17 if self.channels == 1 else 32
+        return 9 if self.channels == 1 else 17
+
+    @property
+    def main_data_offset(self):
+        # header, CRC, side info: the audio data (and the bit reservoir) of the frame follows
+        return 4 + (2 if self.protected else 0) + self.side_info_size
+
+
+def parse_frame_header(data: bytes, pos: int = 0) -> Optional[FrameHeader]:
+    """
+    Parse the 4 byte Layer III frame header at ``data[pos:pos + 4]``.
+
+    :return: FrameHeader or None if the bytes are not a valid header
+    """
+    if len(data) < pos + 4:
+        return None
+    b0, b1, b2, b3 = data[pos], data[pos + 1], data[pos + 2], data[pos + 3]
+    if b0 != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = (b1 >> 3) & 0x03
+    layer = (b1 >> 1) & 0x03
+    if version == 1 or layer != 1:  # reserved version, or not Layer III
+        return None
+    bitrate_index = (b2 >> 4) & 0x0F
+    sample_rate_index = (b2 >> 2) & 0x03
+    if sample_rate_index == 3:
+        return None
+    kbps = (_BITRATES_V1_L3 if version == 3 else _BITRATES_V2_L3)[bitrate_index]
+    if kbps == 0:
+        return None
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    padding = (b2 >> 1) & 0x01
+    samples_per_frame = 1152 if version == 3 else 576
+    frame_length = (samples_per_frame // 8) * kbps * 1000 // sample_rate + padding
+    channels = 1 if (b3 >> 6) == 3 else 2
+    return FrameHeader(
+        version=version,
+        bitrate=kbps * 1000,
+        sample_rate=sample_rate,
+        channels=channels,
+        protected=(b1 & 0x01) == 0,
+        frame_length=frame_length,
+        samples_per_frame=samples_per_frame,
+    )
+
+
+def id3v2_size(data: bytes) -> int:
+    """Size in bytes of the ID3v2 tag at the start of ``data`` (0 if there is none)."""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = ((data[6] & 0x7F) << 21) | ((data[7] & 0x7F) << 14) | ((data[8] & 0x7F) << 7) | (data[9] & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def is_info_frame(data: bytes, pos: int, header: FrameHeader) -> bool:
+    """
+    True if the frame at ``pos`` is a Xing/Info or VBRI header frame.
+
+    These frames carry no audio. They describe the whole file, so they must not be copied into the
+    middle of a stitched output.
+    """
+    xing_pos = pos + 4 + header.side_info_size
+    for tag_pos in (xing_pos, xing_pos + 2):
+        if data[tag_pos:tag_pos + 4] in (b"Xing", b"Info"):
+            return True
+    return data[pos + 36:pos + 40] == b"VBRI"
+
+
+def read_info_frame_count(data: bytes, pos: int, header: FrameHeader) -> Optional[int]:
+    """Number of audio frames stored in the Xing/Info or VBRI frame at ``pos``, None if absent."""
+    xing_pos = pos + 4 + header.side_info_size
+    for tag_pos in (xing_pos, xing_pos + 2):
+        if data[tag_pos:tag_pos + 4] in (b"Xing", b"Info"):
+            flags = int.from_bytes(data[tag_pos + 4:tag_pos + 8], "big")
+            if flags & 0x01 and len(data) >= tag_pos + 12:
+                return int.from_bytes(data[tag_pos + 8:tag_pos + 12], "big")
+            return None
+    if data[pos + 36:pos + 40] == b"VBRI" and len(data) >= pos + 54:
+        return int.from_bytes(data[pos + 50:pos + 54], "big")
+    return None
+
+
+def main_data_begin(data: bytes, pos: int, header: FrameHeader) -> int:
+    """
+    Bit reservoir back pointer of the frame at ``pos``: how many bytes of its audio data are stored in
+    the frames before it. A frame with 0 decodes without its predecessors, a splice can start there.
+    """
+    side_info = pos + 4 + (2 if header.protected else 0)
+    if header.version == 3:
+        return (data[side_info] << 1) | (data[side_info + 1] >> 7)
+    return data[side_info]
+
+
+def read_gapless_info(data: bytes, pos: int, header: FrameHeader) -> Optional[Tuple[int, int]]:
+    """
+    (encoder delay, padding) in samples from the LAME tag of the Xing/Info frame at ``pos``, None if the
+    frame has no LAME tag. Decoders add another 529 samples of delay (DECODER_DELAY).
+    """
+    xing_pos = pos + 4 + header.side_info_size
+    for tag_pos in (xing_pos, xing_pos + 2):
+        if data[tag_pos:tag_pos + 4] in (b"Xing", b"Info"):
+            break
+    else:
+        return None
+    flags = int.from_bytes(data[tag_pos + 4:tag_pos + 8], "big")
+    lame_pos = tag_pos + 8
+    for flag, size in ((0x01, 4), (0x02, 4), (0x04, 100), (0x08, 4)):
+        if flags & flag:
+            lame_pos += size
+    # 9 bytes of encoder version ("LAME3.100", "Lavc58.91" ...) then 12 bytes of fields before the delays
+    if len(data) < lame_pos + 24 or not data[lame_pos:lame_pos + 4].isalpha():
+        return None
+    b0, b1, b2 = data[lame_pos + 21], data[lame_pos + 22], data[lame_pos + 23]
+    return (b0 << 4) | (b1 >> 4), ((b1 & 0x0F) << 8) | b2
+
+
+class Mp3FrameIndex:
+    """
+    Byte offsets of every audio frame of an MP3 file.
+
+    ``offsets`` holds the start of each frame plus the end of the last frame, so frame ``i`` is
+    ``offsets[i]:offsets[i + 1]``. All frames share the sample rate and samples per frame of the
+    first one, frame ``i`` therefore starts at ``i * samples_per_frame / sample_rate`` seconds and
+    the timestamps do not need to be stored.
+    """
+
+    __slots__ = ("filename", "sample_rate", "samples_per_frame", "channels", "offsets")
+
+    def __init__(self, filename: str, sample_rate: int, samples_per_frame: int, channels: int, offsets: array):
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+        self.channels = channels
+        self.offsets = offsets
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def frame_duration(self) -> float:
+        return self.samples_per_frame / self.sample_rate
+
+    @property
+    def duration(self) -> float:
+        return self.frame_count * self.frame_duration
+
+    @property
+    def audio_start(self) -> int:
+        return self.offsets[0]
+
+    @property
+    def audio_end(self) -> int:
+        return self.offsets[-1]
+
+    def frame_at(self, seconds: float) -> int:
+        """Index of the frame boundary nearest to ``seconds``, clamped to the file."""
+        frame = int(round(seconds * self.sample_rate / self.samples_per_frame))
+        return min(max(frame, 0), self.frame_count)
+
+    def timestamp(self, frame: int) -> float:
+        return frame * self.samples_per_frame / self.sample_rate
+
+    def byte_range(self, start_sec: Optional[float] = None, end_sec: Optional[float] = None) -> Tuple[int, int]:
+        """
+        (offset, length) of the frames between ``start_sec`` and ``end_sec``, ``None`` meaning
+        the start/end of the audio. Both times are rounded to the nearest frame boundary.
+        """
+        first = self.frame_at(start_sec) if start_sec else 0
+        last = self.frame_at(end_sec) if end_sec is not None else self.frame_count
+        if last < first:
+            last = first
+        return self.offsets[first], self.offsets[last] - self.offsets[first]
+
+
+def _find_sync(data, pos: int, end: int) -> int:
+    # next position where a frame header is followed by another valid header
+    while True:
+        pos = data.find(b"\xff", pos, end)
+        if pos < 0 or pos + 4 > end:
+            return -1
+        header = parse_frame_header(data, pos)
+        if header is not None:
+            next_pos = pos + header.frame_length
+            if next_pos == end or parse_frame_header(data, next_pos) is not None:
+                return pos
+        pos += 1
+
+
+def index_frames(data, filename: str = "") -> Mp3FrameIndex:
+    """
+    Build the frame index of the MP3 held in ``data`` (bytes or mmap).
+
+    The ID3v2 tag, the Xing/Info/VBRI frame and trailing ID3v1/APE tags are left out of the index.
+    Garbage between frames is skipped by resyncing on the next pair of valid headers.
+    """
+    end = len(data)
+    if end >= ID3V1_SIZE and data[end - ID3V1_SIZE:end - ID3V1_SIZE + 3] == b"TAG":
+        end -= ID3V1_SIZE
+
+    pos = _find_sync(data, id3v2_size(data[:10]), end)
+    if pos < 0:
+        raise ValueError(f"No MPEG audio frames found in {filename}")
+
+    first = parse_frame_header(data, pos)
+    if is_info_frame(data, pos, first):
+        pos += first.frame_length
+
+    offsets = array("Q")
+    audio_end = pos
+    while pos < end:
+        header = parse_frame_header(data, pos)
+        if header is None or header.sample_rate != first.sample_rate:
+            pos = _find_sync(data, pos + 1, end)
+            if pos < 0:
+                break
+            continue
+        if pos + header.frame_length > end:  # truncated last frame
+            break
+        offsets.append(pos)
+        pos += header.frame_length
+        audio_end = pos
+    if not offsets:
+        raise ValueError(f"No MPEG audio frames found in {filename}")
+    offsets.append(audio_end)
+
+    return Mp3FrameIndex(filename, first.sample_rate, first.samples_per_frame, first.channels, offsets)
+
+
+def build_index(filename: str) -> Mp3FrameIndex:
+    """Read ``filename`` once and return its frame index."""
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f"Empty audio file {filename}")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return index_frames(data, filename)
+
+
+# ProgressiveFrameIndex reads a growing file as soon as _PROGRESSIVE_MIN_READ new bytes arrived, at most
+# _PROGRESSIVE_MAX_READ at a time. A resync candidate is only trusted _SYNC_MARGIN bytes before the end of
+# the bytes read, where the header of the frame after it (at most 1441 bytes further) is readable too
+_SYNC_MARGIN = 4096
+_PROGRESSIVE_MIN_READ = 2 * _SYNC_MARGIN
+_PROGRESSIVE_MAX_READ = 1024 * 1024
+
+
+class ProgressiveFrameIndex(Mp3FrameIndex):
+    """
+    Frame index of an MP3 file that is still being written, e.g. downloaded.
+
+    ``wait(offset)`` blocks until the first ``offset`` bytes of the file are written, or the file is
+    complete, and returns (bytes written, complete). Frames are indexed as their bytes arrive and
+    ``byte_range`` only blocks until the frames it needs are indexed, so a splice can copy the start of
+    the file while its end is still arriving. Once complete, the offsets are the ones index_frames builds.
+    """
+
+    __slots__ = ("_wait", "_fd", "_pos", "_synced", "_done")
+
+    def __init__(self, filename: str, wait: Callable[[int], Tuple[int, bool]]):
+        super().__init__(filename, 0, 0, 0, array("Q"))
+        self._wait = wait
+        self._fd = os.open(filename, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        self._synced = False
+        self._done = False
+        try:
+            available, _ = wait(10)
+            self._pos = id3v2_size(os.pread(self._fd, min(available, 10), 0))
+            self._extend(1)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if getattr(self, "_fd", None) is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+    def _extend(self, frames: Optional[int]):
+        """Index until ``frames`` frames are known (all of them when None) or the file ends."""
+        while not self._done and (frames is None or self.frame_count < frames):
+            available, complete = self._wait(self._pos + _PROGRESSIVE_MIN_READ)
+            end = available
+            if complete and end >= ID3V1_SIZE and os.pread(self._fd, 3, end - ID3V1_SIZE) == b"TAG":
+                end -= ID3V1_SIZE
+            size = min(end - self._pos, _PROGRESSIVE_MAX_READ)
+            data = os.pread(self._fd, size, self._pos) if size > 0 else b""
+            last = complete and self._pos + len(data) >= end
+            self._pos += self._scan(data, last)
+            if last:
+                self._done = True
+                self.close()
+        if self._done and self.frame_count < 1:
+            raise ValueError(f"No MPEG audio frames found in {self.filename}")
+
+    def _add_frame(self, pos: int, frame_length: int):
+        # the end of the last frame is replaced by the start of the new one, like index_frames does
+        if self.offsets:
+            self.offsets[-1] = pos
+        else:
+            self.offsets.append(pos)
+        self.offsets.append(pos + frame_length)
+
+    def _scan(self, data: bytes, last: bool) -> int:
+        """Index the frames in ``data``, which starts at ``self._pos``. Returns the bytes consumed."""
+        end = len(data)
+        pos = 0
+        while pos < end:
+            if not self._synced:
+                sync = _find_sync(data, pos, end)
+                if not last and (sync < 0 or sync > end - _SYNC_MARGIN):
+                    return max(pos, end - _SYNC_MARGIN)
+                if sync < 0:
+                    return end
+                pos = sync
+                self._synced = True
+                if not self.sample_rate:
+                    first = parse_frame_header(data, pos)
+                    self.sample_rate = first.sample_rate
+                    self.samples_per_frame = first.samples_per_frame
+                    self.channels = first.channels
+                    if is_info_frame(data, pos, first):
+                        pos += first.frame_length
+                continue
+            if pos + 4 > end and not last:
+                return pos
+            header = parse_frame_header(data, pos)
+            if header is None or header.sample_rate != self.sample_rate:
+                self._synced = False
+                pos += 1
+                continue
+            if pos + header.frame_length > end:
+                # wait for the rest of the frame, a truncated last frame is left out
+                return pos if not last else end
+            self._add_frame(self._pos + pos, header.frame_length)
+            pos += header.frame_length
+        return pos
+
+    def complete(self) -> "ProgressiveFrameIndex":
+        """Index the whole file, blocking until it is written."""
+        self._extend(None)
+        return self
+
+    def byte_range(self, start_sec: Optional[float] = None, end_sec: Optional[float] = None) -> Tuple[int, int]:
+        if end_sec is None:
+            self._extend(None)
+        else:
+            self._extend(int(round(max(start_sec or 0, end_sec) * self.sample_rate / self.samples_per_frame)))
+        return super().byte_range(start_sec, end_sec)
+
+
+# header_duration reads _HEADER_PROBE_SIZE at the start of the file, and _CBR_SAMPLE_SIZE at
+# _CBR_SAMPLE_POINTS evenly spaced positions to check that the bitrate is constant
+_HEADER_PROBE_SIZE = 16 * 1024
+_CBR_SAMPLE_POINTS = 8
+_CBR_SAMPLE_SIZE = 4 * 1024
+_CBR_CHECK_FRAMES = 4
+
+
+def _same_bitrate_frames(data: bytes, pos: int, bitrate: int, count: int) -> bool:
+    for _ in range(count):
+        header = parse_frame_header(data, pos)
+        if header is None:
+            return pos >= len(data) - 4  # ran out of probe data, not out of sync
+        if header.bitrate != bitrate:
+            return False
+        pos += header.frame_length
+    return True
+
+
+def header_duration(filename: str) -> Optional[float]:
+    """
+    Duration computed from a few KB of headers, without decoding or indexing the file.
+
+    The Xing/Info or VBRI frame count is used when present. Otherwise the file is assumed to be CBR
+    if the first frames and short runs of frames spread over the file all have the same bitrate, and
+    the duration follows from the audio byte size. A stitch of CBR sources with different bitrates
+    can only be told apart from CBR if one of the runs lands in the odd source.
+
+    :return: seconds, or None when the headers do not allow an exact answer (e.g. VBR without a
+        Xing header), in which case the caller should fall back to ffprobe
+    """
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        audio_start = id3v2_size(f.read(10))
+        f.seek(audio_start)
+        data = f.read(_HEADER_PROBE_SIZE)
+        audio_end = size
+        if size >= ID3V1_SIZE:
+            f.seek(size - ID3V1_SIZE)
+            if f.read(3) == b"TAG":
+                audio_end -= ID3V1_SIZE
+
+        pos = _find_sync(data, 0, len(data))
+        if pos < 0:
+            return None
+        first = parse_frame_header(data, pos)
+        frames = read_info_frame_count(data, pos, first)
+        if frames is not None:
+            return frames * first.samples_per_frame / first.sample_rate
+        if is_info_frame(data, pos, first):
+            # Info frame without a frame count, the audio starts after it
+            pos += first.frame_length
+            first = parse_frame_header(data, pos)
+            if first is None:
+                return None
+
+        if not _same_bitrate_frames(data, pos, first.bitrate, _CBR_CHECK_FRAMES):
+            return None
+        step = (audio_end - audio_start) // (_CBR_SAMPLE_POINTS + 1)
+        for i in range(1, _CBR_SAMPLE_POINTS + 1):
+            sample_pos = audio_start + i * step
+            if sample_pos < audio_start + len(data):
+                continue
+            f.seek(sample_pos)
+            sample = f.read(_CBR_SAMPLE_SIZE)
+            frame_pos = _find_sync(sample, 0, len(sample))
+            if frame_pos < 0 or not _same_bitrate_frames(sample, frame_pos, first.bitrate, _CBR_CHECK_FRAMES):
+                return None
+
+    return (audio_end - audio_start - pos) * 8 / first.bitrate
+
+
+def read_file_gapless_info(filename: str) -> Optional[Tuple[int, int]]:
+    """read_gapless_info of the Xing/Info frame at the start of ``filename``, None if it has none."""
+    with open(filename, "rb") as f:
+        head = f.read(10)
+        f.seek(id3v2_size(head))
+        data = f.read(_HEADER_PROBE_SIZE)
+    pos = _find_sync(data, 0, len(data))
+    if pos < 0:
+        return None
+    header = parse_frame_header(data, pos)
+    if not is_info_frame(data, pos, header):
+        return None
+    return read_gapless_info(data, pos, header)
+
+
+def iter_entry_ranges(entries: Iterable[Tuple], get_index: Callable[[str], Mp3FrameIndex]) -> Iterator[ByteRange]:
+    """
+    Translate concat list entries (filename, inpoint, outpoint) into byte ranges, lazily: the index of
+    a source is only looked up when its entry is reached, so a consumer can start on the first range
+    before the later sources are indexed.
+
+    All sources must share the sample rate and channel count of the first one, a stream with a
+    different format spliced in the middle would not decode correctly.
+
+    :param entries: entries as built by concat._get_concat_entries
+    :param get_index: returns the Mp3FrameIndex of a filename
+    :return: iterator of (filename, offset, length)
+    """
+    reference = None
+    for filename, inpoint, outpoint in entries:
+        index = get_index(filename)
+        if reference is None:
+            reference = index
+        elif (index.sample_rate, index.channels) != (reference.sample_rate, reference.channels):
+            raise ValueError(
+                f"{filename} is {index.sample_rate} Hz/{index.channels} ch, "
+                f"{reference.filename} is {reference.sample_rate} Hz/{reference.channels} ch. Transcode first"
+            )
+        offset, length = index.byte_range(inpoint, outpoint)
+        if length:
+            yield filename, offset, length
+
+
+def entries_to_ranges(entries: List[Tuple], get_index: Callable[[str], Mp3FrameIndex]) -> List[ByteRange]:
+    """List version of iter_entry_ranges."""
+    return list(iter_entry_ranges(entries, get_index))
+
+
+def get_index_cached(
+    cache: Dict[str, Mp3FrameIndex], build: Callable[[str], Mp3FrameIndex] = build_index
+) -> Callable[[str], Mp3FrameIndex]:
+    """
+    get_index for entries_to_ranges that gets every index once per job.
+
+    :param build: returns the index of a filename, e.g. indexcache.get_index to use the persistent cache
+    """
+
+    def get_index(filename: str) -> Mp3FrameIndex:
+        if filename not in cache:
+            cache[filename] = build(filename)
+        return cache[filename]
+
+    return get_index
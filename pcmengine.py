@@ -0,0 +1,202 @@
+# In-process PCM stitch engine for the re-encoding path.
+#
+# The filter_complex stitch decodes the track and every ad in a new ffmpeg graph per job, so an ad running
+# in a million episodes is decoded a million times. Here the decoded PCM of each ad is kept in a DiskLRU of
+# raw s16le files, keyed by the content of the ad, and memory mapped by every job that inserts it. The
+# track is decoded once per job into a memory mapped temporary file. The output timeline is a list of
+# NumPy views of these maps (slicing copies nothing), gain and fades at the joins are array operations on
+# the few samples they touch, and the timeline is streamed to a single encoder process.
+#
+# Everything is decoded to the adori audio standard (see adstore.NORMALIZATION), so the track and the
+# ads always share sample rate and channels.
+import os
+import subprocess
+import uuid
+from typing import Dict
+from typing import List
+from typing import Optional
+
+# Third Party Imports
+import numpy as np
+
+# Imports from this repository
+from adstore import NORMALIZATION
+from diskcache import CACHE_ROOT
+from diskcache import DiskLRU
+from diskcache import content_key
+from diskcache import file_lock
+
+DEFAULT_MAX_BYTES = int(os.getenv("AD_STITCH_PCM_CACHE_BYTES", 8 * 1024 * 1024 * 1024))
+SUFFIX = ".raw"
+
+SAMPLE_RATE = NORMALIZATION["ar"]
+CHANNELS = NORMALIZATION["ac"]
+BITRATE = NORMALIZATION["b:a"]
+DTYPE = np.int16
+# samples written to the encoder at a time
+STREAM_CHUNK_SAMPLES = 64 * 1024
+
+
+def decode(source: str, output_filename: str, sample_rate: int = SAMPLE_RATE, channels: int = CHANNELS):
+    """Decode ``source`` to interleaved s16le PCM in ``output_filename``."""
+    args = ["ffmpeg", "-y", "-hide_banner", "-nostats", "-loglevel", "panic", "-i", source]
+    args += ["-vn", "-ar", str(sample_rate), "-ac", str(channels), "-acodec", "pcm_s16le", "-f", "s16le"]
+    args += [output_filename]
+    subprocess.check_call(args=args)
+
+
+def open_pcm(filename: str, channels: int = CHANNELS) -> np.ndarray:
+    """Read-only (samples, channels) map of the raw PCM file ``filename``."""
+    if os.path.getsize(filename) == 0:  # mmap can not map an empty file
+        return np.zeros((0, channels), dtype=DTYPE)
+    return np.memmap(filename, dtype=DTYPE, mode="r").reshape(-1, channels)
+
+
+class PcmStore:
+    """DiskLRU of decoded ads, one raw PCM file per ad content."""
+
+    def __init__(self, directory: str, max_bytes: int, sample_rate: int = SAMPLE_RATE, channels: int = CHANNELS):
+        self.store = DiskLRU(directory, max_bytes)
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._lock_dir = os.path.join(directory, "locks")
+
+    def key(self, source: str) -> str:
+        return f"{content_key(source)}-{self.sample_rate}-{self.channels}"
+
+    def get_pcm_file(self, source: str) -> str:
+        """
+        Path of the decoded PCM of ``source``, decoding it on the first request.
+
+        The returned file belongs to the store, callers must not modify or delete it.
+        """
+        key = self.key(source)
+        path = self.store.get(key, SUFFIX)
+        if path is not None:
+            return path
+        with file_lock(os.path.join(self._lock_dir, f"{key}.lock")):
+            # another thread or process may have decoded it while we waited for the lock
+            path = self.store.get(key, SUFFIX)
+            if path is None:
+                path = self.store.put(
+                    key, SUFFIX, lambda tmp_path: decode(source, tmp_path, self.sample_rate, self.channels)
+                )
+        return path
+
+    def load(self, source: str) -> np.ndarray:
+        # an evicted file stays readable through the map, the inode lives until the map is closed
+        return open_pcm(self.get_pcm_file(source), self.channels)
+
+
+_default_store: Optional[PcmStore] = None
+
+
+def get_store() -> PcmStore:
+    global _default_store
+    if _default_store is None:
+        _default_store = PcmStore(os.path.join(CACHE_ROOT, "pcm"), DEFAULT_MAX_BYTES)
+    return _default_store
+
+
+def build_timeline(
+    track: np.ndarray, ads: List[np.ndarray], marks: List[int], ad_gain_db: float = 0.0
+) -> List[np.ndarray]:
+    """
+    The stitched output as a list of arrays, in the segment layout of stitcher._get_concat_entries.
+
+    :param track: PCM of the track
+    :param ads: PCM of each ad
+    :param marks: sample of the track each ad is inserted at, ascending
+    :param ad_gain_db: gain applied to the ads
+    """
+    gain = 10 ** (ad_gain_db / 20.0)
+    pieces = []
+    prev_input_slice_end = 0
+    for ad, mark in zip(ads, marks):
+        mark = min(mark, len(track))
+        if prev_input_slice_end < mark:
+            pieces.append(track[prev_input_slice_end:mark])
+            prev_input_slice_end = mark
+        if gain != 1.0:
+            ad = np.clip(ad * gain, np.iinfo(DTYPE).min, np.iinfo(DTYPE).max).astype(DTYPE)
+        pieces.append(ad)
+    pieces.append(track[prev_input_slice_end:])
+    return [piece for piece in pieces if len(piece)]
+
+
+def apply_fades(pieces: List[np.ndarray], fade_samples: int) -> List[np.ndarray]:
+    """
+    ``pieces`` with a linear fade out at the end of each piece before a join and a fade in at the start of
+    each piece after it. Only the faded samples are copied, the rest stay views of the maps.
+    """
+    if fade_samples <= 0 or len(pieces) < 2:
+        return pieces
+    faded = []
+    last = len(pieces) - 1
+    for i, piece in enumerate(pieces):
+        n = min(fade_samples, len(piece) // 2)
+        ramp = (np.arange(1, n + 1, dtype=np.float32) / (n + 1))[:, None]
+        head, body, tail = piece[:n], piece[n:len(piece) - n], piece[len(piece) - n:]
+        if i > 0:
+            head = (head * ramp).astype(DTYPE)
+        if i < last:
+            tail = (tail * ramp[::-1]).astype(DTYPE)
+        faded += [head, body, tail]
+    return [piece for piece in faded if len(piece)]
+
+
+def encode(
+    pieces: List[np.ndarray],
+    output_filename: str,
+    sample_rate: int = SAMPLE_RATE,
+    bitrate: str = BITRATE,
+):
+    """Stream ``pieces`` to one ffmpeg process encoding ``output_filename``."""
+    channels = pieces[0].shape[1] if pieces else CHANNELS
+    args = ["ffmpeg", "-y", "-hide_banner", "-nostats", "-loglevel", "panic"]
+    args += ["-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0"]
+    args += ["-c:a", "libmp3lame", "-b:a", bitrate, "-f", "mp3", output_filename]
+    process = subprocess.Popen(args, stdin=subprocess.PIPE, bufsize=0)
+    try:
+        for piece in pieces:
+            for start in range(0, len(piece), STREAM_CHUNK_SAMPLES):
+                chunk = np.ascontiguousarray(piece[start:start + STREAM_CHUNK_SAMPLES])
+                process.stdin.write(memoryview(chunk).cast("B"))
+    except BrokenPipeError:
+        pass  # ffmpeg exited, its return code tells why
+    finally:
+        process.stdin.close()
+        return_code = process.wait()
+    if return_code:
+        raise subprocess.CalledProcessError(return_code, args)
+
+
+def stitch(
+    track_file: str,
+    insert_segments: List[Dict],
+    output_filename: str,
+    fade_ms: int = 0,
+    ad_gain_db: float = 0.0,
+    store: Optional[PcmStore] = None,
+) -> str:
+    """
+    Stitch the ads of ``insert_segments`` (markInMillis, filepath) into ``track_file`` and encode the
+    result to ``output_filename``.
+
+    :param fade_ms: length of the fades at each join, 0 for hard cuts
+    :param ad_gain_db: gain applied to the ads
+    """
+    store = store or get_store()
+    track_pcm_file = f"{os.path.splitext(output_filename)[0]}-{uuid.uuid4()}{SUFFIX}"
+    try:
+        decode(track_file, track_pcm_file, store.sample_rate, store.channels)
+        track = open_pcm(track_pcm_file, store.channels)
+        ads = [store.load(ad["filepath"]) for ad in insert_segments]
+        marks = [ad["markInMillis"] * store.sample_rate // 1000 for ad in insert_segments]
+        pieces = build_timeline(track, ads, marks, ad_gain_db)
+        pieces = apply_fades(pieces, fade_ms * store.sample_rate // 1000)
+        encode(pieces, output_filename, store.sample_rate)
+        return output_filename
+    finally:
+        if os.path.exists(track_pcm_file):
+            os.remove(track_pcm_file)
@@ -0,0 +1,197 @@
+# One ffprobe per file.
+#
+# GetAudioLength, do_transcode, the example.py helpers and the stitcher all used to run their own ffprobe,
+# so the same file was probed several times per job. probe() runs ffprobe at most once per
+# (path, size, mtime) and returns a typed ProbeResult. Results are kept in an in-memory LRU and, when the
+# disk store is enabled, in a DiskLRU keyed by file content so other processes and later jobs reuse them.
+# estimate_duration answers from the MP3 headers alone and only falls back to ffprobe when it has to.
+import json
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+# Imports from this repository
+from diskcache import CACHE_ROOT
+from diskcache import DiskLRU
+from diskcache import content_key
+from mp3frames import header_duration
+
+MEMORY_ENTRIES = 4096
+DISK_MAX_BYTES = 64 * 1024 * 1024
+SUFFIX = ".probe.json"
+
+
+class ProbeError(RuntimeError):
+    pass
+
+
+class ProbeResult(NamedTuple):
+    duration: float  # seconds, of the first audio stream (format duration if the stream has none)
+    sample_rate: int
+    channels: int
+    bit_rate: int  # bits per second
+    codec_name: str
+    data: dict  # full ffprobe -show_format -show_streams output
+
+    @classmethod
+    def from_ffprobe(cls, data: dict) -> "ProbeResult":
+        streams = data.get("streams") or []
+        audio = next((s for s in streams if s.get("codec_type") == "audio"), streams[0] if streams else {})
+        duration = audio.get("duration") or data.get("format", {}).get("duration") or 0
+        bit_rate = audio.get("bit_rate") or data.get("format", {}).get("bit_rate") or 0
+        return cls(
+            duration=float(duration),
+            sample_rate=int(audio.get("sample_rate") or 0),
+            channels=int(audio.get("channels") or 0),
+            bit_rate=int(bit_rate),
+            codec_name=audio.get("codec_name", ""),
+            data=data,
+        )
+
+
+_memory: "OrderedDict[tuple, ProbeResult]" = OrderedDict()
+_lock = threading.Lock()
+_disk_store: Optional[DiskLRU] = None
+if os.getenv("AD_STITCH_PROBE_DISK_CACHE", "1") == "1":
+    _disk_store = DiskLRU(os.path.join(CACHE_ROOT, "probe"), DISK_MAX_BYTES)
+
+
+def set_disk_store(store: Optional[DiskLRU]):
+    """Use ``store`` as the on-disk probe store, None disables it."""
+    global _disk_store
+    _disk_store = store
+
+
+def clear_memory():
+    with _lock:
+        _memory.clear()
+
+
+def _is_url(input_filename: str) -> bool:
+    return input_filename.startswith("http://") or input_filename.startswith("https://")
+
+
+def run_ffprobe(input_filename: str) -> dict:
+    result = subprocess.run(
+        args=[
+            "ffprobe",
+            "-hide_banner",
+            "-v",
+            "quiet",
+            "-i",
+            input_filename,
+            "-print_format",
+            "json",
+            "-show_format",
+            "-show_streams",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        raise ProbeError(f"FFProbe : Non-zero return code {result.returncode} for {input_filename}")
+    try:
+        obj = json.loads(result.stdout)
+    except json.JSONDecodeError:
+        raise ProbeError(f"FFProbe : Invalid json output for {input_filename}")
+    if not isinstance(obj, dict) or not obj.get("streams"):
+        raise ProbeError(f"FFProbe : No streams found in {input_filename}")
+    return obj
+
+
+def _memory_get(key) -> Optional[ProbeResult]:
+    with _lock:
+        result = _memory.get(key)
+        if result is not None:
+            _memory.move_to_end(key)
+        return result
+
+
+def _memory_put(key, result: ProbeResult):
+    with _lock:
+        _memory[key] = result
+        _memory.move_to_end(key)
+        while len(_memory) > MEMORY_ENTRIES:
+            _memory.popitem(last=False)
+
+
+def probe(input_filename: str) -> ProbeResult:
+    """
+    ffprobe ``input_filename`` (a local path or http(s) url) once and cache the result.
+
+    Local files are cached per (path, size, mtime), so a rewritten file is probed again. Urls are
+    cached per url for the lifetime of the process.
+
+    :raises ProbeError: the file is missing or ffprobe can not read it
+    """
+    if _is_url(input_filename):
+        key = (input_filename,)
+    else:
+        try:
+            st = os.stat(input_filename)
+        except FileNotFoundError:
+            raise ProbeError(f"Audio file {input_filename} does not exist")
+        key = (os.path.realpath(input_filename), st.st_size, st.st_mtime_ns)
+
+    result = _memory_get(key)
+    if result is not None:
+        return result
+
+    store = _disk_store if len(key) == 3 else None
+    data = None
+    if store is not None:
+        ckey = content_key(input_filename)
+        path = store.get(ckey, SUFFIX)
+        if path is not None:
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                store.remove(ckey, SUFFIX)
+
+    if data is None:
+        data = run_ffprobe(input_filename)
+        if store is not None:
+
+            def write(tmp_path):
+                with open(tmp_path, "w") as f:
+                    json.dump(data, f)
+
+            store.put(ckey, SUFFIX, write)
+
+    result = ProbeResult.from_ffprobe(data)
+    _memory_put(key, result)
+    return result
+
+
+def get_duration(input_filename: str) -> float:
+    """Duration in seconds, raises ProbeError when it can not be determined."""
+    duration = probe(input_filename).duration
+    if duration == 0:
+        raise ProbeError(f"Unable to determine duration for {input_filename}")
+    return duration
+
+
+def estimate_duration(input_filename: str) -> float:
+    """
+    Duration in seconds from the MP3 headers (a few KB of reads), ffprobe only when the headers
+    are not enough (VBR without Xing/VBRI header, other formats, urls).
+    """
+    if not _is_url(input_filename):
+        try:
+            duration = header_duration(input_filename)
+        except FileNotFoundError:
+            raise ProbeError(f"Audio file {input_filename} does not exist")
+        if duration:
+            return duration
+    return get_duration(input_filename)
+
+
+def estimate_durations(input_filenames: List[str], max_workers: int = 8) -> List[float]:
+    """estimate_duration of every file, in parallel. The result is in the order of ``input_filenames``."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(estimate_duration, input_filenames))
@@ -0,0 +1,210 @@
+# Builds an output file from (source path, offset, length) byte ranges without pulling the audio
+# through Python buffers.
+#
+# os.copy_file_range lets the kernel copy (or reflink) the data directly between the files. Where it is
+# not available (old kernels, copies across filesystems, macOS, Windows) os.sendfile is tried next and
+# finally mmap slices of the source are written out, which still avoids an extra user space copy per chunk.
+# iter_ranges streams the same ranges as chunks for callers that send the output instead of storing it,
+# VirtualFile maps offsets of the never materialized output back to the source ranges.
+import bisect
+import errno
+import mmap
+import os
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+ByteRange = Tuple[str, int, int]
+
+METHOD_COPY_FILE_RANGE = "copy_file_range"
+METHOD_SENDFILE = "sendfile"
+METHOD_MMAP = "mmap"
+
+# largest single syscall request, the kernel caps a single copy/sendfile call at ~2GB anyway
+_MAX_CHUNK = 1 << 30
+# errors that mean "this syscall can not do this copy", as opposed to a real I/O error
+_UNSUPPORTED_ERRNOS = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+# methods the kernel does not implement (ENOSYS) are not tried again in this process
+_unsupported = set()
+# the other errors depend on the files (e.g. EXDEV across filesystems on older kernels), the method is
+# skipped only for copies between the same pair of devices: (method, source st_dev, destination st_dev)
+_unsupported_devices = set()
+
+
+def _copy_file_range(src_fd: int, dst_fd: int, offset: int, length: int):
+    while length > 0:
+        copied = os.copy_file_range(src_fd, dst_fd, min(length, _MAX_CHUNK), offset)
+        if copied == 0:
+            raise EOFError
+        offset += copied
+        length -= copied
+
+
+def _sendfile(src_fd: int, dst_fd: int, offset: int, length: int):
+    while length > 0:
+        sent = os.sendfile(dst_fd, src_fd, offset, min(length, _MAX_CHUNK))
+        if sent == 0:
+            raise EOFError
+        offset += sent
+        length -= sent
+
+
+def _mmap_copy(src_fd: int, dst_fd: int, offset: int, length: int):
+    # mmap offsets have to be a multiple of the allocation granularity
+    aligned = offset - offset % mmap.ALLOCATIONGRANULARITY
+    if offset + length > os.fstat(src_fd).st_size:
+        raise EOFError
+    with mmap.mmap(src_fd, length + offset - aligned, access=mmap.ACCESS_READ, offset=aligned) as data:
+        view = memoryview(data)
+        try:
+            pos = offset - aligned
+            end = pos + length
+            while pos < end:
+                pos += os.write(dst_fd, view[pos:min(end, pos + _MAX_CHUNK)])
+        finally:
+            view.release()
+
+
+_METHODS = [
+    (METHOD_COPY_FILE_RANGE, _copy_file_range, hasattr(os, "copy_file_range")),
+    (METHOD_SENDFILE, _sendfile, hasattr(os, "sendfile")),
+    (METHOD_MMAP, _mmap_copy, True),
+]
+
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, length: int) -> str:
+    """
+    Append ``length`` bytes of ``src_fd`` starting at ``offset`` to ``dst_fd`` at its current position.
+
+    :return: name of the method that did the copy
+    """
+    if length == 0:
+        return METHOD_MMAP
+    dst_pos = os.lseek(dst_fd, 0, os.SEEK_CUR)
+    devices = None
+    for name, method, available in _METHODS:
+        if not available or name in _unsupported:
+            continue
+        if _unsupported_devices:
+            devices = devices or (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+            if (name,) + devices in _unsupported_devices:
+                continue
+        try:
+            method(src_fd, dst_fd, offset, length)
+            return name
+        except EOFError:
+            raise ValueError(f"Source is shorter than the requested range {offset}+{length}")
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            if e.errno == errno.ENOSYS:
+                _unsupported.add(name)
+            else:
+                devices = devices or (os.fstat(src_fd).st_dev, os.fstat(dst_fd).st_dev)
+                _unsupported_devices.add((name,) + devices)
+            # a partial copy may have moved the output position, start the range again
+            os.lseek(dst_fd, dst_pos, os.SEEK_SET)
+            os.ftruncate(dst_fd, dst_pos)
+    raise OSError(errno.ENOTSUP, "No copy method available")
+
+
+def write_ranges(output_filename: str, ranges: Iterable[ByteRange]) -> str:
+    """
+    Write the byte ranges, in order, to ``output_filename``.
+
+    Consecutive ranges of the same source share one file descriptor. ``ranges`` is consumed lazily, each
+    range is copied as soon as it is known.
+
+    :param ranges: iterable of (source path, offset, length)
+    :return: output_filename
+    """
+    dst_fd = os.open(output_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    src_name, src_fd = None, None
+    try:
+        for filename, offset, length in ranges:
+            if filename != src_name:
+                if src_fd is not None:
+                    os.close(src_fd)
+                    src_fd = None
+                src_fd = os.open(filename, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                src_name = filename
+            copy_range(src_fd, dst_fd, offset, length)
+    except Exception:
+        os.close(dst_fd)
+        dst_fd = None
+        os.remove(output_filename)
+        raise
+    finally:
+        if src_fd is not None:
+            os.close(src_fd)
+        if dst_fd is not None:
+            os.close(dst_fd)
+    return output_filename
+
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+
+def iter_ranges(ranges: Iterable[ByteRange], chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Yield the content of the byte ranges as chunks of at most ``chunk_size`` bytes.
+
+    Memory use is bounded by one chunk, and ``ranges`` is consumed lazily, so the first chunk is
+    available as soon as the first range is known.
+    """
+    src_name, src_fd = None, None
+    try:
+        for filename, offset, length in ranges:
+            if filename != src_name:
+                if src_fd is not None:
+                    os.close(src_fd)
+                    src_fd = None
+                src_fd = os.open(filename, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                src_name = filename
+            end = offset + length
+            while offset < end:
+                chunk = os.pread(src_fd, min(chunk_size, end - offset), offset)
+                if not chunk:
+                    raise ValueError(f"{filename} is shorter than the requested range")
+                offset += len(chunk)
+                yield chunk
+    finally:
+        if src_fd is not None:
+            os.close(src_fd)
+
+
+class VirtualFile:
+    """
+    A file that only exists as a manifest of byte ranges.
+
+    ``starts[i]`` is the offset of piece ``i`` in the virtual file, so any (start, end) request is
+    answered by reading only the pieces it overlaps.
+    """
+
+    __slots__ = ("ranges", "starts", "size")
+
+    def __init__(self, ranges: List[ByteRange]):
+        self.ranges = ranges
+        self.starts = []
+        size = 0
+        for _, _, length in ranges:
+            self.starts.append(size)
+            size += length
+        self.size = size
+
+    def map_range(self, start: int, end: int) -> Iterator[ByteRange]:
+        """Source ranges that make up virtual bytes ``start:end`` (end exclusive)."""
+        end = min(end, self.size)
+        i = bisect.bisect_right(self.starts, start) - 1
+        while start < end and i < len(self.ranges):
+            filename, offset, length = self.ranges[i]
+            skip = start - self.starts[i]
+            count = min(length - skip, end - start)
+            yield filename, offset + skip, count
+            start += count
+            i += 1
+
+    def iter_range(self, start: int, end: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        return iter_ranges(self.map_range(start, end), chunk_size)
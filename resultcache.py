@@ -0,0 +1,140 @@
+# Tiered cache of "is this stitched file in the bucket" answers, checked in front of the bucket.
+#
+#   memory  LRU of recent answers. Present files are remembered for POSITIVE_TTL_SEC, misses for the much
+#           shorter NEGATIVE_TTL_SEC since another worker may be stitching the file right now
+#   disk    DiskLRU of small JSON markers of the stitched MP3s this host uploaded (name, size, upload
+#           time), not of the audio. A marker there means the file is in the bucket, and the entry
+#           outlives the process and is shared by the workers of the host
+#   bucket  the existence check of the caller, only made when both tiers miss
+#
+# Stitched files are content addressed (the name holds the hash of the track and ads), so a present
+# answer does not go stale, only the negative one does.
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+# Imports from this repository
+from diskcache import CACHE_ROOT
+from diskcache import DiskLRU
+
+# a marker is about 100 bytes but takes a whole filesystem block (4 KB on most), the default keeps the
+# markers of the last ~64k uploads
+DEFAULT_MAX_BYTES = int(os.getenv("AD_STITCH_RESULT_CACHE_BYTES", 256 * 1024 * 1024))
+MEMORY_ENTRIES = 16384
+POSITIVE_TTL_SEC = 300
+NEGATIVE_TTL_SEC = 2
+SUFFIX = ".json"
+
+TIER_MEMORY = "memory"
+TIER_DISK = "disk"
+TIER_BUCKET = "bucket"
+
+
+class ResultCache:
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        entries: int = MEMORY_ENTRIES,
+        positive_ttl: float = POSITIVE_TTL_SEC,
+        negative_ttl: float = NEGATIVE_TTL_SEC,
+    ):
+        self.store = DiskLRU(directory, max_bytes)
+        self.entries = entries
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        # name -> (present, expiry on the monotonic clock)
+        self._memory: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counts = {
+            TIER_MEMORY: {"hits": 0, "negativeHits": 0, "misses": 0},
+            TIER_DISK: {"hits": 0, "misses": 0},
+            TIER_BUCKET: {"hits": 0, "misses": 0},
+        }
+
+    @staticmethod
+    def key(name: str) -> str:
+        # remote names look like v1-stitched/<id>-<uid>-<hash>.mp3
+        return os.path.splitext(os.path.basename(name))[0]
+
+    def _count(self, tier: str, outcome: str):
+        with self._lock:
+            self._counts[tier][outcome] += 1
+
+    def _remember(self, name: str, present: bool):
+        ttl = self.positive_ttl if present else self.negative_ttl
+        with self._lock:
+            self._memory[name] = (present, time.monotonic() + ttl)
+            self._memory.move_to_end(name)
+            while len(self._memory) > self.entries:
+                self._memory.popitem(last=False)
+
+    def _recall(self, name: str) -> Optional[bool]:
+        with self._lock:
+            entry = self._memory.get(name)
+            if entry is None:
+                return None
+            present, expiry = entry
+            if time.monotonic() >= expiry:
+                del self._memory[name]
+                return None
+            self._memory.move_to_end(name)
+            return present
+
+    def exists(self, name: str, exists_remote: Callable[[str], bool]) -> bool:
+        """
+        Whether the stitched file ``name`` is in the bucket, asking the tiers in order.
+
+        :param exists_remote: existence check of the bucket, the last tier
+        """
+        present = self._recall(name)
+        if present is not None:
+            self._count(TIER_MEMORY, "hits" if present else "negativeHits")
+            return present
+        self._count(TIER_MEMORY, "misses")
+
+        if self.store.get(self.key(name), SUFFIX) is not None:
+            self._count(TIER_DISK, "hits")
+            self._remember(name, True)
+            return True
+        self._count(TIER_DISK, "misses")
+
+        present = exists_remote(name)
+        self._count(TIER_BUCKET, "hits" if present else "misses")
+        self._remember(name, present)
+        return present
+
+    def add(self, name: str, local_filename: str):
+        """Record the upload of ``local_filename`` as ``name`` with a marker in the disk tier."""
+        marker = {"name": name, "bytes": os.path.getsize(local_filename), "uploadedAt": time.time()}
+
+        def write(tmp_path):
+            with open(tmp_path, "w") as f:
+                json.dump(marker, f)
+
+        self.store.put(self.key(name), SUFFIX, write)
+        self._remember(name, True)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = {tier: dict(counts) for tier, counts in self._counts.items()}
+            stats[TIER_MEMORY]["entries"] = len(self._memory)
+        stats[TIER_DISK]["bytes"] = self.store.total_bytes()
+        stats[TIER_DISK]["maxBytes"] = self.store.max_bytes
+        return stats
+
+
+_default_cache: Optional[ResultCache] = None
+
+
+def get_cache() -> ResultCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResultCache(os.path.join(CACHE_ROOT, "stitched-markers"), DEFAULT_MAX_BYTES)
+    return _default_cache
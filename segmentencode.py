@@ -0,0 +1,99 @@
+# Parallel MP3 encoding of a long PCM timeline.
+#
+# LAME runs on a single thread, so re-encoding a one hour stitch keeps one core busy for its whole run. The
+# timeline is decoded to a WAV file once (decoding is cheap) and cut at frame boundaries into segments that
+# are encoded at the same time, one ffmpeg process per segment. Every segment is encoded with the samples
+# around it as context and with -reservoir 0 (see smartrender.encode_frames), so it needs no bytes of the
+# segment before it and starts on the sample the previous one ended at. The segments are joined by copying
+# their frames, the output is gapless.
+import os
+import tempfile
+import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from typing import Tuple
+
+# Imports from this repository
+import smartrender
+from rangecopy import write_ranges
+
+# every segment runs its own ffmpeg process, the threads only wait for them
+ENCODE_WORKERS = os.cpu_count() or 1
+# shorter segments would spend more on their context frames and process starts than they save
+MIN_SEGMENT_SEC = 30
+DEFAULT_BITRATE = 128000
+
+
+def samples_per_frame(sample_rate: int) -> int:
+    # MPEG 1 Layer III for 32 kHz and above, MPEG 2/2.5 below
+    return 1152 if sample_rate >= 32000 else 576
+
+
+def split_frames(frames: int, segments: int, min_frames: int) -> List[Tuple[int, int]]:
+    """(first, last) frames of at most ``segments`` segments of at least ``min_frames`` each."""
+    segments = max(min(segments, frames // max(min_frames, 1)), 1)
+    bounds = [frames * i // segments for i in range(segments + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def _read_pcm(wav_filename: str, start: int, end: int) -> bytes:
+    """Samples ``start:end`` of the WAV file, zeros outside of it."""
+    with wave.open(wav_filename, "rb") as wav:
+        sample_size = wav.getnchannels() * wav.getsampwidth()
+        first = min(max(start, 0), wav.getnframes())
+        wav.setpos(first)
+        pcm = wav.readframes(max(min(end, wav.getnframes()) - first, 0))
+    before = (first - start) * sample_size
+    return bytes(before) + pcm + bytes((end - start) * sample_size - before - len(pcm))
+
+
+def _encode_segment(wav_filename: str, first: int, last: int, bitrate: int) -> str:
+    with wave.open(wav_filename, "rb") as wav:
+        sample_rate, channels = wav.getframerate(), wav.getnchannels()
+    spf = samples_per_frame(sample_rate)
+    pcm = _read_pcm(
+        wav_filename,
+        first * spf - smartrender.preroll_samples(spf),
+        last * spf + smartrender.postroll_samples(spf),
+    )
+    encoded = smartrender.encode_frames(pcm, last - first, sample_rate, channels, bitrate)
+    segment_filename = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}-segment.mp3")
+    with open(segment_filename, "wb") as f:
+        f.write(encoded)
+    return segment_filename
+
+
+def encode_wav(
+    wav_filename: str,
+    output_filename: str,
+    bitrate: int = DEFAULT_BITRATE,
+    workers: int = ENCODE_WORKERS,
+) -> str:
+    """
+    Encode the 16 bit WAV ``wav_filename`` to ``output_filename`` on up to ``workers`` cores.
+
+    The output has no encoder delay: its first frame decodes to the first sample of the WAV file. The last
+    frame is completed with silence.
+    """
+    with wave.open(wav_filename, "rb") as wav:
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"{wav_filename} is not 16 bit PCM")
+        sample_rate, samples = wav.getframerate(), wav.getnframes()
+    spf = samples_per_frame(sample_rate)
+    frames = -(-samples // spf)
+    segments = split_frames(frames, workers, MIN_SEGMENT_SEC * sample_rate // spf)
+
+    futures = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_encode_segment, wav_filename, first, last, bitrate) for first, last in segments
+            ]
+        ranges = [(future.result(), 0, os.path.getsize(future.result())) for future in futures]
+        return write_ranges(output_filename, ranges)
+    finally:
+        # the executor waited for every segment, remove the ones that were written
+        for future in futures:
+            if future.exception() is None:
+                os.remove(future.result())
@@ -0,0 +1,208 @@
+# Single-flight execution of expensive, idempotent work such as stitching a track.
+#
+# When a new episode goes live, many workers miss on the same stitched file at once. run() lets one caller
+# per key do the work: threads of a process wait on the first thread of that process, and processes (on
+# this host or any host sharing LEASE_DIR) wait on the one holding the key's lease file. The lease is
+# created with O_EXCL, so exactly one process gets it, and the holder refreshes its mtime every
+# HEARTBEAT_SEC. A lease that was not refreshed for STALE_AFTER_SEC, or whose holder process is gone, is
+# taken over by a waiting process. Followers poll ``lookup`` for the result instead of recomputing it.
+#
+# The worst a race can do (a takeover of a leader that was only slow, a follower giving up after its
+# timeout) is to do the work twice, which is why the work has to be idempotent.
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import TypeVar
+
+# Imports from this repository
+from diskcache import CACHE_ROOT
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+LEASE_DIR = os.getenv("AD_STITCH_LEASE_DIR", os.path.join(CACHE_ROOT, "leases"))
+HEARTBEAT_SEC = 5
+STALE_AFTER_SEC = 30
+POLL_SEC = 1.0
+DEFAULT_TIMEOUT_SEC = 600
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists, owned by another user
+        return True
+    return True
+
+
+def _read_json(path: str) -> Optional[Dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # missing, or caught between creation and the write of its content
+        return None
+
+
+class Lease:
+    """Exclusive lease on ``path``, kept alive by a heartbeat thread while it is held."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.token = uuid.uuid4().hex
+        self._stop = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+
+    def acquire(self) -> bool:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"token": self.token, "pid": os.getpid(), "host": socket.gethostname(), "started": time.time()}, f)
+        self._stop.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name="lease-heartbeat", daemon=True)
+        self._heartbeat_thread.start()
+        return True
+
+    def _heartbeat(self):
+        while not self._stop.wait(HEARTBEAT_SEC):
+            holder = _read_json(self.path)
+            if holder is None or holder.get("token") != self.token:
+                logger.warning("Lease lost, another process took it over", lease=self.path)
+                return
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        holder = _read_json(self.path)
+        if holder is not None and holder.get("token") == self.token:
+            os.remove(self.path)
+
+    def stale_holder(self) -> Optional[Dict]:
+        """Content of the lease file when its holder is dead or stopped heartbeating, None otherwise."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+        holder = _read_json(self.path)
+        if holder is None:
+            # a lease that stays empty belongs to a process that died while creating it
+            return {} if time.time() - mtime > STALE_AFTER_SEC else None
+        if holder.get("host") == socket.gethostname() and not _pid_alive(holder.get("pid", 0)):
+            return holder
+        if time.time() - mtime > STALE_AFTER_SEC:
+            return holder
+        return None
+
+    def take_over(self, stale: Dict):
+        """Remove the stale lease ``stale`` so the next acquire can succeed."""
+        moved = f"{self.path}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(self.path, moved)
+        except FileNotFoundError:
+            return
+        holder = _read_json(moved)
+        if holder is not None and holder.get("token") != stale.get("token"):
+            # another process took over between our check and the rename, give it its lease back
+            try:
+                os.link(moved, self.path)
+            except FileExistsError:
+                pass
+        else:
+            logger.warning("Taking over stale lease", lease=self.path, holder=stale)
+        os.remove(moved)
+
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+_flights: Dict[str, _Flight] = {}
+_flights_lock = threading.Lock()
+
+
+def _run_leased(key: str, compute: Callable[[], T], lookup: Callable[[], Optional[T]], timeout: float) -> T:
+    lease = Lease(os.path.join(LEASE_DIR, f"{key}.lease"))
+    deadline = time.monotonic() + timeout
+    while True:
+        if lease.acquire():
+            try:
+                # the previous holder may have finished between our miss and the acquire
+                result = lookup()
+                return compute() if result is None else result
+            finally:
+                lease.release()
+
+        result = lookup()
+        if result is not None:
+            return result
+        stale = lease.stale_holder()
+        if stale is not None:
+            lease.take_over(stale)
+            continue
+        if time.monotonic() > deadline:
+            logger.warning("Timed out waiting for the lease holder, computing", key=key, timeout=timeout)
+            return compute()
+        time.sleep(POLL_SEC)
+
+
+def run(
+    key: str,
+    compute: Callable[[], T],
+    lookup: Callable[[], Optional[T]],
+    timeout: float = DEFAULT_TIMEOUT_SEC,
+) -> T:
+    """
+    Result of ``compute()`` for ``key``, computed by one caller at a time across threads and processes.
+
+    :param compute: does the work and returns its result, it must be idempotent
+    :param lookup: returns the result once some caller computed it, None until then
+    :param timeout: seconds a follower waits for the leader before computing the result itself
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        if not flight.done.wait(timeout):
+            logger.warning("Timed out waiting for the leader thread, computing", key=key, timeout=timeout)
+            return compute()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = _run_leased(key, compute, lookup, timeout)
+        return flight.result
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
@@ -0,0 +1,72 @@
+# Content-addressed cache of the track slices cut by the slice stitch mode.
+#
+# Stitching the same episode with a different ad set cuts the same slices (0-5 s, 5-40 s, ...) again under
+# new uuid names. Slices are stored here keyed by (track content, start ms, end ms) and later stitches
+# hard-link the cached slice into place instead of running ffmpeg. Callers keep deleting their slice after
+# the stitch, that only drops their link, the cached copy stays until it is evicted.
+import os
+import threading
+from typing import Dict
+from typing import Optional
+
+# Imports from this repository
+from diskcache import CACHE_ROOT
+from diskcache import DiskLRU
+from diskcache import content_key
+from diskcache import link_or_copy
+
+DEFAULT_MAX_BYTES = int(os.getenv("AD_STITCH_SLICE_CACHE_BYTES", 2 * 1024 * 1024 * 1024))
+SUFFIX = ".mp3"
+
+
+class SliceCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.store = DiskLRU(directory, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(orig_file: str, start_sec: float, end_sec: Optional[float]) -> str:
+        end = "end" if end_sec is None else int(round(end_sec * 1000))
+        return f"{content_key(orig_file)}-{int(round(start_sec * 1000))}-{end}"
+
+    def fetch(self, orig_file: str, start_sec: float, end_sec: Optional[float], output_file: str) -> bool:
+        """Place the cached slice at ``output_file``, False on a miss."""
+        path = self.store.get(self.key(orig_file, start_sec, end_sec), SUFFIX)
+        if path is not None:
+            try:
+                link_or_copy(path, output_file)
+            except FileNotFoundError:  # evicted in between
+                path = None
+        with self._lock:
+            if path is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return path is not None
+
+    def store_slice(self, orig_file: str, start_sec: float, end_sec: Optional[float], output_file: str):
+        """Add a freshly cut slice to the cache."""
+        self.store.put(self.key(orig_file, start_sec, end_sec), SUFFIX, lambda tmp: link_or_copy(output_file, tmp))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hitRate": hits / (hits + misses) if hits + misses else 0.0,
+            "bytes": self.store.total_bytes(),
+            "maxBytes": self.store.max_bytes,
+        }
+
+
+_default_cache: Optional[SliceCache] = None
+
+
+def get_cache() -> SliceCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = SliceCache(os.path.join(CACHE_ROOT, "slices"), DEFAULT_MAX_BYTES)
+    return _default_cache
@@ -0,0 +1,525 @@
+# Smart render: stitch by copying MP3 frames and re-encoding only a few frames around every join.
+#
+# Splice mode copies whole frames, so every join is rounded to a frame (26 ms) and carries the encoder
+# delay and padding of the inserted file (~50 ms of silence per ad, the drift noted in
+# tmp1_withnotes.json), and the first copied frames after a join point into the bit reservoir of frames
+# that are not there anymore. The encoding stitch fixes all of it by re-encoding the whole episode.
+#
+# Here the target timeline is built in samples: track slices cut at their exact marks, ads without their
+# encoder delay and padding (read from the LAME tag). Frames away from the joins are copied. The
+# BRIDGE_FRAMES frames on each side of a join are decoded to PCM, joined exactly, and re-encoded with
+# -reservoir 0 so they borrow no bytes from the frames around them. The bytes the first copied frames
+# borrow from the source frames before them are appended to the last frame of the bridge, which is
+# rewritten with a higher bitrate to make room for them.
+#
+# Copied frames sit on the frame grid of their source, so each copied run is placed within half a frame
+# of its exact position and the bridge before it absorbs the difference (silence or dropped samples at
+# the join, at most one frame). Errors do not add up from one ad to the next.
+#
+# `verify` measures the drift of every join of a stitched file against the target timeline by
+# correlating the decoded output with the decoded sources.
+#
+# usage: python smartrender.py render out.mp3 track.mp3 Coke.mp3@5000 Geico.mp3@40000
+#        python smartrender.py verify out.mp3 track.mp3 Coke.mp3@5000 Geico.mp3@40000
+import argparse
+import math
+import operator
+import os
+import subprocess
+import sys
+import tempfile
+import uuid
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+# Imports from this repository
+import mp3frames
+from mp3frames import DECODER_DELAY
+from mp3frames import FrameHeader
+from mp3frames import Mp3FrameIndex
+from rangecopy import write_ranges
+
+FFMPEG = ["ffmpeg", "-nostats", "-hide_banner", "-v", "error"]
+
+# frames re-encoded on each side of a join
+BRIDGE_FRAMES = 2
+# frames decoded before a cut, their output is dropped: they fill the bit reservoir and the MDCT overlap
+DECODE_PREROLL_FRAMES = 3
+# frames encoded before the wanted ones and dropped, see encode_frames
+ENCODE_PREROLL_FRAMES = 2
+# delay of LAME as used by ffmpeg (576) plus the decoder delay: decoded[n + ENCODER_DELAY] = input[n]
+ENCODER_DELAY = 576 + DECODER_DELAY
+# frames searched after the bridge for one whose borrowed bit reservoir fits in the last bridge frame
+RESUME_SEARCH_FRAMES = 32
+# largest bit reservoir of Layer III, in bytes
+MAX_RESERVOIR = 511
+MAX_BRIDGE_WORKERS = os.cpu_count() or 1
+
+
+class Span(NamedTuple):
+    """Samples ``start:end`` of a source, as its decoder outputs them without any gapless trimming."""
+
+    index: Mp3FrameIndex
+    start: int
+    end: int
+
+
+class Copy(NamedTuple):
+    """Frames ``first:last`` of a source, copied as they are."""
+
+    index: Mp3FrameIndex
+    first: int
+    last: int
+
+
+# (index, start, end) samples of a source, or (None, 0, n) for n samples of silence
+Part = Tuple[Optional[Mp3FrameIndex], int, int]
+
+
+class Bridge(NamedTuple):
+    """
+    ``frames`` frames encoded from the PCM of ``parts``, with ``pre``/``post`` as encoder context.
+    ``reservoir`` are the bytes the copied frames after the bridge borrow from the frames before them.
+    """
+
+    parts: List[Part]
+    frames: int
+    pre: List[Part]
+    post: List[Part]
+    reservoir: bytes = b""
+
+
+def _gapless_bounds(index: Mp3FrameIndex) -> Tuple[int, int]:
+    total = index.frame_count * index.samples_per_frame
+    info = mp3frames.read_file_gapless_info(index.filename)
+    if info is None:
+        return 0, total
+    delay, padding = info
+    return min(delay + DECODER_DELAY, total), max(total - max(padding - DECODER_DELAY, 0), 0)
+
+
+def entries_to_spans(entries: List[Tuple], get_index: Callable[[str], Mp3FrameIndex]) -> List[Span]:
+    """
+    Target timeline of concat list entries (filename, inpoint, outpoint).
+
+    Whole file entries (the ads) lose their encoder delay and padding. Cuts of the track are placed at
+    their exact sample, counted from the start of its audio (after the encoder delay), like players do.
+    """
+    spans = []
+    reference = None
+    for filename, inpoint, outpoint in entries:
+        index = get_index(filename)
+        if reference is None:
+            reference = index
+        elif (index.sample_rate, index.channels, index.samples_per_frame) != (
+            reference.sample_rate,
+            reference.channels,
+            reference.samples_per_frame,
+        ):
+            raise ValueError(
+                f"{filename} is {index.sample_rate} Hz/{index.channels} ch, "
+                f"{reference.filename} is {reference.sample_rate} Hz/{reference.channels} ch. Transcode first"
+            )
+        audio_start, audio_end = _gapless_bounds(index)
+        if inpoint is None and outpoint is None:
+            start, end = audio_start, audio_end
+        else:
+            start = audio_start + int(round((inpoint or 0) * index.sample_rate))
+            if not spans and not inpoint:
+                # an episode starting with the track keeps its priming, copying starts at frame 0
+                start = 0
+            end = audio_end if outpoint is None else audio_start + int(round(outpoint * index.sample_rate))
+            end = min(end, audio_end)
+        if end > start:
+            spans.append(Span(index, start, end))
+    return spans
+
+
+def _main_data(index: Mp3FrameIndex, frame: int, fd: int) -> Tuple[int, bytes]:
+    """(main_data_begin, audio data bytes) of ``frame``."""
+    data = os.pread(fd, index.offsets[frame + 1] - index.offsets[frame], index.offsets[frame])
+    header = mp3frames.parse_frame_header(data)
+    return mp3frames.main_data_begin(data, 0, header), data[header.main_data_offset:]
+
+
+def _borrowed(index: Mp3FrameIndex, frame: int, fd: int) -> int:
+    """Bytes that ``frame`` and the frames after it read from the frames before ``frame``."""
+    borrowed = available = 0
+    while available < MAX_RESERVOIR and frame < index.frame_count:
+        begin, main_data = _main_data(index, frame, fd)
+        borrowed = max(borrowed, begin - available)
+        available += len(main_data)
+        frame += 1
+    return borrowed
+
+
+def _reservoir(index: Mp3FrameIndex, frame: int, size: int, fd: int) -> bytes:
+    """The last ``size`` bytes of audio data before ``frame``."""
+    tail = b""
+    while len(tail) < size and frame > 0:
+        frame -= 1
+        tail = _main_data(index, frame, fd)[1] + tail
+    return bytes(max(size - len(tail), 0)) + tail[len(tail) - size:]
+
+
+def _resume_frame(index: Mp3FrameIndex, frame: int, last: int, room: int) -> Tuple[Optional[int], bytes]:
+    """
+    First frame from ``frame`` (before ``last``) that copying can resume at, with the bit reservoir it
+    needs, which must fit in ``room`` bytes.
+    """
+    fd = os.open(index.filename, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        for candidate in range(frame, min(frame + RESUME_SEARCH_FRAMES, last)):
+            size = _borrowed(index, candidate, fd)
+            if size <= room:
+                return candidate, _reservoir(index, candidate, size, fd)
+    finally:
+        os.close(fd)
+    return None, b""
+
+
+def _frame_length(header: FrameHeader, kbps: int) -> int:
+    return (header.samples_per_frame // 8) * kbps * 1000 // header.sample_rate
+
+
+def _bitrates(header: FrameHeader) -> Tuple[int, ...]:
+    return mp3frames._BITRATES_V1_L3 if header.version == 3 else mp3frames._BITRATES_V2_L3
+
+
+def _reservoir_room(header: FrameHeader) -> int:
+    """Bytes a bridge frame of ``header`` gains when rewritten at the highest bitrate."""
+    return _frame_length(header, max(_bitrates(header))) - _frame_length(header, header.bitrate // 1000)
+
+
+def _append_reservoir(frame: bytes, reservoir: bytes) -> bytes:
+    """
+    ``frame`` rewritten at the lowest bitrate that holds its audio data followed by ``reservoir``, so the
+    next frame finds the bytes it borrows at the end of it. The bytes between are ancillary data.
+    """
+    header = mp3frames.parse_frame_header(frame)
+    main_data = frame[header.main_data_offset:]
+    bitrates = _bitrates(header)
+    for bitrate_index, kbps in enumerate(bitrates):
+        length = _frame_length(header, kbps)
+        if kbps and length - 4 - header.side_info_size >= len(main_data) + len(reservoir):
+            break
+    else:
+        raise ValueError(f"No bitrate holds {len(main_data)} + {len(reservoir)} bytes of audio data")
+    # no padding, no CRC (it would cover the new bitrate)
+    head = bytes((frame[0], frame[1] | 0x01, (bitrate_index << 4) | (frame[2] & 0x0D), frame[3]))
+    side_info = frame[header.main_data_offset - header.side_info_size:header.main_data_offset]
+    padding = bytes(length - 4 - len(side_info) - len(main_data) - len(reservoir))
+    return head + side_info + main_data + padding + reservoir
+
+
+def _parts_length(parts: List[Part]) -> int:
+    return sum(end - start for _, start, end in parts)
+
+
+def _fit_parts(parts: List[Part], length: int) -> List[Part]:
+    """
+    ``parts`` made exactly ``length`` samples long at their first join: the copied runs around the bridge
+    are on the frame grid, the bridge takes up the difference to the exact timeline.
+    """
+    at = 1 if len(parts) > 1 else len(parts)
+    diff = length - _parts_length(parts)
+    if diff >= 0:
+        return parts[:at] + [(None, 0, diff)] + parts[at:]
+    fitted = list(parts[:at])
+    for index, start, end in parts[at:]:
+        drop = min(-diff, end - start)
+        diff += drop
+        fitted.append((index, start + drop, end))
+    if diff < 0:  # nothing after the join to drop from, drop before it
+        index, start, end = fitted[0]
+        fitted[0] = (index, start, end + diff)
+    return fitted
+
+
+def plan(spans: List[Span], bridge_frames: int = BRIDGE_FRAMES) -> List[Union[Copy, Bridge]]:
+    """Copy runs and bridges that render ``spans``, in output order."""
+    spf = spans[0].index.samples_per_frame
+    room = _reservoir_room(_first_header(spans[0].index))
+    pre_length = preroll_samples(spf)
+    post_length = postroll_samples(spf)
+
+    pieces: List[Union[Copy, Bridge]] = []
+    parts: List[Part] = []
+    bridge_start = 0  # output frame of the bridge being built
+    pre: List[Part] = [(None, 0, pre_length)]
+    position = 0  # exact output sample where the current span starts
+    for i, span in enumerate(spans):
+        index = span.index
+        # nearest placement of the span on the output frame grid
+        misalignment = (position - span.start) % spf
+        shift = -misalignment if misalignment <= spf // 2 else spf - misalignment
+        frame_offset = (position + shift - span.start) // spf
+
+        is_last = i == len(spans) - 1
+        last = index.frame_count if is_last else span.end // spf - bridge_frames
+        if i == 0 and span.start == 0:
+            first, reservoir = 0, b""
+        else:
+            first, reservoir = _resume_frame(index, -(-span.start // spf) + bridge_frames, last, room)
+
+        if first is None or first >= last:
+            parts.append((index, span.start, span.end))
+        else:
+            parts.append((index, span.start, first * spf))
+            bridge_end = first + frame_offset
+            if bridge_end > bridge_start or _parts_length(parts):
+                post = [(index, first * spf, min(first * spf + post_length, last * spf))]
+                length = (bridge_end - bridge_start) * spf
+                pieces.append(Bridge(_fit_parts(parts, length), bridge_end - bridge_start, pre, post, reservoir))
+            pieces.append(Copy(index, first, last))
+            bridge_start = last + frame_offset
+            pre = [(index, last * spf - pre_length, last * spf)]
+            parts = [] if is_last else [(index, last * spf, span.end)]
+        position += span.end - span.start
+
+    if _parts_length(parts):
+        # the episode ends in a bridge, its last frame is completed with silence
+        frames = -(-_parts_length(parts) // spf)
+        parts.append((None, 0, frames * spf - _parts_length(parts)))
+        pieces.append(Bridge(parts, frames, pre, [(None, 0, post_length)]))
+    return pieces
+
+
+def decode_pcm(index: Mp3FrameIndex, start: int, end: int) -> bytes:
+    """Samples ``start:end`` of the source as interleaved s16le, zeros past its last frame."""
+    spf = index.samples_per_frame
+    sample_size = 2 * index.channels
+    first = max(start // spf - DECODE_PREROLL_FRAMES, 0)
+    last = min(-(-end // spf), index.frame_count)
+    pcm = b""
+    if last > first:
+        with open(index.filename, "rb") as f:
+            f.seek(index.offsets[first])
+            data = f.read(index.offsets[last] - index.offsets[first])
+        args = FFMPEG + ["-f", "mp3", "-i", "pipe:0", "-f", "s16le", "-acodec", "pcm_s16le", "pipe:1"]
+        pcm = subprocess.run(args, input=data, stdout=subprocess.PIPE, check=True).stdout
+        # frames the decoder could not decode for lack of reservoir data are the first ones
+        missing = (last - first) * spf * sample_size - len(pcm)
+        if missing > 0:
+            pcm = bytes(missing) + pcm
+    pcm = pcm[(start - first * spf) * sample_size:(end - first * spf) * sample_size]
+    return pcm + bytes((end - start) * sample_size - len(pcm))
+
+
+def _parts_pcm(parts: List[Part], channels: int) -> bytes:
+    return b"".join(
+        bytes((end - start) * 2 * channels) if index is None else decode_pcm(index, start, end)
+        for index, start, end in parts
+        if end > start
+    )
+
+
+def preroll_samples(samples_per_frame: int) -> int:
+    """Samples of context encode_frames needs before the samples it encodes."""
+    return ENCODE_PREROLL_FRAMES * samples_per_frame - ENCODER_DELAY
+
+
+def postroll_samples(samples_per_frame: int) -> int:
+    """Samples of context encode_frames needs after the samples it encodes."""
+    return ENCODER_DELAY + samples_per_frame
+
+
+def encode_frames(pcm: bytes, frames: int, sample_rate: int, channels: int, bitrate: int) -> bytes:
+    """
+    ``frames`` self-contained MP3 frames of the s16le ``pcm``.
+
+    ``pcm`` is preroll_samples of context, the ``frames`` frames of samples to encode and postroll_samples
+    of context, so the samples decode from the start of output frame ENCODE_PREROLL_FRAMES on. The frames
+    before it and the ones flushed after it are dropped. With -reservoir 0 the frames borrow no bytes from
+    each other, so they can be placed after any frame.
+    """
+    args = FFMPEG + ["-f", "s16le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0"]
+    args += ["-c:a", "libmp3lame", "-b:a", str(bitrate), "-reservoir", "0"]
+    args += ["-write_xing", "0", "-id3v2_version", "0", "-f", "mp3", "pipe:1"]
+    encoded = subprocess.run(args, input=pcm, stdout=subprocess.PIPE, check=True).stdout
+    index = mp3frames.index_frames(encoded)
+    last = ENCODE_PREROLL_FRAMES + frames
+    if index.frame_count < last:
+        raise ValueError(f"Encoded {index.frame_count} frames, {last} expected")
+    return encoded[index.offsets[ENCODE_PREROLL_FRAMES]:index.offsets[last]]
+
+
+def _encode_bridge(bridge: Bridge, sample_rate: int, channels: int, bitrate: int) -> bytes:
+    """The frames of ``bridge``, the last one carrying the reservoir of the copied frames after it."""
+    pcm = _parts_pcm(bridge.pre + bridge.parts + bridge.post, channels)
+    encoded = encode_frames(pcm, bridge.frames, sample_rate, channels, bitrate)
+    if not bridge.reservoir:
+        return encoded
+    last_frame = mp3frames.index_frames(encoded).offsets[-2]
+    return encoded[:last_frame] + _append_reservoir(encoded[last_frame:], bridge.reservoir)
+
+
+def _first_header(index: Mp3FrameIndex) -> FrameHeader:
+    with open(index.filename, "rb") as f:
+        f.seek(index.offsets[0])
+        return mp3frames.parse_frame_header(f.read(4))
+
+
+def render(
+    entries: List[Tuple],
+    output_filename: str,
+    get_index: Callable[[str], Mp3FrameIndex] = mp3frames.build_index,
+) -> str:
+    """
+    Smart render the concat list ``entries`` to ``output_filename``.
+
+    Bridges are encoded in parallel, one ffmpeg process each, and written to temporary files that the
+    copy runs are assembled with by rangecopy.
+    """
+    spans = entries_to_spans(entries, get_index)
+    if not spans:
+        raise ValueError("Nothing to render")
+    pieces = plan(spans)
+    reference = spans[0].index
+    bitrate = _first_header(reference).bitrate
+
+    bridge_files = {}
+    try:
+        bridges = [piece for piece in pieces if isinstance(piece, Bridge)]
+        with ThreadPoolExecutor(max_workers=MAX_BRIDGE_WORKERS) as executor:
+            encoded = executor.map(
+                lambda bridge: _encode_bridge(bridge, reference.sample_rate, reference.channels, bitrate), bridges
+            )
+            for i, data in enumerate(encoded):
+                bridge_files[i] = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}-bridge.mp3")
+                with open(bridge_files[i], "wb") as f:
+                    f.write(data)
+
+        ranges = []
+        bridge_number = 0
+        for piece in pieces:
+            if isinstance(piece, Copy):
+                offset = piece.index.offsets[piece.first]
+                ranges.append((piece.index.filename, offset, piece.index.offsets[piece.last] - offset))
+            else:
+                bridge_file = bridge_files[bridge_number]
+                ranges.append((bridge_file, 0, os.path.getsize(bridge_file)))
+                bridge_number += 1
+        return write_ranges(output_filename, ranges)
+    finally:
+        for bridge_file in bridge_files.values():
+            os.remove(bridge_file)
+
+
+# verify correlates VERIFY_WINDOW samples of each source with the output, VERIFY_SEARCH samples around
+# the expected position, first on a signal decimated by VERIFY_DECIMATION then at full rate
+VERIFY_WINDOW = 2048
+VERIFY_SEARCH = 4096
+VERIFY_DECIMATION = 8
+# the window is the loudest one in the first VERIFY_SCAN_SEC of a span, silence can not be located
+VERIFY_SCAN_SEC = 3
+
+
+def _mono(pcm: bytes, channels: int) -> List[float]:
+    samples = array("h")
+    samples.frombytes(pcm)
+    if channels == 1:
+        return [float(s) for s in samples]
+    return [(left + right) / 2.0 for left, right in zip(samples[0::2], samples[1::2])]
+
+
+def _decimate(signal: List[float], factor: int) -> List[float]:
+    return [sum(signal[i:i + factor]) / factor for i in range(0, len(signal) - factor + 1, factor)]
+
+
+def _best_lag(reference: List[float], signal: List[float], lags: range) -> int:
+    best, best_score = lags.start, -math.inf
+    n = len(reference)
+    for lag in lags:
+        window = signal[lag:lag + n]
+        if len(window) < n:
+            break
+        energy = sum(map(operator.mul, window, window))
+        if energy <= 0:
+            continue
+        score = sum(map(operator.mul, reference, window)) / math.sqrt(energy)
+        if score > best_score:
+            best, best_score = lag, score
+    return best
+
+
+def _loudest_window(signal: List[float], window: int) -> int:
+    best, best_energy = 0, -1.0
+    for start in range(0, max(len(signal) - window, 0) + 1, window // 2):
+        chunk = signal[start:start + window]
+        energy = sum(map(operator.mul, chunk, chunk))
+        if energy > best_energy:
+            best, best_energy = start, energy
+    return best
+
+
+def measure_drift(output_filename: str, spans: List[Span]) -> List[Tuple[float, Optional[float]]]:
+    """
+    (expected time, drift in ms) of the start of every span in the stitched output, drift None where the
+    span is silent. A positive drift means the span plays late.
+    """
+    output = mp3frames.build_index(output_filename)
+    channels = output.channels
+    results = []
+    position = 0
+    for span in spans:
+        scan_end = min(span.end, span.start + VERIFY_SCAN_SEC * output.sample_rate)
+        source = _mono(decode_pcm(span.index, span.start, scan_end), channels)
+        offset = _loudest_window(source, VERIFY_WINDOW)
+        reference = source[offset:offset + VERIFY_WINDOW]
+        drift = None
+        if len(reference) == VERIFY_WINDOW and any(reference):
+            expected = position + offset
+            start = max(expected - VERIFY_SEARCH, 0)
+            signal = _mono(decode_pcm(output, start, expected + VERIFY_WINDOW + VERIFY_SEARCH), channels)
+            coarse = _best_lag(
+                _decimate(reference, VERIFY_DECIMATION),
+                _decimate(signal, VERIFY_DECIMATION),
+                range(0, len(signal) // VERIFY_DECIMATION),
+            )
+            lag = _best_lag(
+                reference,
+                signal,
+                range(max((coarse - 2) * VERIFY_DECIMATION, 0), (coarse + 2) * VERIFY_DECIMATION + 1),
+            )
+            drift = (start + lag - expected) * 1000.0 / output.sample_rate
+        results.append((position / output.sample_rate, drift))
+        position += span.end - span.start
+    return results
+
+
+def _parse_ads(values: List[str]) -> List[dict]:
+    ad_segments = []
+    for value in values:
+        filepath, _, mark = value.rpartition("@")
+        ad_segments.append({"markInMillis": int(mark), "filepath": filepath})
+    return sorted(ad_segments, key=lambda ad: ad["markInMillis"])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Smart render stitching and join drift measurement")
+    parser.add_argument("command", choices=["render", "verify"])
+    parser.add_argument("output", help="stitched file to write (render) or to measure (verify)")
+    parser.add_argument("track")
+    parser.add_argument("ads", nargs="+", help="ad file and markInMillis as name@mark, e.g. Coke.mp3@5000")
+    args = parser.parse_args(argv)
+
+    # concat pulls in ffmpeg-python and the caches, only the CLI needs its entry layout
+    import concat
+
+    entries = concat._get_concat_entries(args.track, _parse_ads(args.ads))
+    if args.command == "render":
+        print(render(entries, args.output))
+        return
+    for expected, drift in measure_drift(args.output, entries_to_spans(entries, mp3frames.build_index)):
+        print(f"{expected:10.3f}s  " + ("silent" if drift is None else f"{drift:+8.2f} ms"))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
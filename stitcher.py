@@ -5,6 +5,7 @@ import json
 import os
 import subprocess
 import uuid
+from concurrent.futures import Future
 from datetime import datetime
 from datetime import timedelta
 from typing import Dict
@@ -13,83 +14,286 @@ from typing import Tuple
 
 # Third Party Imports
 import ffmpeg
-import requests
 from adori.db import models
 
 # Imports from this repository
-from crud.networks.utils import get_audio_length
+import downloader
+import pcmengine
+import segmentencode
+import singleflight
+import smartrender
+from adstore import get_normalized_link
 from docs.api.utils.db import db_session_maker
+from indexcache import get_index
+from mp3frames import ProgressiveFrameIndex
+from mp3frames import entries_to_ranges
+from mp3frames import get_index_cached
+from mp3frames import iter_entry_ranges
+from probecache import estimate_duration
+from probecache import get_duration
+from rangecopy import DEFAULT_CHUNK_SIZE
+from rangecopy import iter_ranges
+from rangecopy import write_ranges
+from resultcache import get_cache as get_result_cache
 from services.storage import audio_bucket
-from utils.http import file_ext_from_content_type_header
-from utils.http import get_etag_from_header
+from slicecache import get_cache as get_slice_cache
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
+# see _concat_files
+STITCH_MODE_SLICE = "slice"
+STITCH_MODE_INPOINT = "inpoint"
+STITCH_MODE_SPLICE = "splice"
+STITCH_MODE_PIPELINE = "pipeline"
+STITCH_MODE_SMART = "smart"
+
+# see _stitch_files_with_encoding
+ENCODE_MODE_SINGLE = "single"
+ENCODE_MODE_SEGMENTED = "segmented"
+ENCODE_MODE_PCM = "pcm"
+# longer filter graphs are written to a -filter_complex_script file
+MAX_FILTER_ARG_LENGTH = 4096
+
 
 def download_audio(url: str) -> Tuple[str, str, datetime]:
-    local_filename = None
-    etag = ""
-    expiry = datetime.utcnow() + timedelta(hours=6)
+    local_filename, etag, expiry, _ = downloader.download_audio(url)
+    return local_filename, etag, expiry
 
+
+def _download_sources(track: models.AudioTrack, track_audio_ads: List[models.AudioTrackAd]):
+    """
+    Download the track and all its ads concurrently and normalize the ads into the ad store.
+
+    :return: (local track file, insert segments)
+    """
+    urls = [_get_track_url(track)] + _get_ad_urls(track_audio_ads)
+    adorified_file_path, *ad_filepaths = downloader.download_all(urls)
     try:
-        resp = requests.get(url, stream=True, timeout=10)
-        resp.raise_for_status()
-        etag, expiry = get_etag_from_header(resp.headers)
-
-        # 'audio/mpeg' will be identified as mp2. Correct it to mp3
-        ext = file_ext_from_content_type_header(resp.headers.get("Content-Type", None))
-        if not ext or ext == ".mp2":
-            ext = ".mp3"
-
-        local_filename = f"/tmp/{str(uuid.uuid4())}{ext}"
-        with open(local_filename, "wb") as fd:
-            for chunk in resp.iter_content(1024):
-                if chunk:
-                    fd.write(chunk)
-        return local_filename, etag, expiry
-    except requests.exceptions.HTTPError:
-        logger.error("Http Error", url=url, exc_info=True)
-    except requests.exceptions.ConnectionError:
-        logger.error("Connection Error", url=url, exc_info=True)
-    except requests.exceptions.Timeout:
-        logger.error("Timeout Error", url=url, exc_info=True)
-    except requests.exceptions.RequestException:
-        logger.error("Unknown Error", url=url, exc_info=True)
+        insert_segments = _normalize_ads(track_audio_ads, ad_filepaths)
+    except Exception:
+        os.remove(adorified_file_path)
+        raise
+    return adorified_file_path, insert_segments
 
-    return local_filename, etag, expiry
+
+def _remove_ad_links(insert_segments: List[Dict]):
+    # the links of the normalized ads made by _normalize_ads belong to the job
+    for ad in insert_segments:
+        os.remove(ad["filepath"])
+
+
+def _download_sources_pipelined(track: models.AudioTrack, track_audio_ads: List[models.AudioTrackAd]):
+    """
+    Like _download_sources, but returns once the ads are ready while the track keeps downloading.
+
+    :return: (track download future, track download progress, insert segments)
+    """
+    track_download, track_progress = downloader.download_in_background(_get_track_url(track))
+    try:
+        ad_filepaths = downloader.download_all(_get_ad_urls(track_audio_ads))
+        insert_segments = _normalize_ads(track_audio_ads, ad_filepaths)
+    except Exception:
+        _remove_download(track_download, track_progress)
+        raise
+    return track_download, track_progress, insert_segments
+
+
+def _get_track_url(track: models.AudioTrack) -> str:
+    return audio_bucket.get_blob(track.urlSuffix).generate_signed_url(expiration=timedelta(hours=1))
+
+
+def _get_ad_urls(track_audio_ads: List[models.AudioTrackAd]) -> List[str]:
+    urls = []
+    for ad in track_audio_ads:
+        blob = audio_bucket.get_blob(ad.audioAd.get_file_path())
+        urls.append(blob.generate_signed_url(expiration=timedelta(hours=1)))
+    return urls
+
+
+def _normalize_ads(track_audio_ads: List[models.AudioTrackAd], ad_filepaths: List[str]) -> List[Dict]:
+    """
+    Insert segments pointing at links in /tmp of the normalized ads, which the caller removes.
+
+    The ad store keeps one normalized copy per ad content, the download is not needed afterwards. The job
+    reads a link of it, an eviction of the store entry by another process does not affect it.
+    """
+    insert_segments = []
+    try:
+        for ad, local_filepath in zip(track_audio_ads, ad_filepaths):
+            normalized_filepath = get_normalized_link(local_filepath, "/tmp")
+            insert_segments.append({"markInMillis": ad.markInMillis, "filepath": normalized_filepath})
+    except Exception:
+        for segment in insert_segments:
+            os.remove(segment["filepath"])
+        raise
+    finally:
+        for local_filepath in ad_filepaths:
+            os.remove(local_filepath)
+    return insert_segments
+
+
+def _remove_download(download: Future, progress: downloader.DownloadProgress):
+    """
+    Cancel a background download that is no longer needed and remove its file once it ended.
+
+    Returns right away, a listener that disconnects early does not hold its thread for the rest of the
+    download. A download that already completed is only removed.
+    """
+
+    def remove(future: Future):
+        # a failed or cancelled download removed its file itself
+        if future.cancelled() or future.exception() is not None:
+            return
+        local_filename = future.result()[0]
+        if local_filename is not None and os.path.exists(local_filename):
+            os.remove(local_filename)
+
+    progress.cancel()
+    download.add_done_callback(remove)
 
 
 def _get_concat_files(basename: str, orig_file: str, insert_segments: List[Dict]):
+    # slices already cut for an earlier stitch of the same track are linked from the slice cache
+    slice_cache = get_slice_cache()
     concat_files = []
     prev_input_slice_end = 0
     for idx, ad in enumerate(insert_segments):
         mark_in_sec = ad["markInMillis"] / 1000.0
         if prev_input_slice_end < mark_in_sec:
             output_file = f"/tmp/{basename}-{prev_input_slice_end}-{mark_in_sec}.mp3"
-            cmd = (
-                ffmpeg.input(orig_file, ss=prev_input_slice_end, to=mark_in_sec)
-                .output(output_file, c="copy", avoid_negative_ts=1)
-                .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
-            )
-            cmd.run()
+            if not slice_cache.fetch(orig_file, prev_input_slice_end, mark_in_sec, output_file):
+                cmd = (
+                    ffmpeg.input(orig_file, ss=prev_input_slice_end, to=mark_in_sec)
+                    .output(output_file, c="copy", avoid_negative_ts=1)
+                    .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
+                )
+                cmd.run()
+                slice_cache.store_slice(orig_file, prev_input_slice_end, mark_in_sec, output_file)
             prev_input_slice_end = mark_in_sec
             concat_files.append(output_file)
         concat_files.append(ad["filepath"])
 
     output_file = f"/tmp/{basename}-{prev_input_slice_end}-end.mp3"
+    if not slice_cache.fetch(orig_file, prev_input_slice_end, None, output_file):
+        cmd = (
+            ffmpeg.input(orig_file, ss=prev_input_slice_end)
+            .output(output_file, c="copy", avoid_negative_ts=1)
+            .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
+        )
+        cmd.run()
+        slice_cache.store_slice(orig_file, prev_input_slice_end, None, output_file)
+    concat_files.append(output_file)
+
+    return concat_files
+
+
+def _escape_concat_path(filename: str):
+    # the concat demuxer reads paths between single quotes
+    return filename.replace("'", "'\\''")
+
+
+def _get_concat_entries(orig_file: str, insert_segments: List[Dict]):
+    """
+    Same segment layout as _get_concat_files, but the track slices are
+    returned as (orig_file, start, end) entries instead of being cut into
+    separate files. ``None`` means the start/end of the file.
+    """
+    entries = []
+    prev_input_slice_end = 0
+    for idx, ad in enumerate(insert_segments):
+        mark_in_sec = ad["markInMillis"] / 1000.0
+        if prev_input_slice_end < mark_in_sec:
+            entries.append((orig_file, prev_input_slice_end, mark_in_sec))
+            prev_input_slice_end = mark_in_sec
+        entries.append((ad["filepath"], None, None))
+
+    entries.append((orig_file, prev_input_slice_end, None))
+    return entries
+
+
+def _concat_files_single_pass(uid: str, orig_file: str, insert_segments: List[Dict]):
+    basename = f"{uid}-{uuid.uuid4()}"
+    entries = _get_concat_entries(orig_file, insert_segments)
+
+    concat_filename = f"/tmp/{basename}-concat-list.txt"
+    with open(concat_filename, "w") as f:
+        for filename, inpoint, outpoint in entries:
+            f.write(f"file '{_escape_concat_path(os.path.abspath(filename))}'\n")
+            if inpoint:
+                f.write(f"inpoint {inpoint}\n")
+            if outpoint is not None:
+                f.write(f"outpoint {outpoint}\n")
+
+    output_filename = f"/tmp/{basename}.mp3"
     cmd = (
-        ffmpeg.input(orig_file, ss=prev_input_slice_end)
-        .output(output_file, c="copy", avoid_negative_ts=1)
+        ffmpeg.input(concat_filename, f="concat", safe=0)
+        .output(output_filename, c="copy")
         .global_args("-nostats", "-y", "-hide_banner", "-v", "quiet")
     )
-    cmd.run()
-    concat_files.append(output_file)
+    try:
+        cmd.run()
+    finally:
+        os.remove(concat_filename)
 
-    return concat_files
+    return output_filename
+
+
+def _concat_files_splice(uid: str, orig_file: str, insert_segments: List[Dict]):
+    entries = _get_concat_entries(orig_file, insert_segments)
+    ranges = entries_to_ranges(entries, get_index_cached({}, get_index))
+    output_filename = f"/tmp/{uid}-{uuid.uuid4()}.mp3"
+    return write_ranges(output_filename, ranges)
 
 
-def _concat_files(uid: str, orig_file: str, insert_segments: List[Dict]):
+def _concat_files_smart(uid: str, orig_file: str, insert_segments: List[Dict]):
+    entries = _get_concat_entries(orig_file, insert_segments)
+    output_filename = f"/tmp/{uid}-{uuid.uuid4()}.mp3"
+    return smartrender.render(entries, output_filename, get_index_cached({}, get_index))
+
+
+def _concat_files_pipelined(uid: str, track_progress: downloader.DownloadProgress, insert_segments: List[Dict]):
+    """
+    Splice-mode stitch of a track that is still downloading.
+
+    The track is indexed as its bytes arrive and each byte range is copied
+    as soon as it is known, so only the copy of the segments past the
+    downloaded part waits for the network.
+    """
+    orig_file = track_progress.wait_started()
+    track_index = ProgressiveFrameIndex(orig_file, track_progress.wait)
+    try:
+        entries = _get_concat_entries(orig_file, insert_segments)
+        ranges = iter_entry_ranges(entries, get_index_cached({orig_file: track_index}, get_index))
+        output_filename = f"/tmp/{uid}-{uuid.uuid4()}.mp3"
+        return write_ranges(output_filename, ranges)
+    finally:
+        track_index.close()
+
+
+def _concat_files(uid: str, orig_file: str, insert_segments: List[Dict], mode: str = STITCH_MODE_INPOINT):
+    """
+    Stitch the ads into orig_file without re-encoding.
+
+    STITCH_MODE_INPOINT references the track in one concat list with
+    inpoint/outpoint directives and stitches it with a single ffmpeg run.
+    STITCH_MODE_SPLICE cuts at MP3 frame boundaries and copies the byte
+    ranges into the output without any ffmpeg process or temporary slice.
+    STITCH_MODE_SMART splices too but re-encodes the frames around each
+    join, so the ads land on their exact sample without the gaps of their
+    encoder delay, see smartrender.
+    STITCH_MODE_SLICE is the legacy path, it slices the track into /tmp
+    first and concats the slices.
+    """
+    if mode == STITCH_MODE_INPOINT:
+        return _concat_files_single_pass(uid, orig_file, insert_segments)
+    if mode == STITCH_MODE_SPLICE:
+        return _concat_files_splice(uid, orig_file, insert_segments)
+    if mode == STITCH_MODE_SMART:
+        return _concat_files_smart(uid, orig_file, insert_segments)
+    if mode != STITCH_MODE_SLICE:
+        raise ValueError(f"Unknown stitch mode {mode}")
+
     basename = f"{uid}-{uuid.uuid4()}"
     concat_file_list = _get_concat_files(basename, orig_file, insert_segments)
 
@@ -118,36 +322,88 @@ def _concat_files(uid: str, orig_file: str, insert_segments: List[Dict]):
     return output_filename
 
 
-def _stitch_files_without_encoding(track: models.AudioTrack, track_audio_ads: List[models.AudioTrackAd]):
-    blob = audio_bucket.get_blob(track.urlSuffix)
-    file_url = blob.generate_signed_url(expiration=timedelta(hours=1))
-    adorified_file_path, _, _ = download_audio(file_url)
-
-    insert_segments = []
-    for ad in track_audio_ads:
-        blob = audio_bucket.get_blob(ad.audioAd.get_file_path())
-        url = blob.generate_signed_url(expiration=timedelta(hours=1))
-        local_filepath, _, _ = download_audio(url)
-        insert_segments.append({"markInMillis": ad.markInMillis, "filepath": local_filepath})
-
+def _stitch_files_without_encoding(
+    track: models.AudioTrack, track_audio_ads: List[models.AudioTrackAd], mode: str = STITCH_MODE_INPOINT
+):
+    """
+    :param mode: see _concat_files. STITCH_MODE_PIPELINE splices while the
+        track downloads, see _concat_files_pipelined
+    """
+    if mode == STITCH_MODE_PIPELINE:
+        track_download, track_progress, insert_segments = _download_sources_pipelined(track, track_audio_ads)
+        try:
+            output_file = _concat_files_pipelined(f"{track.id or ''}-{track.uid}", track_progress, insert_segments)
+            duration = estimate_duration(output_file)
+            duration_millis = duration * 1000
+            return output_file, duration_millis
+        finally:
+            _remove_ad_links(insert_segments)
+            _remove_download(track_download, track_progress)
+
+    adorified_file_path, insert_segments = _download_sources(track, track_audio_ads)
     try:
-        output_file = _concat_files(f"{track.id or ''}-{track.uid}", adorified_file_path, insert_segments)
-        duration = get_audio_length(output_file)
+        output_file = _concat_files(f"{track.id or ''}-{track.uid}", adorified_file_path, insert_segments, mode)
+        duration = estimate_duration(output_file)
         duration_millis = duration * 1000
         return output_file, duration_millis
     finally:
         # remove all temp files
         os.remove(adorified_file_path)
-        for seg in insert_segments:
-            os.remove(seg["filepath"])
+        _remove_ad_links(insert_segments)
+
+
+def stream_stitched_files(orig_file: str, insert_segments: List[Dict], chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """
+    Splice-mode stitch yielded as chunks instead of written to /tmp.
+
+    Sources are indexed lazily, so the first chunk is available once the
+    first segment is known. Memory use is bounded by ``chunk_size``.
+    """
+    entries = _get_concat_entries(orig_file, insert_segments)
+    ranges = iter_entry_ranges(entries, get_index_cached({}, get_index))
+    return iter_ranges(ranges, chunk_size)
+
+
+def stream_track(track: models.AudioTrack, track_audio_ads: List[models.AudioTrackAd]):
+    """
+    Generator of the stitched mp3 for a dynamic ad insertion response.
+
+    Nothing is materialized: the first chunks are sent while the track is
+    still downloading. When the generator is exhausted or closed (e.g. the
+    listener disconnected) the download is cancelled and its file removed
+    without waiting for it.
+    """
+    track_download, track_progress, insert_segments = _download_sources_pipelined(track, track_audio_ads)
+    try:
+        orig_file = track_progress.wait_started()
+        track_index = ProgressiveFrameIndex(orig_file, track_progress.wait)
+        try:
+            entries = _get_concat_entries(orig_file, insert_segments)
+            ranges = iter_entry_ranges(entries, get_index_cached({orig_file: track_index}, get_index))
+            yield from iter_ranges(ranges, DEFAULT_CHUNK_SIZE)
+        finally:
+            track_index.close()
+    finally:
+        _remove_ad_links(insert_segments)
+        _remove_download(track_download, track_progress)
 
 
 def _get_ffmpeg_filters_and_taps(audio_ads: List[models.AudioTrackAd]):
+    """
+    Filter graph parts of the encoding stitch.
+
+    An ad that runs in several breaks is one input, fanned out to its
+    breaks with asplit, so it is fetched and decoded once.
+
+    :return: (filters, taps in output order, file paths of the ad inputs 1..n)
+    """
     n_input_slice = 0
     prev_input_slice_end = 0
 
     trim_filters = []
     trim_filter_taps = []
+    # file path -> taps of its breaks, in the order the paths are first used
+    ad_taps: Dict[str, List[str]] = {}
 
     for idx, ad in enumerate(audio_ads):
         mark_in_sec = ad.markInMillis / 1000.0
@@ -161,50 +417,97 @@ def _get_ffmpeg_filters_and_taps(audio_ads: List[models.AudioTrackAd]):
             n_input_slice += 1
             prev_input_slice_end = mark_in_sec
         tap = "[ad{}]".format(idx)
-        filter_str = "[{}:a]anull{}".format(idx + 1, tap)
-        trim_filters.append(filter_str)
+        ad_taps.setdefault(ad.audioAd.get_file_path(), []).append(tap)
         trim_filter_taps.append(tap)
 
+    for input_idx, taps in enumerate(ad_taps.values(), start=1):
+        if len(taps) == 1:
+            filter_str = "[{}:a]anull{}".format(input_idx, taps[0])
+        else:
+            filter_str = "[{}:a]asplit={}{}".format(input_idx, len(taps), "".join(taps))
+        trim_filters.append(filter_str)
+
     tap = "[input{}]".format(n_input_slice)
     filter_str = "[0:a]atrim=start={},".format(prev_input_slice_end)
     filter_str += "asetpts=PTS-STARTPTS{}".format(tap)
     trim_filters.append(filter_str)
     trim_filter_taps.append(tap)
 
-    return trim_filters, trim_filter_taps
+    return trim_filters, trim_filter_taps, list(ad_taps)
+
+
+def _stitch_files_with_pcm_engine(track: models.AudioTrack, track_audio_ads: List[models.AudioTrackAd]):
+    adorified_file_path, insert_segments = _download_sources(track, track_audio_ads)
+    stitched_file_name = f"/tmp/{track.id or ''}-{track.uid}-{uuid.uuid4()}.mp3"
+    try:
+        pcmengine.stitch(adorified_file_path, insert_segments, stitched_file_name)
+    finally:
+        os.remove(adorified_file_path)
+        _remove_ad_links(insert_segments)
+    duration = estimate_duration(stitched_file_name)
+    return stitched_file_name, duration * 1000
 
 
-def _stitch_files_with_encoding(track: models.AudioTrack, track_audio_ads: List[models.AudioTrackAd]):
+def _stitch_files_with_encoding(
+    track: models.AudioTrack, track_audio_ads: List[models.AudioTrackAd], mode: str = ENCODE_MODE_SINGLE
+):
+    """
+    Stitch by decoding the track and ads and encoding the output again.
+
+    ENCODE_MODE_SINGLE encodes the whole output in the ffmpeg run of the
+    filter graph, on one core. ENCODE_MODE_SEGMENTED writes the output of
+    the filter graph to a WAV file and encodes it in segments on all cores,
+    see segmentencode. ENCODE_MODE_PCM replaces the filter graph with the
+    NumPy engine of pcmengine, which decodes each ad once across jobs.
+    """
+    if mode not in (ENCODE_MODE_SINGLE, ENCODE_MODE_SEGMENTED, ENCODE_MODE_PCM):
+        raise ValueError(f"Unknown encode mode {mode}")
 
     for ad in track_audio_ads:
         if ad.audioAd.adSourceId == models.AdServiceSource.THIRD_PARTY:
             raise ValueError("Only static ads are supported for stitching")
 
+    if mode == ENCODE_MODE_PCM:
+        return _stitch_files_with_pcm_engine(track, track_audio_ads)
+
     stitched_file_name = f"/tmp/{track.id or ''}-{track.uid}-{uuid.uuid4()}.mp3"
 
     blob = audio_bucket.get_blob(track.origFilePath)
     input_file = blob.generate_signed_url(timedelta(hours=1))
 
-    filters, taps = _get_ffmpeg_filters_and_taps(track_audio_ads)
+    filters, taps, ad_file_paths = _get_ffmpeg_filters_and_taps(track_audio_ads)
     concat_filter = "{}concat=n={}:v=0:a=1[outaudio]".format("".join(taps), len(taps))
     filters.append(concat_filter)
     filter_string = ";".join(filters)
 
     input_files = [input_file]
-    for ad in track_audio_ads:
-        blob = audio_bucket.get_blob(ad.audioAd.get_file_path())
+    for file_path in ad_file_paths:
+        blob = audio_bucket.get_blob(file_path)
         filename = blob.generate_signed_url(timedelta(hours=1))
         input_files.append(filename)
 
     cmd_args = ["ffmpeg", "-nostats", "-y", "-hide_banner", "-v", "quiet"]
     for f in input_files:
         cmd_args += ["-i", f]
-    cmd_args += ["-filter_complex", filter_string]
-    cmd_args += ["-map", "[outaudio]", stitched_file_name]
+    # graphs of episodes with many breaks are passed in a file, argv is limited
+    filter_script_name = f"{os.path.splitext(stitched_file_name)[0]}-filter.txt"
+    if len(filter_string) > MAX_FILTER_ARG_LENGTH:
+        with open(filter_script_name, "w") as f:
+            f.write(filter_string)
+        cmd_args += ["-filter_complex_script", filter_script_name]
+    else:
+        cmd_args += ["-filter_complex", filter_string]
+    wav_file_name = f"{os.path.splitext(stitched_file_name)[0]}.wav"
+    if mode == ENCODE_MODE_SEGMENTED:
+        cmd_args += ["-map", "[outaudio]", "-c:a", "pcm_s16le", wav_file_name]
+    else:
+        cmd_args += ["-map", "[outaudio]", stitched_file_name]
 
     try:
         subprocess.run(cmd_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        duration = get_audio_length(stitched_file_name)
+        if mode == ENCODE_MODE_SEGMENTED:
+            segmentencode.encode_wav(wav_file_name, stitched_file_name)
+        duration = get_duration(stitched_file_name)
         duration_millis = duration * 1000
     except subprocess.CalledProcessError as e:
         logger.error(
@@ -216,6 +519,10 @@ def _stitch_files_with_encoding(track: models.AudioTrack, track_audio_ads: List[
             command=" ".join(cmd_args),
         )
         raise
+    finally:
+        for temp_file_name in (wav_file_name, filter_script_name):
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
 
     return stitched_file_name, duration_millis
 
@@ -270,19 +577,33 @@ def _get_filename_from_hash(hash_string: str, ext: str = "mp3"):
     return f"v1-stitched/{hash_string}.{ext}"
 
 
+def _blob_exists(name: str) -> bool:
+    return audio_bucket.get_blob(name) is not None
+
+
 def get_track_url_suffix(track: models.AudioTrack, track_audio_ads: List[models.AudioTrackAd]):
     if not track_audio_ads:
         raise ValueError("ads can not be empty")
 
     hash_string = _get_hash(track, track_audio_ads)
     remote_filename = _get_filename_from_hash(f"{track.id or ''}-{track.uid}-{hash_string}")
-    if audio_bucket.get_blob(remote_filename):
+    # memory, then local disk, then the bucket
+    result_cache = get_result_cache()
+    if result_cache.exists(remote_filename, _blob_exists):
+        return remote_filename
+
+    def lookup():
+        return remote_filename if result_cache.exists(remote_filename, _blob_exists) else None
+
+    def stitch_and_upload():
+        stitched_filename, duration_millis = _stitch_files_without_encoding(track, track_audio_ads)
+        _upload_stitched_mp3_file(stitched_filename, remote_filename)
+        result_cache.add(remote_filename, stitched_filename)
+        os.remove(stitched_filename)
         return remote_filename
 
-    stitched_filename, duration_millis = _stitch_files_without_encoding(track, track_audio_ads)
-    _upload_stitched_mp3_file(stitched_filename, remote_filename)
-    os.remove(stitched_filename)
-    return remote_filename
+    # concurrent misses on the same hash (e.g. a new episode going live) stitch it once
+    return singleflight.run(hash_string, stitch_and_upload, lookup)
 
 
 if __name__ == "__main__":
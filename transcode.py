@@ -6,6 +6,7 @@ import subprocess
 import uuid
 import logging
 import shutil
+import tempfile
 from datetime import datetime
 from datetime import timedelta
 from typing import Dict
@@ -13,7 +14,6 @@ from typing import List
 from typing import Tuple
 
 # Third Party Imports
-import ffmpeg
 import requests
 
 # Imports from this repository
@@ -21,6 +21,7 @@ import requests
 sys.path.append("/workspaces/Adorify")
 from pyadorifier.utils.logger import get_logger
 from pyadorifier.utils.adorify import run_pb_adorifier
+from adstore import transcode_args
 
 logger = get_logger(__name__)
 
@@ -46,46 +47,28 @@ def do_pbadorify(input_filename: str, output_filename: str, adoriId: int):
     else:
         return False
 
+# Scratch directory for intermediates that have to exist as files (e.g. the input of run_pb_adorifier).
+# /dev/shm is RAM backed on Linux, elsewhere the system temp directory is used.
+def scratch_dir():
+    _dir = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+    _dir = os.path.join(_dir, "ad_stitching")
+    os.makedirs(_dir, exist_ok=True)
+    return _dir
+
+
+# Unique per job, so concurrent transcodes never overwrite each other's intermediate
+def scratch_file(ext: str = ".mp3"):
+    return os.path.join(scratch_dir(), f"{uuid.uuid4()}{ext}")
+
+
 def do_transcode(input_filename: str, output_filename: str):
     if os.path.exists(input_filename):
         try:                
             print(f"tanscoding {input_filename}")
-            subprocess.check_call(
-                args=[
-                    "ffmpeg",
-                    "-y",
-                    "-hide_banner",
-                    "-nostats",
-                    "-loglevel",
-                    "panic",
-                    "-i",
-                    input_filename,
-                    "temp.wav",
-                ]
-            )
-            subprocess.check_call(
-                args=[
-                    "ffmpeg",
-                    "-y",
-                    "-hide_banner",
-                    "-nostats",
-                    "-loglevel",
-                    "panic",
-                    "-i",
-                    "temp.wav",
-                    "-ar",
-                    "44100",
-                    "-ac",
-                    "2",
-                    "-b:a", 
-                    "128k",
-                    output_filename,
-                ]
-            )
-            if os.path.exists("temp.wav"): os.remove("temp.wav")
+            subprocess.check_call(args=transcode_args(input_filename, output_filename))
             return True 
-        except ffmpeg.Error as e:
-            logger.error("ffmpeg.probe do_transcode : {}".format(e.stderr))
+        except subprocess.CalledProcessError as e:
+            logger.error("ffmpeg do_transcode : {}".format(e))
             return False
     else:
         logger.error("File Does not exist : {}".format(input_filename))
@@ -106,10 +89,11 @@ def main(argv):
         adoriId = int(sys.argv[3])
         print(f" input_filename: {input_filename}\n output_filename: {output_filename}\n adoriId: {adoriId}\n")
     if os.path.exists(input_filename):
-        result =  do_transcode(input_filename,"transcoded.mp3")
+        transcoded_filename = scratch_file()
+        result =  do_transcode(input_filename, transcoded_filename)
         if(result==True):
-            do_pbadorify("transcoded.mp3", output_filename,  adoriId)
-        if os.path.exists("transcoded.mp3"): os.remove("transcoded.mp3")
+            do_pbadorify(transcoded_filename, output_filename,  adoriId)
+        if os.path.exists(transcoded_filename): os.remove(transcoded_filename)
     else:
         print("file not found")
 